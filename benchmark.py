@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Measure how many chat events per second LazySusan dispatches.
+
+Speak events, a tenth of them /echo commands, are emitted through the API
+client, whose websocket is replaced by one that records the frames sent, so
+no connection is needed. Run it with each Python version to compare them:
+
+    python benchmark.py --events 20000 --runs 5
+
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+from lazysusan import LazySusan
+
+# chat_server avoids looking up turntable's server; no connection is made
+CONFIG = """[benchmark]
+admin_ids: benchmark
+auth_id: benchmark
+chat_server: 127.0.0.1:8080
+user_id: benchmark
+room_id: benchmark
+plugins: simple.Talk
+"""
+USERS = 50
+
+
+class RecordingSocket(object):
+
+    """A websocket that records the frames sent rather than sending them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame):
+        """Record a frame."""
+        self.sent.append(frame)
+
+
+def make_bot():
+    """Return a bot running simple.Talk that records its API requests."""
+    bot = LazySusan('benchmark', None, False, False)
+    bot.username = 'benchmark'
+    bot.ready_time = time.time()
+    if 'simple.Talk' not in bot._loaded_plugins:
+        bot.load_plugin('simple.Talk')
+    bot.api.rateLimit = 0
+    bot.api.ws = RecordingSocket()
+    return bot, bot.api.ws.sent
+
+
+def run(bot, sent, num_events):
+    """Emit num_events speak events and return the elapsed seconds."""
+    events = []
+    for i in range(num_events):
+        text = '/echo hi' if i % 10 == 0 else 'just chatting {0}'.format(i)
+        events.append({'command': 'speak', 'name': 'n{0}'.format(i % USERS),
+                       'text': text, 'userid': 'u{0}'.format(i % USERS)})
+    del sent[:]
+    start = time.time()
+    for data in events:
+        bot.api.emit('speak', data)
+    return time.time() - start
+
+
+def main():
+    """Provide the entry point to the benchmark."""
+    parser = OptionParser()
+    parser.add_option('--events', type='int', default=20000,
+                      help='The number of events per run (default: 20000).')
+    parser.add_option('--runs', type='int', default=5,
+                      help='The number of runs, of which the fastest is '
+                      'reported (default: 5).')
+    options, _ = parser.parse_args()
+
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)  # Read the config and write state files here
+        with open('lazysusan.ini', 'w') as fp:
+            fp.write(CONFIG)
+        bot, sent = make_bot()
+        best = min(run(bot, sent, options.events)
+                   for _ in range(options.runs))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    print('{0:.0f} events/s'.format(options.events / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,51 @@
 """LazySusan is a pluginable bot for turntable.fm."""
 
 from __future__ import print_function
+import atexit
+import gc
 import heapq
+import json
 import logging
 import os
+import re
 import sys
+import threading
 import time
-from ConfigParser import ConfigParser
+import weakref
 from datetime import datetime
-from lazysusan.helpers import (admin_required, display_exceptions,
-                               dynamic_permissions, get_sender_id,
-                               no_arg_command, single_arg_command)
-from lazysusan.plugins import CommandPlugin
+from lazysusan.connection import ConnectionSupervisor
+from lazysusan.frames import COMMAND_RE, FrameFilter
+from lazysusan.history import ChatHistory
+from lazysusan.jobs import JobManager
+from lazysusan.membership import MembershipCoalescer
+from logging.handlers import RotatingFileHandler
+from lazysusan.helpers import (admin_or_moderator_required, admin_required,
+                               display_exceptions, dynamic_permissions,
+                               encode_message, get_sender_id, import_plugin,
+                               moderator_required, no_arg_command,
+                               single_arg_command)
+from lazysusan.plugins import CommandPlugin, Plugin
+from lazysusan.process import COMMAND_FLAGS, ProcessPlugin
+from lazysusan.readcache import ReadCache
+from lazysusan.shared import SharedCache
+from lazysusan.snapshot import SnapshotManager
+from lazysusan.songs import SongCache
+from lazysusan.supervisor import Supervisor
+from lazysusan.throttle import CommandThrottle
+from lazysusan.tracing import AdaptivePacer, ApiTracer
 from optparse import OptionParser
 from ttapi import Bot
 from update_checker import pretty_date, update_check
+try:
+    from ConfigParser import ConfigParser
+    from Queue import Full, Queue
+except ImportError:  # Python 3
+    from configparser import ConfigParser
+    from queue import Full, Queue
+try:
+    STRING_TYPES = basestring
+except NameError:  # Python 3
+    STRING_TYPES = str
 
 __version__ = '0.1rc11'
 
@@ -34,12 +65,19 @@ class LazySusan(object):
 
     """The primary class for LazySusan that represents a bot."""
 
+    CONFIG_CHECK_INTERVAL = 5
+    CONFIG_LIST_PREFIXES = ('botplaylist.',)
+    CONFIG_LINE_KEYS = ('lazy_plugins', 'plugins', 'process_plugins')
+    CONFIG_SET_KEYS = ('admin_ids',)
+    PERMISSION_DECORATORS = (
+        ('admin_or_moderator_required', admin_or_moderator_required),
+        ('admin_required', admin_required),
+        ('moderator_required', moderator_required))
     update_checked = False
 
     @staticmethod
-    def _get_config(section):
-        """Return a dictionary of configuration options for the section."""
-        config = ConfigParser()
+    def _config_locations():
+        """Return the list of paths lazysusan.ini is read from, in order."""
         if 'APPDATA' in os.environ:  # Windows
             os_config_path = os.environ['APPDATA']
         elif 'XDG_CONFIG_HOME' in os.environ:  # Modern Linux
@@ -51,19 +89,57 @@ class LazySusan(object):
         locations = ['lazysusan.ini']
         if os_config_path is not None:
             locations.insert(0, os.path.join(os_config_path, 'lazysusan.ini'))
-        if not config.read(locations):
+        return locations
+
+    @classmethod
+    def _config_mtimes(cls):
+        """Return the modification time of each config location (or None)."""
+        mtimes = []
+        for path in cls._config_locations():
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    @classmethod
+    def _get_config(cls, section):
+        """Return a dictionary of configuration options for the section.
+
+        Multi-valued options are parsed once here: admin_ids into a frozenset,
+        and plugins, lazy_plugins and local playlists into tuples.
+
+        """
+        config = ConfigParser()
+        if not config.read(cls._config_locations()):
             raise LazySusanException('No lazysusan.ini found.')
         if not config.has_section(section) and section != 'DEFAULT':
             raise LazySusanException('No section `{0}` found in lazysusan.ini.'
                                      .format(section))
-        return dict(config.items(section))
-
-    def __init__(self, config_section, plugin_dir, enable_logging):
-        if not self.update_checked:
-            update_check(__name__, __version__)
-            self.update_checked = True
-
+        retval = {}
+        for key, value in config.items(section):
+            if key in cls.CONFIG_SET_KEYS:
+                value = frozenset(value.split())
+            elif key in cls.CONFIG_LINE_KEYS:
+                value = tuple(x.strip() for x in value.split('\n')
+                              if x.strip())
+            elif key.startswith(cls.CONFIG_LIST_PREFIXES):
+                value = tuple(value.split())
+            retval[key] = value
+        return retval
+
+    def __init__(self, config_section, plugin_dir, enable_logging,
+                 check_for_updates=True, share=False):
         self.start_time = datetime.utcnow()
+        self._start_clock = time.time()
+
+        if check_for_updates and not self.update_checked:
+            # Never delay connecting on the update server's round trip
+            thread = threading.Thread(target=update_check,
+                                      args=(__name__, __version__))
+            thread.daemon = True
+            thread.start()
+            LazySusan.update_checked = True
 
         if plugin_dir:
             if os.path.isdir(plugin_dir):
@@ -71,11 +147,24 @@ class LazySusan(object):
             else:
                 print('`{0}` is not a directory.'.format(plugin_dir))
 
+        self._close_reason = None  # Why start's websocket last closed
+        self._config_stamp = self._config_mtimes()
         config = self._get_config(config_section)
         self._delayed_events = []
+        self._lazy_plugins = {}
         self._loaded_plugins = {}
         self.api = Bot(config['auth_id'], config['user_id'], rate_limit=0.575)
         self.api.debug = enable_logging
+        # Serializes use of the API client with plugin worker threads
+        self.api_lock = threading.RLock()
+        self.frames = FrameFilter(self.api)
+        self.api.on_message = self._locked(
+            self.frames.wrap(self.api.on_message))
+        self.connection = ConnectionSupervisor(self.api)
+        self.membership = MembershipCoalescer(self)
+        self.pacer = AdaptivePacer(self.api)
+        self.tracer = ApiTracer(self.api, self.pacer)
+        self.read_cache = ReadCache(self.api)
         self.api.on('add_dj', self.handle_add_dj)
         self.api.on('booted_user', self.handle_booted_user)
         self.api.on('deregistered', self.handle_user_leave)
@@ -90,28 +179,77 @@ class LazySusan(object):
         self.api.on('speak', self.handle_room_message)
         self.bot_id = config['user_id']
         self.commands = {'/about': self.cmd_about,
+                         '/apistats': self.cmd_api_stats,
                          '/commands': self.cmd_commands,
+                         '/connection': self.cmd_connection,
+                         '/grep': self.cmd_grep,
                          '/help': self.cmd_help,
+                         '/jobcancel': self.cmd_job_cancel,
+                         '/jobs': self.cmd_jobs,
                          '/join': self.cmd_join,
                          '/leave': self.cmd_leave,
                          '/pgload': self.cmd_plugin_load,
                          '/pgreload': self.cmd_plugin_reload,
                          '/pgunload': self.cmd_plugin_unload,
                          '/plugins': self.cmd_plugins,
+                         '/seen': self.cmd_seen,
                          '/uptime': self.cmd_uptime}
         self.config = config
+        self.config_section = config_section
         self.dj_ids = set()
+        self.history = ChatHistory(int(config.get('history_size', 5000)))
+        self.jobs = JobManager(self)
         self.listener_ids = set()
         self.max_djs = None
         self.moderator_ids = set()
+        self.ready_time = None
+        self.shared = SharedCache(self, share or 'shared_dir' in config)
+        self.snapshots = SnapshotManager(self)
+        self.songs = SongCache(int(config.get('song_cache_size',
+                                              SongCache.MAX_SIZE)))
+        self.api.on('pre_message', self.songs.handle_message)
+        # They only read responses and newsong frames, which are always decoded
+        self.frames.decoded_only.update([self.songs.handle_message,
+                                         self.tracer.handle_message])
+        self.throttle = CommandThrottle()
         self.username = None
+        snapshot = self.snapshots.load()
+
+        if 'chat_server' in config:  # E.g., lazysusan.fakeserver for testing
+            host, _, port = config['chat_server'].rpartition(':')
+            self.api.whichServer = lambda _: [host, int(port)]
+
+        # Connect first so that the room is joined as soon as the websocket
+        # starts. Plugins defer their API fetches until `ready` (see warmup).
+        # The handshake (authenticate, getFanOf, room.register and a presence
+        # update) is sent without the rate limit, which otherwise delays each
+        # of its requests; the limit is restored once ready.
+        self._handshake_rate_limit = self.api.rateLimit
+        self.api.rateLimit = 0
+        self.api.connect(config['room_id'])
 
         # Load plugins after everything has been initialized
-        for plugin in config['plugins'].split('\n'):
+        for plugin in config['plugins']:
             self.load_plugin(plugin)
+        for plugin, triggers in self._lazy_config(config).items():
+            self.declare_lazy_plugin(plugin, triggers)
+        self.schedule(self.CONFIG_CHECK_INTERVAL, self.check_config)
+        if snapshot:
+            self.snapshots.restore_events(snapshot)
+        self.schedule(self.snapshots.INTERVAL, self.snapshots.checkpoint)
 
-        self.api.connect(config['room_id'])
-        self.api.ws.on_error = handle_error
+    @staticmethod
+    def _lazy_config(config):
+        """Return a mapping of lazy plugin name to its list of triggers."""
+        return dict((line.split()[0], line.split()[1:])
+                    for line in config.get('lazy_plugins', ()))
+
+    def _locked(self, function):
+        """Return a wrapper of function that holds the API lock."""
+        def _closure(*args, **kwargs):
+            with self.api_lock:
+                return function(*args, **kwargs)
+        return _closure
 
     def _load_command_plugin(self, plugin):
         """Load a plugin (by name) that responds to a command.
@@ -122,10 +260,10 @@ class LazySusan(object):
         to_add = {}
         for command, func_name in plugin.COMMANDS.items():
             if command in self.commands:
-                other = self.commands[command]
-                if isinstance(other.im_self, CommandPlugin):
+                other = getattr(self.commands[command], '__self__', None)
+                if isinstance(other, CommandPlugin):
                     print('`{0}` conflicts with `{1}` for command `{2}`.'
-                          .format(plugin.NAME, other.im_self.NAME, command))
+                          .format(plugin.NAME, other.NAME, command))
                 else:
                     print('`{0}` cannot use the reserved command `{1}`.'
                           .format(plugin.NAME, command))
@@ -135,11 +273,105 @@ class LazySusan(object):
         self.commands.update(to_add)
         return True
 
+    def _private_ok(self, data):
+        """Return whether a reply to data may quote private messages.
+
+        That is only the case for admins, and only in a private message.
+
+        """
+        return data['command'] == 'pmmed' and self.is_admin(data)
+
+    def _process_plugin_options(self, plugin_name):
+        """Return the worker options for a process plugin, else None.
+
+        Each line of process_plugins names a plugin to run in a worker
+        process, optionally followed by limits: cpu=SECONDS, memory=MB and
+        nice=INCREMENT.
+
+        """
+        for line in self.config.get('process_plugins', ()):
+            parts = line.split()
+            if parts[0] != plugin_name:
+                continue
+            options = {}
+            for option in parts[1:]:
+                key, _, value = option.partition('=')
+                if key not in ('cpu', 'memory', 'nice') or \
+                        not value.isdigit():
+                    print('Ignoring invalid option `{0}` for plugin `{1}`.'
+                          .format(option, plugin_name))
+                    continue
+                options[key] = int(value)
+            return options
+        return None
+
+    def _remove_lazy_plugin(self, plugin_name):
+        """Remove the placeholder commands and events of a lazy plugin."""
+        commands, events = self._lazy_plugins.pop(plugin_name)
+        for command in commands:
+            del self.commands[command]
+        for event, placeholder in events:
+            # Replace rather than mutate the list as it may be mid-emit
+            self.api.signals[event] = [x for x in self.api.signals[event]
+                                       if x is not placeholder]
+
     def _unload_command_plugin(self, plugin):
         """Unload a plugin (by name) that responds to commands."""
         for command in plugin.COMMANDS:
             del self.commands[command]
 
+    def cancel_scheduled(self, owner):
+        """Cancel the scheduled events whose callback is a method of owner."""
+        self._delayed_events = [
+            x for x in self._delayed_events
+            if getattr(x[1], '__self__', None) is not owner]
+        heapq.heapify(self._delayed_events)
+
+    def check_config(self):
+        """Reload lazysusan.ini if it changed and apply the changes live.
+
+        Admins and local playlists are read from the config on use, so only
+        the set of (lazy) plugins needs to be updated here.
+
+        """
+        self.schedule(self.CONFIG_CHECK_INTERVAL, self.check_config)
+        stamp = self._config_mtimes()
+        if stamp == self._config_stamp:
+            return
+        self._config_stamp = stamp
+        try:
+            config = self._get_config(self.config_section)
+        except LazySusanException as exc:
+            print('Not reloading lazysusan.ini: {0}'.format(exc))
+            return
+        previous = self.config
+        self.config = config
+        print('Reloaded lazysusan.ini.')
+        for key in ('auth_id', 'user_id'):
+            if previous.get(key) != config.get(key):
+                print('Changing `{0}` requires a restart.'.format(key))
+
+        for plugin in previous['plugins']:
+            if plugin not in config['plugins']:
+                self.unload_plugin(plugin)
+        for plugin in config['plugins']:
+            if plugin not in self._loaded_plugins:
+                self.load_plugin(plugin)
+        previous_lazy = self._lazy_config(previous)
+        lazy = self._lazy_config(config)
+        for plugin in previous_lazy:
+            if plugin in lazy:
+                continue
+            if plugin in self._lazy_plugins:
+                self._remove_lazy_plugin(plugin)
+            elif plugin in self._loaded_plugins and \
+                    plugin not in config['plugins']:  # Loaded on first use
+                self.unload_plugin(plugin)
+        for plugin, triggers in lazy.items():
+            if plugin not in self._loaded_plugins and \
+                    plugin not in self._lazy_plugins:
+                self.declare_lazy_plugin(plugin, triggers)
+
     @no_arg_command
     def cmd_about(self, data):
         """Display information about this bot."""
@@ -147,6 +379,21 @@ class LazySusan(object):
                  'https://github.com/bboe/LazySusan'.format(__version__))
         self.reply(reply, data)
 
+    @admin_required
+    @no_arg_command
+    def cmd_api_stats(self, data):
+        """Display the API request rate limit and per-method statistics."""
+        reply = ('Rate limit: {0:.3f}s, recent error rate: {1:.0%}. '
+                 .format(self.api.rateLimit, self.pacer.error_rate))
+        reply += self.tracer.summary()
+        reply += '. Frames: {decoded} decoded, {dropped} dropped'.format(
+            **self.frames.stats)
+        reply += ('. Read cache: {0:.0%} hit rate ({1} hits, {2} shared)'
+                  .format(self.read_cache.hit_rate,
+                          self.read_cache.stats['hits'],
+                          self.read_cache.stats['shared']))
+        self.reply(reply, data)
+
     @no_arg_command
     def cmd_commands(self, data):
         """List the available commands."""
@@ -157,14 +404,14 @@ class LazySusan(object):
         no_priv_cmds = []
 
         for command, func in self.commands.items():
-            if func.func_dict.get('dynamic_permissions'):
+            if func.__dict__.get('dynamic_permissions'):
                 # TODO: Handle this case
                 pass
-            elif func.func_dict.get('admin_required'):
+            elif func.__dict__.get('admin_required'):
                 admin_cmds.append(command)
-            elif func.func_dict.get('admin_or_moderator_required'):
+            elif func.__dict__.get('admin_or_moderator_required'):
                 admin_or_moderator_cmds.append(command)
-            elif func.func_dict.get('moderator_required'):
+            elif func.__dict__.get('moderator_required'):
                 moderator_cmds.append(command)
             else:
                 no_priv_cmds.append(command)
@@ -187,6 +434,25 @@ class LazySusan(object):
             reply += ', '.join(sorted(admin_cmds))
             self.api.pm(reply, user_id)
 
+    @admin_required
+    @no_arg_command
+    def cmd_connection(self, data):
+        """Display the health of the bot's connection to turntable."""
+        metrics = self.connection.metrics()
+        for key, value in self.membership.stats.items():
+            metrics['membership_' + key] = value
+        reply = ', '.join('{0}: {1}'.format(key, metrics[key])
+                          for key in sorted(metrics))
+        self.reply(reply, data)
+
+    def _close_stale_connection(self):
+        """Close the websocket so that start will reconnect."""
+        print('No messages received in {0} seconds. Reconnecting.'
+              .format(int(self.connection.seconds_since_frame)))
+        if self.api.ws:
+            self._close_reason = 'stale'
+            self.api.ws.close()
+
     def _connect(self, room_id, when_connected=True):
         """Internal function to handling joining rooms.
 
@@ -201,6 +467,35 @@ class LazySusan(object):
         print('Joining {0}'.format(room_id))
         self.api.roomRegister(room_id)
 
+    def _handle_websocket_error(self, websocket, error):
+        """Note an interrupt caught by websocket-client, else output it.
+
+        websocket-client catches KeyboardInterrupt in run_forever and passes it
+        to on_error rather than raising it, and what run_forever returns
+        differs between its versions.
+
+        """
+        if isinstance(error, KeyboardInterrupt):
+            self._close_reason = 'interrupt'
+        elif self._close_reason != 'stale':  # Closing it raises an error
+            handle_error(websocket, error)
+
+    @single_arg_command
+    def cmd_grep(self, message, data):
+        """Display the most recent chat messages containing the given word."""
+        # Private messages are only shown to admins, and never in the room
+        entries = self.history.search(message,
+                                      include_private=self._private_ok(data))
+        if not entries:
+            self.reply(u'Nobody has said `{0}` recently.'.format(message),
+                       data)
+            return
+        now = time.time()
+        self.reply(u' | '.join(
+            u'{0} ({1}s ago): {2}'.format(name or user_id, int(now - when),
+                                          text)
+            for when, user_id, name, text, _ in entries), data)
+
     def cmd_help(self, message, data):
         """With no arguments, display this message. Otherwise, display the help
         for the given command. Type /commands to see the list of commands."""
@@ -217,7 +512,7 @@ class LazySusan(object):
             reply = docstr(self.cmd_help)
         elif ' ' not in message:
             if message in self.commands:
-                tmp = self.commands[message].func_dict
+                tmp = self.commands[message].__dict__
                 if tmp.get('admin_required') and not self.is_admin(data) or \
                         tmp.get('moderator_required') and \
                         not self.is_moderator(data):
@@ -229,6 +524,26 @@ class LazySusan(object):
             return
         self.reply(reply, data)
 
+    @admin_required
+    @single_arg_command
+    def cmd_job_cancel(self, message, data):
+        """Cancel the background job with the given id."""
+        if message.isdigit() and self.jobs.cancel(int(message)):
+            reply = 'Job {0} cancelled.'.format(message)
+        else:
+            reply = 'There is no job {0}.'.format(message)
+        self.reply(reply, data)
+
+    @no_arg_command
+    def cmd_jobs(self, data):
+        """Display the running background jobs and their progress."""
+        if not self.jobs.jobs:
+            self.reply('There are no jobs running.', data)
+            return
+        self.reply('Jobs: ' + ', '.join(
+            '{0}: {1}'.format(job_id, job.describe())
+            for job_id, job in self.jobs.jobs.items()), data)
+
     @admin_required
     def cmd_join(self, message, data):
         """Join the room by room_id.
@@ -277,9 +592,13 @@ class LazySusan(object):
     def cmd_plugin_reload(self, message, data):
         """Reoad the specified plugin."""
         if message not in self._loaded_plugins:
-            reply = 'Plugin `{0}` is not loaded.'.format(message)
-        elif not (self.unload_plugin(message) and
-                  self.load_plugin(message, attempt_reload=True)):
+            self.reply('Plugin `{0}` is not loaded.'.format(message), data)
+            return
+        plugin = self._loaded_plugins[message]
+        state = (plugin.export_state(), plugin.STATE_VERSION)
+        del plugin  # The old instance must not outlive unload_plugin
+        if not (self.unload_plugin(message) and
+                self.load_plugin(message, attempt_reload=True, state=state)):
             reply = 'Plugin `{0}` could not be reloaded.'.format(message)
         else:
             reply = 'Plugin `{0}` reloaded.'.format(message)
@@ -303,6 +622,21 @@ class LazySusan(object):
         """Display the list of loaded plugins."""
         reply = 'Loaded plugins: '
         reply += ', '.join(sorted(self._loaded_plugins.keys()))
+        if self._lazy_plugins:
+            reply += '. Not yet loaded: '
+            reply += ', '.join(sorted(self._lazy_plugins.keys()))
+        self.reply(reply, data)
+
+    @single_arg_command
+    def cmd_seen(self, message, data):
+        """Display when the given user last said something."""
+        entry = self.history.last_message(
+            message, include_private=self._private_ok(data))
+        if not entry:
+            reply = u'I have not seen {0} recently.'.format(message)
+        else:
+            reply = u'{0} was last seen {1}s ago saying: {2}'.format(
+                entry[2], int(time.time() - entry[0]), entry[3])
         self.reply(reply, data)
 
     @no_arg_command
@@ -323,6 +657,80 @@ class LazySusan(object):
             item = get_sender_id(item)
         return item in self.moderator_ids
 
+    def declare_lazy_plugin(self, plugin_name, triggers):
+        """Declare a plugin that is loaded on its first command or event.
+
+        :param plugin_name: The plugin name as accepted by load_plugin.
+        :param triggers: A list of the plugin's commands (those starting with
+            `/`) and the API events it subscribes to.
+
+        The plugin's class is imported, but not instantiated, so that each
+        placeholder command gets the docstring, permission flags and throttle
+        cost of the plugin's command. Users without a required permission are
+        refused before the plugin is loaded, except for dynamic permissions,
+        which the command checks once loaded.
+
+        Return whether or not the plugin was declared successfully.
+
+        """
+        def command_placeholder(command, func):
+            """Return a command that loads the plugin and then runs."""
+            def _closure(_, message, data):
+                if self.load_plugin(plugin_name) and command in self.commands:
+                    self.commands[command](message, data)
+            flags = dict((x, func.__dict__[x]) for x in COMMAND_FLAGS
+                         if func.__dict__.get(x))
+            for flag, decorator in self.PERMISSION_DECORATORS:
+                if flag in flags:  # Deny before loading, as the command does
+                    _closure = decorator(_closure)
+
+            def placeholder(message, data):  # pylint: disable-msg=C0111
+                return _closure(self, message, data)
+            placeholder.__doc__ = func.__doc__
+            placeholder.__dict__.update(flags)
+            return placeholder
+
+        def event_placeholder(event):
+            """Return a callback that loads the plugin on the event."""
+            def _closure(data):
+                if not self.load_plugin(plugin_name):
+                    return
+                # The new callbacks were not registered in time for this emit
+                plugin = self._loaded_plugins[plugin_name]
+                for reg_event, callback in plugin._registered.values():
+                    if reg_event == event:
+                        callback(data)
+            return _closure
+
+        if plugin_name in self._loaded_plugins or \
+                plugin_name in self._lazy_plugins:
+            print('Plugin `{0}` is already loaded.'.format(plugin_name))
+            return False
+        plugin_class = import_plugin(plugin_name)
+        if not plugin_class:
+            print('Cannot find plugin `{0}`.'.format(plugin_name))
+            return False
+        commands = [x for x in triggers if x.startswith('/')]
+        plugin_commands = getattr(plugin_class, 'COMMANDS', {})
+        for command in commands:
+            if command in self.commands or command not in plugin_commands:
+                print('`{0}` cannot use the command `{1}`.'
+                      .format(plugin_name, command))
+                print('Not declaring plugin `{0}`.'.format(plugin_name))
+                return False
+        for command in commands:
+            self.commands[command] = command_placeholder(
+                command, getattr(plugin_class, plugin_commands[command]))
+        events = []
+        for event in triggers:
+            if not event.startswith('/'):
+                placeholder = event_placeholder(event)
+                self.api.on(event, placeholder)
+                events.append((event, placeholder))
+        self._lazy_plugins[plugin_name] = (commands, events)
+        print('Declared lazy plugin `{0}`.'.format(plugin_name))
+        return True
+
     def handle_add_dj(self, data):
         """Handle the event indicating a new dj stepped up to the table."""
         for user in data['user']:
@@ -331,9 +739,9 @@ class LazySusan(object):
     def handle_booted_user(self, data):
         """Handle the event indicating a user was booted from the room."""
         if data['userid'] == self.bot_id:
-            # Try to rejoin the default room after 30 seconds.
+            # Try to rejoin the default room after at least 30 seconds.
             self.api.roomId = None
-            self.schedule(30, self._connect, self.config['room_id'], False)
+            self.reconnect(minimum_delay=30)
 
     def handle_add_moderator(self, data):
         """Handle the event indicating a user was promoted to moderator."""
@@ -342,13 +750,29 @@ class LazySusan(object):
     def handle_pm(self, data):
         """Handle the event indicating LazySusan received a private message."""
         self.process_message(data)
+        sender_id = data['senderid']
+        self.history.add(sender_id, self.history.name(sender_id) or sender_id,
+                         data['text'], private=True)
 
     def handle_ready(self, _):
-        """Handle the event indicating LazySusan has connected to turntable."""
+        """Handle the event indicating LazySusan has connected to turntable.
+
+        Plugin warmup requests are all issued at this point so that their
+        responses arrive concurrently rather than as a chain.
+
+        """
         def callback(cb_data):
             """Handle response to the userInfo API call."""
             self.username = cb_data['name']
+        self.ready_time = time.time()
+        print('Ready in {0:.3f} seconds.'
+              .format(self.ready_time - self._start_clock))
+        if self._handshake_rate_limit is not None:
+            self.api.rateLimit = self._handshake_rate_limit
+            self._handshake_rate_limit = None
         self.api.userInfo(callback)
+        for plugin in self._loaded_plugins.values():
+            self.warmup_plugin(plugin)
 
     @display_exceptions
     def handle_remove_dj(self, data):
@@ -364,26 +788,29 @@ class LazySusan(object):
     def handle_room_change(self, data):
         """Handle the response to a room connect event (_connect)."""
         if not data['success']:
+            self.connection.record_failure()
             if data['errno'] == 3:
-                print('You are banned from that room. Retrying in 3 minutes.')
-                self.schedule(180, self._connect, self.config['room_id'],
-                              False)
+                print('You are banned from that room.')
+                self.reconnect(minimum_delay=180)
                 return
             print('Error changing rooms.')
             # Try to rejoin the default room
             self.api.roomId = None
-            self._connect(self.config['room_id'])
+            self.reconnect()
             return
+        self.connection.record_success()
         self.dj_ids = set(data['room']['metadata']['djs'])
         self.listener_ids = set(x['userid'] for x in data['users'])
         self.max_djs = data['room']['metadata']['max_djs']
         self.moderator_ids = set(data['room']['metadata']['moderator_id'])
+        self.jobs.resume()  # Responses to in-flight requests were lost
 
     @display_exceptions
     def handle_room_message(self, data):
         """Handle the event indicating a chat room message was received."""
         if self.username and self.username != data['name']:
             self.process_message(data)
+            self.history.add(data['userid'], data['name'], data['text'])
 
     def handle_user_join(self, data):
         """Handle the event indicating a user joined the room."""
@@ -396,7 +823,7 @@ class LazySusan(object):
         for user in data['user']:
             self.listener_ids.remove(user['userid'])
 
-    def load_plugin(self, plugin_name, attempt_reload=False):
+    def load_plugin(self, plugin_name, attempt_reload=False, state=None):
         """Load a LazySusan plugin by name.
 
         :param plugin_name: Indicates the plugin to load. The plugin name
@@ -405,48 +832,45 @@ class LazySusan(object):
             version `name` is appropriate.
         :param attempt_reload: Must be set to True in order to reload an
             already loaded plugin.
+        :param state: A tuple of the (state, version) exported by a previous
+            instance of the plugin to restore before the plugin warms up. By
+            default, the state from the snapshot loaded at startup, if any.
 
         """
-        parts = plugin_name.split('.')
-        if len(parts) > 1:
-            module_name = '.'.join(parts[:-1])
-            class_name = parts[-1]
+        if plugin_name in self._lazy_plugins:
+            self._remove_lazy_plugin(plugin_name)
+        if state is None:  # Restore the state saved before a restart
+            state = self.snapshots.plugin_state(plugin_name)
+        options = self._process_plugin_options(plugin_name)
+        if options is not None:
+            plugin = ProcessPlugin(self, plugin_name, **options)
+            if not plugin.start():
+                return False
         else:
-            # Use the titlecase format of the module name as the class name
-            module_name = parts[0]
-            class_name = parts[0].title()
-
-        # First try to load plugins from the passed in plugins_dir and then
-        # from the lazysusan.plugins package.
-        module = None
-        for package in (None, 'lazysusan.plugins'):
-            if package:
-                module_name = '{0}.{1}'.format(package, module_name)
-
-            if attempt_reload and module_name in sys.modules:
-                module = reload(sys.modules[module_name])
-            else:
-                try:
-                    module = __import__(module_name, fromlist=[class_name])
-                except ImportError:
-                    pass
-            if module:
-                break
-        if not module:
-            print('Cannot find plugin `{0}`.'.format(plugin_name))
-            return False
-        try:
-            plugin = getattr(module, class_name)(self)
-        except AttributeError:
-            print('Cannot find plugin `{0}`.'.format(plugin_name))
-            return False
+            plugin_class = import_plugin(plugin_name, attempt_reload)
+            if not plugin_class:
+                print('Cannot find plugin `{0}`.'.format(plugin_name))
+                return False
+            try:
+                plugin = plugin_class(self)
+            except AttributeError:
+                print('Cannot find plugin `{0}`.'.format(plugin_name))
+                return False
+            plugin.__class__.NAME = plugin_name
 
-        plugin.__class__.NAME = plugin_name
         if isinstance(plugin, CommandPlugin):
             if not self._load_command_plugin(plugin):
+                plugin.close()
                 return
         self._loaded_plugins[plugin_name] = plugin
         print('Loaded plugin `{0}`.'.format(plugin_name))
+        if state and state[0] is not None:
+            if plugin.import_state(*state):
+                print('Restored state of plugin `{0}`.'.format(plugin_name))
+            else:
+                print('Discarded state of plugin `{0}`.'.format(plugin_name))
+        if self.ready_time:  # Otherwise warmed up by handle_ready
+            self.warmup_plugin(plugin)
         return True
 
     def process_message(self, data):
@@ -462,11 +886,34 @@ class LazySusan(object):
         handler = self.commands.get(command)
         if not handler:
             return
+        user_id = get_sender_id(data)
+        if not self.is_admin(user_id):  # Admins are never throttled
+            cost = handler.__dict__.get('command_cost', 1)
+            if not self.throttle.allow(user_id, command, cost):
+                if self.throttle.should_warn(user_id):
+                    self.api.pm('Slow down, please try again in a minute.',
+                                user_id)
+                return
         handler(message, data)
 
-    def reply(self, message, data):
-        """Reply to a command on the same stream (pm/room chat) as invoked."""
-        if data['command'] == 'speak':
+    def reconnect(self, minimum_delay=0):
+        """Schedule an attempt to rejoin the default room.
+
+        The delay is determined by the connection supervisor's backoff.
+
+        """
+        delay = self.connection.next_delay(minimum_delay)
+        print('Rejoining the default room in {0:.1f} seconds.'.format(delay))
+        self.schedule(delay, self._connect, self.config['room_id'], False)
+
+    def reply(self, message, data=None):
+        """Reply to a command on the same stream (pm/room chat) as invoked.
+
+        With no data, e.g., for announcements, the message is said in the room.
+
+        """
+        message = encode_message(message)
+        if data is None or data['command'] == 'speak':
             self.api.speak(message)
         elif data['command'] == 'pmmed':
             self.api.pm(message, data['senderid'])
@@ -500,21 +947,128 @@ class LazySusan(object):
                        (schedule_time, callback, args, kwargs))
 
     def start(self):
-        """Start LazySusan."""
-        self.api.start()
+        """Start LazySusan.
+
+        Whenever the websocket closes it is reopened after a delay determined
+        by the connection supervisor.
+
+        """
+        self.connection.watch(self._close_stale_connection)
+        try:
+            while self.api.ws:
+                opened = time.time()
+                self._close_reason = None
+                self.api.ws.on_error = self._handle_websocket_error
+                self.api.ws.run_forever()
+                if self._close_reason == 'interrupt':
+                    raise KeyboardInterrupt
+                if self.api.lastActivity < opened:  # Never received a frame
+                    self.connection.record_failure()
+                delay = self.connection.next_delay()
+                print('Websocket closed. Reconnecting in {0:.1f} seconds.'
+                      .format(delay))
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            print('Interrupt received.')
+        self.snapshots.save()
 
     def unload_plugin(self, plugin_name):
         """Unload a LazySusan plugin by name."""
         if plugin_name not in self._loaded_plugins:
             return False
-        plugin = self._loaded_plugins[plugin_name]
+        plugin = self._loaded_plugins.pop(plugin_name)
         if isinstance(plugin, CommandPlugin):
             self._unload_command_plugin(plugin)
-        del self._loaded_plugins[plugin_name]
-        del plugin
+        plugin.close()
         print('Unloaded plugin `{0}`.'.format(plugin_name))
+        if isinstance(plugin, Plugin):  # Verify nothing else references it
+            collected = weakref.ref(plugin)
+            del plugin
+            gc.collect()
+            if collected() is not None:
+                print('Plugin `{0}` is still referenced after unloading, '
+                      'e.g., by a pending API callback.'.format(plugin_name))
         return True
 
+    @staticmethod
+    @display_exceptions
+    def warmup_plugin(plugin):
+        """Run a plugin's warmup so that a failure does not affect others."""
+        plugin.warmup()
+
+
+class QueueLogHandler(logging.Handler):
+
+    """A log handler that writes records to its target on a background thread.
+
+    Records are dropped, rather than blocking the websocket thread, when the
+    queue is full.
+
+    """
+
+    def __init__(self, target, max_queued=10000):
+        super(QueueLogHandler, self).__init__()
+        self.dropped = 0
+        self.queue = Queue(max_queued)
+        self.target = target
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        """Write queued records until the None sentinel is received."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord(
+                    {'msg': 'Dropped {0} log records.'.format(dropped)}))
+            self.target.handle(record)
+
+    def close(self):
+        """Flush the remaining records and close the target handler."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        super(QueueLogHandler, self).close()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class SampleFilter(logging.Filter):
+
+    """A log filter that only passes 1 in N frames of certain event types.
+
+    The event type is found with a regular expression rather than by decoding
+    the frame.
+
+    """
+
+    COMMAND_RE = COMMAND_RE
+
+    def __init__(self, rates):
+        super(SampleFilter, self).__init__()
+        self.counts = {}
+        self.rates = rates
+
+    def filter(self, record):
+        if not isinstance(record.msg, STRING_TYPES):
+            return True
+        match = self.COMMAND_RE.search(record.msg)
+        if not match or match.group(1) not in self.rates:
+            return True
+        command = match.group(1)
+        count = self.counts.get(command, 0)
+        self.counts[command] = count + 1
+        return count % self.rates[command] == 0
+
 
 class TruncateFormatter(logging.Formatter):
 
@@ -525,11 +1079,107 @@ class TruncateFormatter(logging.Formatter):
         self.max_len = 240
 
     def format(self, record):
-        if len(record.msg) > self.max_len:
-            record.msg = record.msg[:self.max_len - 3] + '...'
+        message = record.getMessage()
+        if len(message) > self.max_len:
+            # Format a copy so other handlers see the original record
+            record = logging.makeLogRecord(dict(
+                record.__dict__, args=None,
+                msg=message[:self.max_len - 3] + '...'))
         return super(TruncateFormatter, self).format(record)
 
 
+class JsonFormatter(TruncateFormatter):
+
+    """A log formatter that outputs one compact JSON object per line."""
+
+    def format(self, record):
+        message = super(JsonFormatter, self).format(record)
+        return json.dumps({'time': round(record.created, 3),
+                           'message': message}, separators=(',', ':'))
+
+
+def configure_logging(log_file, options, rates):
+    """Log the frames received from turntable to log_file (`-` for stderr)."""
+    logger = logging.getLogger('turntable-api')
+    logger.setLevel(logging.DEBUG)
+
+    if log_file != '-':
+        target = RotatingFileHandler(log_file,
+                                     maxBytes=options.log_max_bytes,
+                                     backupCount=options.log_backups)
+    else:
+        target = logging.StreamHandler()
+
+    if options.log_json:
+        formatter = JsonFormatter()
+    else:
+        formatter = TruncateFormatter('%(asctime)s - %(message)s')
+    target.setFormatter(formatter)
+    handler = QueueLogHandler(target)
+    if rates:
+        handler.addFilter(SampleFilter(rates))
+    logger.addHandler(handler)
+    atexit.register(handler.close)
+
+
+def run_bot(section, options, rates):
+    """Run the bot configured by section until it is interrupted.
+
+    When supervised, each bot logs to its own file named after its section.
+
+    """
+    log_file = options.log_file
+    if log_file and options.supervise and log_file != '-':
+        root, ext = os.path.splitext(log_file)
+        log_file = '{0}-{1}{2}'.format(root, section, ext)
+    if log_file:
+        configure_logging(log_file, options, rates)
+
+    try:
+        bot = LazySusan(config_section=section,
+                        plugin_dir=options.plugin_dir,
+                        enable_logging=bool(log_file),
+                        check_for_updates=not options.no_update_check,
+                        share=options.supervise)
+    except LazySusanException as exc:
+        print(exc)
+        sys.exit(1)
+
+    bot.start()
+
+
+def supervised_sections():
+    """Return the config sections to run with --supervise.
+
+    Raise LazySusanException when two sections would write to the same job
+    directory, snapshot or stats directory.
+
+    """
+    parser = ConfigParser()
+    if not parser.read(LazySusan._config_locations()):
+        raise LazySusanException('No lazysusan.ini found.')
+    sections = parser.sections() or ['DEFAULT']
+    owners = {}
+    for section in sections:
+        config = LazySusan._get_config(section)
+        paths = {'job_dir': config.get('job_dir', JobManager.JOB_DIR),
+                 'snapshot_file': config.get(
+                     'snapshot_file',
+                     SnapshotManager.SNAPSHOT_FILE.format(section))}
+        plugins = ' '.join(config.get('plugins', ()) +
+                           config.get('lazy_plugins', ()))
+        if re.search(r'\bstats\b', plugins):
+            paths['stats_dir'] = config.get('stats_dir', 'lazysusan-stats')
+        for key, path in paths.items():
+            path = os.path.abspath(path)
+            if path in owners:
+                raise LazySusanException(
+                    'Sections `{0}` and `{1}` both use `{2}`. Set `{3}` in '
+                    'each section.'.format(owners[path], section, path, key))
+            owners[path] = section
+    return sections
+
+
 def main():
     """The command-line entry point to LazySusan."""
     parser = OptionParser(version='%prog {0}'.format(__version__))
@@ -540,27 +1190,38 @@ def main():
                       help='Specify the path to a folder containing plugins.')
     parser.add_option('-l', '--log-file',
                       help='Log all messages to the specified file.')
+    parser.add_option('--log-json', action='store_true',
+                      help='Log one JSON object per line.')
+    parser.add_option('--log-max-bytes', type='int', default=0,
+                      help=('Rotate the log file when it reaches this size. '
+                            'Default: never rotate.'))
+    parser.add_option('--log-backups', type='int', default=5,
+                      help=('The number of rotated log files to keep. '
+                            'Default: %default'))
+    parser.add_option('--log-sample', action='append', default=[],
+                      metavar='EVENT:N',
+                      help=('Only log 1 in N frames of the EVENT type. May be '
+                            'specified multiple times.'))
+    parser.add_option('--supervise', action='store_true',
+                      help=('Run a bot for every config section, each in its '
+                            'own process, restarting those that exit.'))
+    parser.add_option('-U', '--no-update-check', action='store_true',
+                      help='Do not check for a newer version of LazySusan.')
     options, _ = parser.parse_args()
 
-    if bool(options.log_file):
-        logger = logging.getLogger('turntable-api')
-        logger.setLevel(logging.DEBUG)
-
-        if options.log_file != '-':
-            handler = logging.FileHandler(options.log_file)
-        else:
-            handler = logging.StreamHandler()
-
-        formatter = TruncateFormatter('%(asctime)s - %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+    rates = {}
+    for item in options.log_sample:
+        event, _, rate = item.rpartition(':')
+        if not event or not rate.isdigit() or int(rate) < 1:
+            parser.error('Invalid --log-sample value `{0}`.'.format(item))
+        rates[event] = int(rate)
 
+    if not options.supervise:
+        run_bot(options.config, options, rates)
+        return
     try:
-        bot = LazySusan(config_section=options.config,
-                        plugin_dir=options.plugin_dir,
-                        enable_logging=bool(options.log_file))
+        sections = supervised_sections()
     except LazySusanException as exc:
-        print(exc.message)
+        print(exc)
         sys.exit(1)
-
-    bot.start()
+    Supervisor(run_bot, sections, (options, rates)).run()
@@ -0,0 +1,113 @@
+"""Connection health tracking and reconnect pacing for LazySusan."""
+
+from __future__ import print_function
+import random
+import threading
+import time
+
+
+class ConnectionSupervisor(object):
+
+    """Track the health of the bot's connection and pace reconnect attempts.
+
+    Failed attempts are retried after an exponentially increasing delay with
+    full jitter. After FAILURE_THRESHOLD consecutive failures the circuit
+    opens and no attempt is made for OPEN_TIME seconds, after which a single
+    trial attempt is allowed (half-open). A success closes the circuit.
+
+    """
+
+    BASE_DELAY = 1
+    CLOSED = 'closed'
+    FAILURE_THRESHOLD = 8
+    HALF_OPEN = 'half-open'
+    MAX_DELAY = 300
+    OPEN = 'open'
+    OPEN_TIME = 600
+    STALE_TIME = 60  # Turntable sends a heartbeat at least every 12 seconds
+
+    def __init__(self, api):
+        self.api = api
+        self.failures = 0
+        self.opened_at = None
+        self.stats = {'attempts': 0, 'failures': 0, 'stale': 0,
+                      'successes': 0}
+        self._watchdog = None
+
+    @property
+    def state(self):
+        """Return the state of the circuit: closed, open or half-open."""
+        if self.opened_at is None:
+            return self.CLOSED
+        elif time.time() < self.opened_at + self.OPEN_TIME:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def seconds_since_frame(self):
+        """Return the number of seconds since a frame was last received."""
+        return time.time() - self.api.lastActivity
+
+    def metrics(self):
+        """Return a dictionary describing the current connection health."""
+        retval = dict(self.stats)
+        retval.update(consecutive_failures=self.failures,
+                      seconds_since_frame=round(self.seconds_since_frame, 1),
+                      state=self.state)
+        return retval
+
+    def next_delay(self, minimum=0):
+        """Return how long to wait before the next connection attempt.
+
+        :param minimum: A lower bound on the delay, e.g., when turntable has
+            indicated how long to wait.
+
+        """
+        self.stats['attempts'] += 1
+        state = self.state
+        if state == self.OPEN:
+            remaining = self.opened_at + self.OPEN_TIME - time.time()
+            return max(minimum, remaining) + random.uniform(0, self.BASE_DELAY)
+        elif state == self.HALF_OPEN:  # Make the single trial attempt soon
+            return max(minimum, random.uniform(0, self.BASE_DELAY))
+        ceiling = min(self.MAX_DELAY, self.BASE_DELAY * 2 ** self.failures)
+        return max(minimum, random.uniform(0, ceiling))
+
+    def record_failure(self):
+        """Record a failed connection attempt, opening the circuit if due."""
+        self.failures += 1
+        self.stats['failures'] += 1
+        if self.failures >= self.FAILURE_THRESHOLD:  # Includes half-open
+            if self.state != self.OPEN:
+                print('Connection circuit opened after {0} failures.'
+                      .format(self.failures))
+            self.opened_at = time.time()
+
+    def record_success(self):
+        """Record a successful connection, closing the circuit."""
+        self.failures = 0
+        self.opened_at = None
+        self.stats['successes'] += 1
+
+    def watch(self, on_stale):
+        """Call on_stale from a background thread when frames stop arriving.
+
+        This is required because scheduled events only run when frames are
+        received.
+
+        """
+        def _run():
+            reported = None
+            while True:
+                time.sleep(self.STALE_TIME / 4.0)
+                last_frame = self.api.lastActivity
+                if self.seconds_since_frame > self.STALE_TIME and \
+                        last_frame != reported:
+                    reported = last_frame  # Only once per silent period
+                    self.stats['stale'] += 1
+                    on_stale()
+
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=_run)
+            self._watchdog.daemon = True
+            self._watchdog.start()
@@ -0,0 +1,747 @@
+"""A local stand-in for turntable.fm for end-to-end and load testing.
+
+FakeTurntable speaks the websocket protocol used by the turntable API client:
+it authenticates connections, answers API requests and broadcasts room events
+such as registered, add_dj, newsong and speak. Rooms, users, songs and
+playlists are set up by calling its methods, or from a JSON script, and events
+are generated the same way. Every frame can be delayed by a fixed latency, and
+a fraction of requests can be answered with an error.
+
+To run an unmodified bot against it, set `chat_server` in lazysusan.ini to the
+server's address, e.g., `chat_server: 127.0.0.1:8080`, and start both:
+
+    python -m lazysusan.fakeserver --port 8080 --room ROOM_ID --rate 1000
+    lazysusan
+
+"""
+
+from __future__ import print_function
+import base64
+import hashlib
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from optparse import OptionParser
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class Connection(object):
+
+    """A client's websocket connection to the fake server.
+
+    Frames are sent from a writer thread so that latency can be added without
+    delaying other connections.
+
+    """
+
+    def __init__(self, server, sock):
+        self.room_id = None
+        self.server = server
+        self.sock = sock
+        self.user_id = None
+        self._buffer = b''
+        self._queue = Queue()
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+
+    def _frame(self, opcode, payload):
+        """Return an unmasked websocket frame (server frames are unmasked)."""
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        return header + payload
+
+    def _handshake(self):
+        """Complete the websocket opening handshake. Return success."""
+        while b'\r\n\r\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                return False
+            self._buffer += data
+        request, self._buffer = self._buffer.split(b'\r\n\r\n', 1)
+        key = None
+        for line in request.decode('latin-1').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'sec-websocket-key':
+                key = value.strip()
+        if not key:
+            return False
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.sock.sendall(('HTTP/1.1 101 Switching Protocols\r\n'
+                           'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                           'Sec-WebSocket-Accept: {0}\r\n\r\n'
+                           .format(accept)).encode('ascii'))
+        return True
+
+    def _read(self, size):
+        """Return exactly size bytes from the socket, or None when closed."""
+        while len(self._buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self._buffer += data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_message(self):
+        """Return the next text message, or None when the connection ends."""
+        message = b''
+        while True:
+            header = self._read(2)
+            if header is None:
+                return None
+            first, second = bytearray(header)
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack('>H', self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', self._read(8))[0]
+            mask = bytearray(self._read(4)) if second & 0x80 else None
+            payload = bytearray(self._read(length))
+            if mask:
+                for index in range(length):
+                    payload[index] ^= mask[index % 4]
+            opcode = first & 0x0f
+            if opcode == 0x8:  # Close
+                return None
+            elif opcode == 0x9:  # Ping
+                self._queue.put((0, self._frame(0xa, bytes(payload))))
+                continue
+            elif opcode == 0xa:  # Pong
+                continue
+            message += bytes(payload)
+            if first & 0x80:  # The final fragment
+                return message.decode('utf-8')
+
+    def _write(self):
+        """Send queued frames once they are due, until the None sentinel."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            delay = item[0] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.sock.sendall(item[1])
+            except (IOError, OSError):
+                break
+
+    def close(self):
+        """Close the connection."""
+        self._queue.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.sock.close()
+
+    def run(self):
+        """Handle the connection's messages until it closes (reader thread)."""
+        try:
+            if not self._handshake():
+                return
+            self._writer.start()
+            self.send_raw('no_session')
+            while True:
+                message = self._read_message()
+                if message is None:
+                    break
+                if '{' in message:
+                    self.server.handle_request(
+                        self, json.loads(message[message.index('{'):]))
+        except (IOError, OSError, ValueError):
+            pass
+        finally:
+            self.server.disconnect(self)
+            self._queue.put(None)
+            self.sock.close()
+
+    def send(self, data):
+        """Send a JSON message to the client."""
+        self.send_raw(json.dumps(data))
+
+    def send_raw(self, message):
+        """Send a message in turntable's `~m~<length>~m~<message>` format."""
+        payload = u'~m~{0}~m~{1}'.format(len(message), message)
+        self._queue.put((time.time() + self.server.latency,
+                         self._frame(0x1, payload.encode('utf-8'))))
+
+
+class FakeTurntable(object):
+
+    """A scriptable, in-process turntable chat server.
+
+    :param port: The port to listen on. With 0, a free port is chosen and can
+        be read from address once started.
+    :param latency: Seconds to delay every frame sent to a client.
+    :param error_rate: The fraction of requests answered with an error.
+        Per-API rates can be set in errors, e.g., errors['playlist.add'].
+
+    """
+
+    HEARTBEAT_INTERVAL = 10
+    ROOMS_PER_PAGE = 20
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 seed=None):
+        self.active = {}  # User id -> the name of their active playlist
+        self.connections = []
+        self.error_rate = error_rate
+        self.errors = {}
+        self.host = host
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.playlists = {}  # User id -> OrderedDict of name -> song ids
+        self.port = port
+        self.random = random.Random(seed)
+        self.rooms = OrderedDict()
+        self.songs = {}
+        self.stats = {'errors': 0, 'events': 0, 'requests': 0}
+        self.users = {}
+        self._running = False
+        self._socket = None
+
+    @property
+    def address(self):
+        """Return the `host:port` clients connect to (chat_server)."""
+        return '{0}:{1}'.format(self.host, self.port)
+
+    def _api_pm_send(self, conn, request):
+        for other in self._connections(user_id=request['receiverid']):
+            other.send({'command': 'pmmed', 'senderid': conn.user_id,
+                        'text': request['text'], 'time': time.time()})
+        return {}
+
+    def _api_playlist_add(self, conn, request):
+        playlist = self._playlist(conn, request)
+        song = request['song_dict']
+        if isinstance(song, list):
+            song = song[0]
+        playlist.insert(request.get('index', 0), song['fileid'])
+        return {}
+
+    def _api_playlist_all(self, conn, request):
+        return {'list': [self.song(x) for x in self._playlist(conn, request)]}
+
+    def _api_playlist_create(self, conn, request):
+        name = request['playlist_name']
+        playlists = self.user_playlists(conn.user_id)
+        if name in playlists:
+            raise FakeError('A playlist with that name already exists.')
+        playlists[name] = []
+        return {'playlist_name': name}
+
+    def _api_playlist_delete(self, conn, request):
+        name = request['playlist_name']
+        if name == 'default':
+            raise FakeError('The default playlist cannot be deleted.')
+        self._playlist(conn, request)
+        del self.user_playlists(conn.user_id)[name]
+        if self.active.get(conn.user_id) == name:
+            del self.active[conn.user_id]
+        return {'playlist_name': name}
+
+    def _api_playlist_list_all(self, conn, _):
+        active = self.active.get(conn.user_id, 'default')
+        return {'list': [{'active': x == active, 'name': x}
+                         for x in self.user_playlists(conn.user_id)]}
+
+    def _api_playlist_remove(self, conn, request):
+        playlist = self._playlist(conn, request)
+        if not 0 <= request.get('index', 0) < len(playlist):
+            raise FakeError('Invalid index.')
+        return {'song_dict': [{'fileid': playlist.pop(request['index'])}]}
+
+    def _api_playlist_reorder(self, conn, request):
+        playlist = self._playlist(conn, request)
+        if not 0 <= request['index_from'] < len(playlist):
+            raise FakeError('Invalid index.')
+        playlist.insert(request['index_to'],
+                        playlist.pop(request['index_from']))
+        return {}
+
+    def _api_playlist_switch(self, conn, request):
+        self._playlist(conn, request)
+        self.active[conn.user_id] = request['playlist_name']
+        return {'playlist_name': request['playlist_name']}
+
+    def _api_room_add_dj(self, conn, _):
+        self.add_dj(self._room(conn)['roomid'], conn.user_id)
+        return {}
+
+    def _api_room_add_moderator(self, conn, request):
+        room = self._room(conn)
+        room['metadata']['moderator_id'].append(request['target_userid'])
+        self.broadcast(room['roomid'], {'command': 'new_moderator',
+                                        'roomid': room['roomid'],
+                                        'userid': request['target_userid']})
+        return {}
+
+    def _api_room_boot_user(self, conn, request):
+        room_id = self._room(conn)['roomid']
+        self.broadcast(room_id, {'command': 'booted_user',
+                                 'modid': conn.user_id,
+                                 'reason': request.get('reason', ''),
+                                 'roomid': room_id,
+                                 'userid': request['target_userid']})
+        self.leave(room_id, request['target_userid'])
+        return {}
+
+    def _api_room_deregister(self, conn, _):
+        if conn.room_id:
+            self.leave(conn.room_id, conn.user_id)
+        return {}
+
+    def _api_room_info(self, conn, request):
+        room = self.rooms.get(request.get('roomid') or conn.room_id)
+        if not room:
+            raise FakeError('Room not found.')
+        return {'room': self.room(room['roomid']),
+                'users': list(room['users'].values())}
+
+    def _api_room_list_rooms(self, conn, request):
+        rooms = sorted(self.rooms, key=lambda x: -len(self.rooms[x]['users']))
+        skip = request.get('skip') or 0
+        return {'rooms': [[self.room(x), []] for x in
+                          rooms[skip:skip + self.ROOMS_PER_PAGE]]}
+
+    def _api_room_register(self, conn, request):
+        if request['roomid'] not in self.rooms:
+            raise FakeError('Room not found.')
+        if conn.room_id:
+            self.leave(conn.room_id, conn.user_id)
+        conn.room_id = request['roomid']
+        self.join(request['roomid'], conn.user_id)
+        return {}
+
+    def _api_room_rem_dj(self, conn, request):
+        self.rem_dj(self._room(conn)['roomid'],
+                    request.get('djid') or conn.user_id)
+        return {}
+
+    def _api_room_rem_moderator(self, conn, request):
+        room = self._room(conn)
+        room['metadata']['moderator_id'].remove(request['target_userid'])
+        self.broadcast(room['roomid'], {'command': 'rem_moderator',
+                                        'roomid': room['roomid'],
+                                        'userid': request['target_userid']})
+        return {}
+
+    def _api_room_speak(self, conn, request):
+        self.speak(self._room(conn)['roomid'], conn.user_id, request['text'])
+        return {}
+
+    def _api_room_stop_song(self, conn, _):
+        room = self._room(conn)
+        if room['metadata']['current_dj'] != conn.user_id:
+            raise FakeError('You are not the current dj.')
+        self.stop_song(room['roomid'])
+        return {}
+
+    def _api_room_vote(self, conn, request):
+        room = self._room(conn)
+        metadata = room['metadata']
+        key = 'upvotes' if request['val'] == 'up' else 'downvotes'
+        metadata[key] += 1
+        self.broadcast(room['roomid'], {
+            'command': 'update_votes',
+            'room': {'metadata': {
+                'downvotes': metadata['downvotes'],
+                'listeners': metadata['listeners'],
+                'upvotes': metadata['upvotes'],
+                'votelog': [[conn.user_id, request['val']]]}}})
+        return {}
+
+    def _api_user_authenticate(self, conn, request):
+        conn.user_id = request['userid']
+        self.add_user(conn.user_id)
+        return {}
+
+    def _api_user_get_fan_of(self, conn, _):
+        return {'fanof': []}
+
+    def _api_user_info(self, conn, _):
+        return dict(self.users[conn.user_id])
+
+    def _connections(self, room_id=None, user_id=None):
+        """Return the connections in a room, or of a user."""
+        return [x for x in self.connections if x.user_id is not None and
+                (room_id is None or x.room_id == room_id) and
+                (user_id is None or x.user_id == user_id)]
+
+    def _playlist(self, conn, request):
+        """Return the song ids of the playlist named by the request."""
+        name = request.get('playlist_name', 'default')
+        playlists = self.user_playlists(conn.user_id)
+        if name not in playlists:
+            raise FakeError('Playlist not found.')
+        return playlists[name]
+
+    def _room(self, conn):
+        """Return the room of a connection."""
+        if conn.room_id not in self.rooms:
+            raise FakeError('Not in a room.')
+        return self.rooms[conn.room_id]
+
+    def _serve(self):
+        """Accept connections until stopped (listener thread)."""
+        while self._running:
+            try:
+                sock, _ = self._socket.accept()
+            except (IOError, OSError):
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(self, sock)
+            with self.lock:
+                self.connections.append(conn)
+            thread = threading.Thread(target=conn.run)
+            thread.daemon = True
+            thread.start()
+
+    def _heartbeat(self):
+        """Periodically send every connection a heartbeat (timer thread)."""
+        count = 0
+        while self._running:
+            time.sleep(self.HEARTBEAT_INTERVAL)
+            count += 1
+            with self.lock:
+                for conn in self.connections:
+                    conn.send_raw('~h~{0}'.format(count))
+
+    def add_dj(self, room_id, user_id):
+        """Have a user in the room step up to the table."""
+        with self.lock:
+            metadata = self.rooms[room_id]['metadata']
+            if user_id in metadata['djs']:
+                raise FakeError('You are already a dj.')
+            if len(metadata['djs']) >= metadata['max_djs']:
+                raise FakeError('The table is full.')
+            metadata['djs'].append(user_id)
+            self.broadcast(room_id, {'command': 'add_dj', 'roomid': room_id,
+                                     'user': [self.users[user_id]]})
+
+    def add_room(self, room_id, name=None, shortcut=None, max_djs=5,
+                 moderator_ids=(), songlog=()):
+        """Add a room. songlog is a list of song ids played in the room."""
+        name = name or room_id
+        with self.lock:
+            self.rooms[room_id] = {
+                'chatserver': [self.host, self.port], 'name': name,
+                'roomid': room_id,
+                'shortcut': shortcut or name.lower().replace(' ', '_'),
+                'users': OrderedDict(),
+                'metadata': {
+                    'current_dj': None, 'current_song': None, 'djs': [],
+                    'downvotes': 0, 'listeners': 0, 'max_djs': max_djs,
+                    'moderator_id': list(moderator_ids),
+                    'songlog': [dict(self.song(x), score=self.random.random())
+                                for x in songlog],
+                    'upvotes': 0}}
+
+    def add_song(self, song_id, song, artist, album=''):
+        """Add a song's metadata."""
+        self.songs[song_id] = {'_id': song_id, 'metadata': {
+            'album': album, 'artist': artist, 'song': song}}
+
+    def add_user(self, user_id, name=None, playlists=None):
+        """Add a user, optionally with playlists (name -> song ids)."""
+        with self.lock:
+            self.users.setdefault(user_id, {'fans': 0, 'name': name or user_id,
+                                            'userid': user_id})
+            if playlists:
+                self.user_playlists(user_id).update(
+                    (x, list(y)) for x, y in playlists.items())
+
+    def broadcast(self, room_id, data):
+        """Send an event to every connection in the room."""
+        with self.lock:
+            self.stats['events'] += 1
+            for conn in self._connections(room_id=room_id):
+                conn.send(data)
+
+    def disconnect(self, conn):
+        """Remove a closed connection, leaving its room."""
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+            if conn.room_id in self.rooms and \
+                    not self._connections(conn.room_id, conn.user_id):
+                self.leave(conn.room_id, conn.user_id)
+
+    def handle_request(self, conn, request):
+        """Answer an API request from a connection."""
+        with self.lock:
+            self.stats['requests'] += 1
+            api = request.get('api', '')
+            handler = getattr(self, '_api_' + api.replace('.', '_'), None)
+            rate = self.errors.get(api, self.error_rate)
+            if api == 'user.authenticate':  # Errors only apply once connected
+                rate = 0
+            try:
+                if rate and self.random.random() < rate:
+                    raise FakeError('Injected error.')
+                response = handler(conn, request) if handler else {}
+                response['success'] = True
+            except FakeError as exc:
+                self.stats['errors'] += 1
+                response = {'err': exc.message, 'success': False}
+            except (IndexError, KeyError, TypeError) as exc:
+                self.stats['errors'] += 1
+                response = {'err': 'Invalid request: {0!r}'.format(exc),
+                            'success': False}
+            response['msgid'] = request.get('msgid')
+            conn.send(response)
+
+    def join(self, room_id, user_id):
+        """Have a user join a room."""
+        with self.lock:
+            self.add_user(user_id)
+            room = self.rooms[room_id]
+            for conn in self._connections(user_id=user_id):
+                if conn.room_id is None:
+                    conn.room_id = room_id
+            if user_id in room['users']:
+                return
+            room['users'][user_id] = self.users[user_id]
+            room['metadata']['listeners'] = len(room['users'])
+            self.broadcast(room_id, {'command': 'registered',
+                                     'roomid': room_id,
+                                     'user': [self.users[user_id]]})
+
+    def leave(self, room_id, user_id):
+        """Have a user leave a room, stepping down first if a dj."""
+        with self.lock:
+            room = self.rooms[room_id]
+            if user_id in room['metadata']['djs']:
+                self.rem_dj(room_id, user_id)
+            if user_id in room['users']:
+                self.broadcast(room_id, {'command': 'deregistered',
+                                         'roomid': room_id,
+                                         'user': [room['users'][user_id]]})
+                del room['users'][user_id]
+                room['metadata']['listeners'] = len(room['users'])
+            for conn in self._connections(room_id, user_id):
+                conn.room_id = None
+
+    def load(self, script):
+        """Set up users, songs and rooms from a (JSON) dictionary.
+
+        {"songs": {id: [title, artist, album]}, "users": {id: {"name": name,
+        "playlists": {name: [song id, ...]}}}, "rooms": {id: {"name": name,
+        "max_djs": 5, "moderator_ids": [...], "songlog": [song id, ...],
+        "users": [user id, ...], "djs": [user id, ...]}}}
+
+        """
+        for song_id, metadata in script.get('songs', {}).items():
+            self.add_song(song_id, *metadata)
+        for user_id, user in script.get('users', {}).items():
+            self.add_user(user_id, user.get('name'), user.get('playlists'))
+        for room_id, room in script.get('rooms', {}).items():
+            self.add_room(room_id, room.get('name'), room.get('shortcut'),
+                          room.get('max_djs', 5),
+                          room.get('moderator_ids', ()),
+                          room.get('songlog', ()))
+            for user_id in room.get('users', ()):
+                self.join(room_id, user_id)
+            for user_id in room.get('djs', ()):
+                self.add_dj(room_id, user_id)
+
+    def play(self, room_id, song_id, dj_id=None):
+        """Start playing a song in the room (newsong)."""
+        with self.lock:
+            room = self.rooms[room_id]
+            metadata = room['metadata']
+            dj_id = dj_id or (metadata['djs'] or [None])[0]
+            song = dict(self.song(song_id), djid=dj_id,
+                        djname=self.users.get(dj_id, {}).get('name'),
+                        starttime=time.time())
+            metadata.update(current_dj=dj_id, current_song=song, downvotes=0,
+                            upvotes=0)
+            self.broadcast(room_id, {'command': 'newsong',
+                                     'room': self.room(room_id),
+                                     'success': True})
+
+    def pm(self, sender_id, receiver_id, text):
+        """Send a private message to a user."""
+        with self.lock:
+            for conn in self._connections(user_id=receiver_id):
+                conn.send({'command': 'pmmed', 'senderid': sender_id,
+                           'text': text, 'time': time.time()})
+
+    def rem_dj(self, room_id, user_id):
+        """Have a dj step down from the table."""
+        with self.lock:
+            metadata = self.rooms[room_id]['metadata']
+            if user_id not in metadata['djs']:
+                raise FakeError('You are not a dj.')
+            metadata['djs'].remove(user_id)
+            self.broadcast(room_id, {'command': 'rem_dj', 'roomid': room_id,
+                                     'user': [self.users[user_id]]})
+            if metadata['current_dj'] == user_id:
+                self.stop_song(room_id)
+
+    def room(self, room_id):
+        """Return a room's description as sent to clients."""
+        with self.lock:
+            room = self.rooms[room_id]
+            return dict((x, y) for x, y in room.items() if x != 'users')
+
+    def song(self, song_id):
+        """Return a song's metadata, made up if the song was not added."""
+        return self.songs.get(song_id) or {'_id': song_id, 'metadata': {
+            'album': '', 'artist': 'Artist', 'song': song_id}}
+
+    def speak(self, room_id, user_id, text):
+        """Have a user say something in the room."""
+        with self.lock:
+            self.add_user(user_id)
+            self.broadcast(room_id, {'command': 'speak', 'roomid': room_id,
+                                     'name': self.users[user_id]['name'],
+                                     'text': text, 'userid': user_id})
+
+    def start(self):
+        """Start listening in background threads. Return the address."""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        for room in self.rooms.values():
+            room['chatserver'] = [self.host, self.port]
+        self._running = True
+        for target in (self._serve, self._heartbeat):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self.address
+
+    def stop(self):
+        """Stop listening and close every connection."""
+        self._running = False
+        self._socket.close()
+        with self.lock:
+            for conn in list(self.connections):
+                conn.close()
+
+    def stop_song(self, room_id):
+        """Stop the current song (nosong)."""
+        with self.lock:
+            self.rooms[room_id]['metadata'].update(current_dj=None,
+                                                   current_song=None)
+            self.broadcast(room_id, {'command': 'nosong',
+                                     'room': self.room(room_id)})
+
+    def user_playlists(self, user_id):
+        """Return a user's playlists, creating the default playlist."""
+        with self.lock:
+            return self.playlists.setdefault(
+                user_id, OrderedDict([('default', [])]))
+
+
+class FakeError(Exception):
+
+    """An error response to an API request."""
+
+    def __init__(self, message):
+        super(FakeError, self).__init__(message)
+        self.message = message
+
+
+def generate_load(server, room_id, rate, users=100):
+    """Generate membership and chat events in the room at rate per second.
+
+    Runs until interrupted. Synthetic users join and leave the room, step up
+    to and down from the table, and talk.
+
+    """
+    names = ['load{0:05d}'.format(x) for x in range(users)]
+    present = set()
+    interval = 1.0 / rate
+    next_time = time.time()
+    count = 0
+    while True:
+        user_id = server.random.choice(names)
+        with server.lock:
+            djs = server.rooms[room_id]['metadata']['djs']
+            if user_id not in present:
+                server.join(room_id, user_id)
+                present.add(user_id)
+            elif user_id in djs:
+                server.rem_dj(room_id, user_id)
+            elif count % 3 and len(djs) < server.rooms[room_id]['metadata'][
+                    'max_djs']:
+                server.add_dj(room_id, user_id)
+            elif count % 2:
+                server.speak(room_id, user_id, 'Message {0}'.format(count))
+            else:
+                server.leave(room_id, user_id)
+                present.discard(user_id)
+        count += 1
+        next_time += interval
+        delay = next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def main():
+    """Run a fake turntable server from the command line."""
+    parser = OptionParser()
+    parser.add_option('--host', default='127.0.0.1',
+                      help='The address to listen on. Default: %default')
+    parser.add_option('--port', type='int', default=8080,
+                      help='The port to listen on. Default: %default')
+    parser.add_option('--room', action='append', default=[], metavar='ID',
+                      help='Add an empty room. May be specified multiple '
+                      'times.')
+    parser.add_option('--script', metavar='FILE',
+                      help='Set up rooms, users and songs from a JSON file.')
+    parser.add_option('--latency', type='float', default=0,
+                      help='Seconds to delay every frame. Default: %default')
+    parser.add_option('--error-rate', type='float', default=0,
+                      help=('The fraction of requests that fail. Default: '
+                            '%default'))
+    parser.add_option('--rate', type='float', default=0,
+                      help=('Generate this many events per second in the '
+                            'first room. Default: %default'))
+    options, _ = parser.parse_args()
+
+    server = FakeTurntable(options.host, options.port, options.latency,
+                           options.error_rate)
+    if options.script:
+        with open(options.script) as fp:
+            server.load(json.load(fp))
+    for room_id in options.room:
+        server.add_room(room_id)
+    if not server.rooms:
+        parser.error('At least one room is required.')
+    print('Listening on {0}'.format(server.start()))
+    try:
+        if options.rate:
+            generate_load(server, next(iter(server.rooms)), options.rate)
+        else:
+            while True:
+                time.sleep(60)
+    except KeyboardInterrupt:
+        print('Interrupt received.')
+    server.stop()
+    print('Handled {requests} requests ({errors} errors) and broadcast '
+          '{events} events.'.format(**server.stats))
+
+
+if __name__ == '__main__':
+    main()
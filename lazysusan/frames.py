@@ -0,0 +1,103 @@
+"""Fast-path handling of the frames received from turntable."""
+
+import json
+import logging
+import re
+import time
+import types
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:  # Fall back to the standard library
+        fast_json = None
+
+# Finds a frame's event type without decoding it
+COMMAND_RE = re.compile(r'"command":\s*"([^"]+)"')
+
+
+class FastJson(object):
+
+    """Stands in for the json module within the API client's on_message.
+
+    Frames are decoded with orjson or ujson, and requests are still encoded
+    by the standard library.
+
+    """
+
+    dumps = staticmethod(json.dumps)
+    loads = staticmethod(fast_json.loads if fast_json else json.loads)
+
+    @staticmethod
+    def install(method):
+        """Return a copy of the bound method that uses FastJson for json.
+
+        The copy's globals are a snapshot of its module's with json replaced,
+        so that neither the module nor other API clients are affected.
+
+        """
+        function = getattr(method, '__func__', None)
+        if not function or function.__globals__.get('json') is not json:
+            return method
+        copy = types.FunctionType(
+            function.__code__, dict(function.__globals__, json=FastJson),
+            function.__name__, function.__defaults__, function.__closure__)
+        return types.MethodType(copy, method.__self__)
+
+
+class FrameFilter(object):
+
+    """Drop the frames of events that nothing subscribes to before decoding.
+
+    A frame is only decoded by the API client when it is a response to a
+    request, when the client itself tracks its event (STATEFUL), or when
+    the event or pre_message has a subscriber. pre_message subscribers in
+    decoded_only, which only need frames decoded for those other reasons,
+    do not count. For dropped frames the time of the last activity is still
+    updated and post_message is emitted, with None in place of the decoded
+    frame, so that scheduled events run.
+
+    """
+
+    STATEFUL = ('newsong', 'nosong', 'update_votes')
+
+    def __init__(self, api):
+        self.api = api
+        self.decoded_only = set()
+        self.logger = logging.getLogger('turntable-api')
+        self.stats = {'decoded': 0, 'dropped': 0}
+
+    def wanted(self, message):
+        """Return whether or not the frame needs to be decoded."""
+        if '"msgid"' in message:
+            return True
+        for callback in self.api.signals.get('pre_message', ()):
+            if callback not in self.decoded_only:
+                return True
+        match = COMMAND_RE.search(message)
+        if not match:  # E.g., a heartbeat
+            return True
+        command = match.group(1)
+        return command in self.STATEFUL or bool(self.api.signals.get(command))
+
+    def wrap(self, on_message):
+        """Return a wrapper of the API client's on_message that filters.
+
+        When orjson or ujson is installed, the frames that pass are decoded
+        with it.
+
+        """
+        if fast_json:
+            on_message = FastJson.install(on_message)
+
+        def _closure(websocket, message):
+            if self.wanted(message):
+                self.stats['decoded'] += 1
+                return on_message(websocket, message)
+            self.stats['dropped'] += 1
+            self.api.lastActivity = time.time()
+            if self.api.debug:
+                self.logger.debug(message)
+            self.api.emit('post_message', (message, None))
+        return _closure
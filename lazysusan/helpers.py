@@ -1,8 +1,13 @@
 """A collection of useful functions for LazySusan."""
 
+import sys
 import traceback
 from functools import wraps
 from lazysusan.plugins import CommandPlugin
+try:
+    from importlib import reload
+except ImportError:  # Python 2 has the builtin reload
+    pass
 
 
 def admin_required(function):
@@ -25,7 +30,7 @@ def admin_required(function):
             message = 'You must be an admin to execute that command.'
             return bot.api.pm(message, user_id)
         return function(cls, *args, **kwargs)
-    wrapper.func_dict['admin_required'] = True
+    wrapper.__dict__['admin_required'] = True
     return wrapper
 
 
@@ -50,17 +55,31 @@ def admin_or_moderator_required(function):
                        'that command.')
             return bot.api.pm(message, user_id)
         return function(cls, *args, **kwargs)
-    wrapper.func_dict['admin_or_moderator_required'] = True
+    wrapper.__dict__['admin_or_moderator_required'] = True
     return wrapper
 
 
+def command_cost(cost):
+    """A command decorator generator that sets the command's throttle cost.
+
+    Commands cost 1 by default. Commands that send many messages or make
+    expensive API requests should cost more.
+
+    """
+    def generator(function):
+        """Record the cost on the function."""
+        function.__dict__['command_cost'] = cost
+        return function
+    return generator
+
+
 def display_exceptions(function):
     """Expand the arguments to the functions."""
     @wraps(function)
     def wrapper(*args, **kwargs):  # pylint: disable-msg=C0111
         try:
             return function(*args, **kwargs)
-        except:  # Handle all exceptions -- pylint: disable-msg=W0702
+        except Exception:  # Interrupts still stop the bot
             traceback.print_exc()
     return wrapper
 
@@ -74,11 +93,23 @@ def dynamic_permissions(admin=False, mod=False):
             return dyn(*args, **kwargs)
 
         dyn = DynamicPermissions(function, mod=mod, admin=admin)
-        wrapper.func_dict['dynamic_permissions'] = True
+        wrapper.__dict__['dynamic_permissions'] = True
         return wrapper
     return generator
 
 
+def encode_message(message):
+    """Return message as the API client sends it without error.
+
+    The Python 2 API client calls str() on every message, so unicode
+    messages are encoded as UTF-8 there.
+
+    """
+    if str is bytes and not isinstance(message, str):
+        return message.encode('utf-8')
+    return message
+
+
 def get_sender_id(data):
     """Return the userid of the user from the message data."""
     if data['command'] == 'speak':
@@ -90,6 +121,41 @@ def get_sender_id(data):
                         .format(data['command']))
 
 
+def import_plugin(plugin_name, attempt_reload=False):
+    """Import and return a plugin class by name, or None if not found.
+
+    Plugins are first looked for on sys.path (e.g., the plugin directory) and
+    then in the lazysusan.plugins package.
+
+    """
+    parts = plugin_name.split('.')
+    if len(parts) > 1:
+        module_name = '.'.join(parts[:-1])
+        class_name = parts[-1]
+    else:
+        # Use the titlecase format of the module name as the class name
+        module_name = parts[0]
+        class_name = parts[0].title()
+
+    module = None
+    for package in (None, 'lazysusan.plugins'):
+        if package:
+            module_name = '{0}.{1}'.format(package, module_name)
+
+        if attempt_reload and module_name in sys.modules:
+            module = reload(sys.modules[module_name])
+        else:
+            try:
+                module = __import__(module_name, fromlist=[class_name])
+            except ImportError:
+                pass
+        if module:
+            break
+    if not module:
+        return None
+    return getattr(module, class_name, None)
+
+
 def moderator_required(function):
     """A command decorator that requires a moderator to run.
 
@@ -113,7 +179,7 @@ def moderator_required(function):
             message = 'You must be a moderator to execute that command.'
             return bot.api.pm(message, user_id)
         return function(cls, *args, **kwargs)
-    wrapper.func_dict['moderator_required'] = True
+    wrapper.__dict__['moderator_required'] = True
     return wrapper
 
 
@@ -0,0 +1,104 @@
+"""A bounded, searchable history of recent chat messages."""
+
+import re
+import time
+from collections import deque
+
+
+class ChatHistory(object):
+
+    """A fixed capacity ring buffer of messages with an inverted index.
+
+    Messages are numbered sequentially and stored in slot `number % capacity`.
+    The index maps each token and user id to a deque of message numbers in
+    increasing order, so evicting the oldest message only requires popping
+    from the left of the deques of its own tokens. Keys whose deques become
+    empty are removed so that memory stays bounded by the capacity.
+
+    """
+
+    TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, capacity=5000):
+        self.capacity = capacity
+        self.names = {}  # Lowercase name -> user id
+        self._entries = [None] * capacity
+        self._next = 0
+        self._tokens = {}
+        self._users = {}
+
+    def __len__(self):
+        return min(self._next, self.capacity)
+
+    @staticmethod
+    def _discard(index, key, number):
+        """Remove number from the front of the key's deque in index."""
+        numbers = index.get(key)
+        if numbers and numbers[0] == number:
+            numbers.popleft()
+            if not numbers:
+                del index[key]
+                return True
+        return False
+
+    def _evict(self, number):
+        """Remove the message with number from the index."""
+        entry = self._entries[number % self.capacity]
+        for token in set(self.tokenize(entry[3])):
+            self._discard(self._tokens, token, number)
+        if self._discard(self._users, entry[1], number) and entry[2]:
+            name = entry[2].lower()
+            if self.names.get(name) == entry[1]:
+                del self.names[name]
+
+    def _matching(self, numbers, include_private):
+        """Generate the entries for numbers, most recent first."""
+        for number in reversed(numbers):
+            entry = self._entries[number % self.capacity]
+            if include_private or not entry[4]:
+                yield entry
+
+    def add(self, user_id, name, text, private=False):
+        """Add a message to the history, evicting the oldest when full."""
+        number = self._next
+        if number >= self.capacity:
+            self._evict(number - self.capacity)
+        self._entries[number % self.capacity] = (time.time(), user_id, name,
+                                                 text, private)
+        for token in set(self.tokenize(text)):
+            self._tokens.setdefault(token, deque()).append(number)
+        self._users.setdefault(user_id, deque()).append(number)
+        if name:
+            self.names[name.lower()] = user_id
+        self._next += 1
+
+    def last_message(self, name, include_private=False):
+        """Return the most recent entry from the named user, or None."""
+        user_id = self.names.get(name.lower())
+        if user_id not in self._users:
+            return None
+        return next(self._matching(self._users[user_id], include_private),
+                    None)
+
+    def name(self, user_id):
+        """Return the name of the user's most recent message, or None."""
+        numbers = self._users.get(user_id)
+        if not numbers:
+            return None
+        return self._entries[numbers[-1] % self.capacity][2]
+
+    def search(self, word, limit=3, include_private=False):
+        """Return up to limit entries containing word, most recent first."""
+        tokens = self.tokenize(word)
+        if len(tokens) != 1 or tokens[0] not in self._tokens:
+            return []
+        retval = []
+        for entry in self._matching(self._tokens[tokens[0]], include_private):
+            retval.append(entry)
+            if len(retval) >= limit:
+                break
+        return retval
+
+    def tokenize(self, text):
+        """Return the list of lowercase tokens in text."""
+        return self.TOKEN_RE.findall(text.lower())
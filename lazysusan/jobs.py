@@ -0,0 +1,238 @@
+"""Resumable background jobs made of chains of turntable API requests."""
+
+from __future__ import print_function
+import json
+import os
+import traceback
+from collections import OrderedDict
+from lazysusan.storage import _replace
+
+
+class Job(object):
+
+    """A long running operation modeled as a state machine.
+
+    A job issues one request at a time from step and updates its state from
+    the response in handle. The state must be JSON serializable as it is
+    checkpointed after every response. Large inputs that do not change, such
+    as a list of song ids, belong in items, which is saved once.
+
+    Subclasses set KIND, a unique name used to restore saved jobs.
+
+    """
+
+    KIND = None
+
+    def __init__(self, plugin, data, state=None, items=None):
+        self.bot = plugin.bot
+        self.data = data  # The command message, used for replies
+        self.generation = 0
+        self.items = items or []
+        self.job_id = None
+        self.plugin = plugin
+        self.state = state or {}
+
+    def describe(self):
+        """Return a short description of the job and its progress."""
+        return self.KIND
+
+    def handle(self, data):
+        """Update the state from the response to the last request.
+
+        Return False when the job is complete (or has failed). By default the
+        job is complete.
+
+        """
+        return False
+
+    def reply(self, message):
+        """Reply to the command that started the job."""
+        self.bot.reply(message, self.data)
+
+    def resume(self):
+        """Prepare the state to continue after a reconnect or a restart.
+
+        The response to the last request may have been lost, so the next step
+        should not assume it was (or was not) applied.
+
+        """
+        pass
+
+    def step(self, callback):
+        """Issue the next request with callback.
+
+        Return False, without issuing a request, when the job is complete. By
+        default no request is issued.
+
+        """
+        return False
+
+
+class JobManager(object):
+
+    """Run jobs and checkpoint their progress to disk.
+
+    Jobs are saved in the directory set by job_dir. Running jobs are resumed
+    after a reconnect (resume), and saved jobs are resumed after a restart or
+    reload once the plugin that owns their kind registers it.
+
+    """
+
+    JOB_DIR = 'lazysusan-jobs'
+
+    def __init__(self, bot):
+        self.active = False
+        self.bot = bot
+        self.jobs = OrderedDict()
+        self.kinds = {}
+        self._next_id = None
+
+    @property
+    def directory(self):
+        """Return the directory jobs are saved in."""
+        return self.bot.config.get('job_dir', self.JOB_DIR)
+
+    def _finish(self, job):
+        """Remove a completed or cancelled job and its files."""
+        if self.jobs.get(job.job_id) is job:
+            del self.jobs[job.job_id]
+        for path in self._paths(job.job_id):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _load(self, kind):
+        """Return the saved jobs of kind that are not already running."""
+        if not os.path.isdir(self.directory):
+            return []
+        retval = []
+        for job_id in self._saved_ids():
+            if job_id in self.jobs:
+                continue
+            path, items_path = self._paths(job_id)
+            try:
+                with open(path) as fp:
+                    saved = json.load(fp)
+                if saved['kind'] != kind:
+                    continue
+                with open(items_path) as fp:
+                    items = json.load(fp)
+            except (IOError, OSError, ValueError) as exc:
+                print('Cannot load job {0}: {1}'.format(job_id, exc))
+                continue
+            job_class, owner = self.kinds[kind]
+            job = job_class(owner, saved['data'], saved['state'], items)
+            job.job_id = job_id
+            job.resume()
+            self.jobs[job_id] = job
+            retval.append(job)
+        return retval
+
+    def _paths(self, job_id):
+        """Return the paths of the state and items files of a job."""
+        path = os.path.join(self.directory, 'job-{0}.json'.format(job_id))
+        return path, path[:-len('.json')] + '.items.json'
+
+    def _run(self, job):
+        """Issue the job's next request, finishing the job when it is done."""
+        def callback(data):
+            if self.jobs.get(job.job_id) is not job or \
+                    job.generation != generation:
+                return  # Cancelled, or superseded by resume
+            if not self._safely(job, job.handle, data):
+                self._finish(job)
+                return
+            self._save(job)
+            self._run(job)
+
+        job.generation += 1
+        generation = job.generation
+        if not self._safely(job, job.step, callback):
+            self._finish(job)
+
+    def _save(self, job, items=False):
+        """Checkpoint the job's state, and optionally its items."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path, items_path = self._paths(job.job_id)
+        if items:
+            with open(items_path + '.tmp', 'w') as fp:
+                json.dump(job.items, fp)
+            _replace(items_path + '.tmp', items_path)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump({'data': job.data, 'kind': job.KIND,
+                       'state': job.state}, fp)
+        _replace(path + '.tmp', path)
+
+    def _saved_ids(self):
+        """Return the sorted ids of the jobs saved in the directory."""
+        retval = []
+        for filename in os.listdir(self.directory):
+            parts = filename.split('.')
+            if len(parts) == 2 and parts[1] == 'json' and \
+                    parts[0].startswith('job-') and parts[0][4:].isdigit():
+                retval.append(int(parts[0][4:]))
+        return sorted(retval)
+
+    @staticmethod
+    def _safely(job, function, *args):
+        """Call a job method, reporting an exception as the job failing."""
+        try:
+            return function(*args)
+        except Exception:  # pylint: disable-msg=W0703
+            traceback.print_exc()
+            job.reply('Job {0} failed.'.format(job.job_id))
+            return False
+
+    def cancel(self, job_id):
+        """Cancel a job by id. Return whether or not the job existed."""
+        job = self.jobs.get(job_id)
+        if not job:
+            return False
+        self._finish(job)
+        return True
+
+    def register(self, job_class, owner):
+        """Register a kind of job and resume its saved jobs.
+
+        :param job_class: The Job subclass, constructed with owner as its
+            plugin when a saved job is restored.
+
+        """
+        self.kinds[job_class.KIND] = (job_class, owner)
+        for job in self._load(job_class.KIND):
+            print('Resuming job {0}: {1}'.format(job.job_id, job.describe()))
+            if self.active:
+                self._run(job)
+
+    def release(self, owner):
+        """Stop running the jobs of owner, e.g., when it is unloaded.
+
+        Their checkpoints are kept so that they resume when owner is loaded
+        again.
+
+        """
+        for job_id, job in list(self.jobs.items()):
+            if job.plugin is owner:
+                del self.jobs[job_id]
+        for kind, (_, kind_owner) in list(self.kinds.items()):
+            if kind_owner is owner:
+                del self.kinds[kind]
+
+    def resume(self):
+        """(Re)issue the current request of every job, e.g., on reconnect."""
+        self.active = True
+        for job in list(self.jobs.values()):
+            job.resume()
+            self._run(job)
+
+    def start(self, job):
+        """Assign the job an id, save it and issue its first request."""
+        if self._next_id is None:
+            saved = os.path.isdir(self.directory) and self._saved_ids()
+            self._next_id = (saved[-1] if saved else 0) + 1
+        job.job_id = self._next_id
+        self._next_id += 1
+        self.jobs[job.job_id] = job
+        self._save(job, items=True)
+        self._run(job)
+        return job.job_id
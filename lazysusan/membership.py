@@ -0,0 +1,91 @@
+"""Coalescing of bursts of room membership events."""
+
+import time
+from collections import OrderedDict
+
+
+class MembershipCoalescer(object):
+
+    """Stage room membership events and dispatch their net changes in batches.
+
+    The API client's emit is replaced so that registered, deregistered,
+    add_dj and rem_dj events are staged rather than dispatched. Staged events
+    are flushed before any other event is dispatched, DELAY seconds after the
+    first was staged (through the bot's scheduler), or once HIGH_WATER users
+    are staged. The responses to API requests, which ttapi emits with the
+    command None, do not flush them. For each user only the last event of
+    each kind is kept, and only those that change the bot's view of the room
+    are dispatched. The users of each command are dispatched together as a
+    single frame whose `user` list holds all of them, so handlers that loop
+    over `data['user']` need no changes.
+
+    """
+
+    # Leaving events are dispatched before joining events
+    COMMANDS = ('rem_dj', 'deregistered', 'registered', 'add_dj')
+    DELAY = 1.0
+    HIGH_WATER = 200
+    JOINING = ('add_dj', 'registered')
+    KINDS = {'add_dj': 'dj', 'deregistered': 'listener',
+             'registered': 'listener', 'rem_dj': 'dj'}
+    PASSTHROUGH = (None, 'post_message', 'pre_message')
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.dispatch = bot.api.emit
+        self.frames = {}  # The last staged frame of each command
+        self.staged = OrderedDict()  # (kind, user id) -> (command, user)
+        self.stats = {'batches': 0, 'dispatched': 0, 'staged': 0}
+        self._scheduled = False
+        self._staged_time = None
+        bot.api.emit = self.emit
+
+    def _flush_due(self):
+        """Flush the staged events once they have waited DELAY (scheduled)."""
+        self._scheduled = False
+        if not self.staged:
+            return
+        remaining = self._staged_time + self.DELAY - time.time()
+        if remaining > 0:  # Flushed since, and these were staged later
+            self._scheduled = True
+            self.bot.schedule(remaining, self._flush_due)
+        else:
+            self.flush()
+
+    def emit(self, signal, data=None):
+        """Stage a membership event, or flush and dispatch any other event."""
+        if signal not in self.KINDS:
+            if signal not in self.PASSTHROUGH:
+                self.flush()
+            return self.dispatch(signal, data)
+        if not self.staged:
+            self._staged_time = time.time()
+        for user in data['user']:
+            key = (self.KINDS[signal], user['userid'])
+            self.staged.pop(key, None)  # Keep the staged order by last event
+            self.staged[key] = (signal, user)
+        self.frames[signal] = data
+        self.stats['staged'] += 1
+        if len(self.staged) >= self.HIGH_WATER:
+            self.flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            self.bot.schedule(self.DELAY, self._flush_due)
+
+    def flush(self):
+        """Dispatch the net changes of the staged membership events."""
+        if not self.staged:
+            return
+        current = {'dj': self.bot.dj_ids, 'listener': self.bot.listener_ids}
+        users = dict((x, []) for x in self.COMMANDS)
+        for (kind, user_id), (command, user) in self.staged.items():
+            if (user_id in current[kind]) != (command in self.JOINING):
+                users[command].append(user)
+        frames, self.frames = self.frames, {}
+        self.staged = OrderedDict()
+        self.stats['batches'] += 1
+        for command in self.COMMANDS:
+            if users[command]:
+                self.stats['dispatched'] += 1
+                self.dispatch(command, dict(frames[command],
+                                            user=users[command]))
@@ -1,23 +1,64 @@
 """The plugins namespace is used to contain the various LazySusan plugins."""
 
+import weakref
+
 
 class Plugin(object):
 
     """The base LazySusan plugin that is meant to be extended.
 
     This class provides the methods register, and unregister, that are
-    necessary for (un)registering callback to certain API events.
+    necessary for (un)registering callback to certain API events. Callbacks
+    are registered through a WeakCallback so that the API client does not
+    keep the plugin alive, and close removes them when the plugin is
+    unloaded.
+
+    Plugins that need to fetch data from turntable should do so in warmup
+    rather than in __init__ so that the bot can join its room first.
+
+    Plugins can preserve their state across a reload by implementing
+    export_state and import_state. STATE_VERSION should be incremented
+    whenever the format of the exported state changes.
 
     """
 
+    STATE_VERSION = 1
+
     def __init__(self, bot):
         self.bot = bot
         self._registered = {}
         self._reg_num = 0
 
-    def __del__(self):
-        for register_number in self._registered:
+    def close(self):
+        """Unregister the plugin's callbacks and cancel its scheduled events.
+
+        Called when the plugin is unloaded. Plugins that hold other resources
+        should extend this method.
+
+        """
+        for register_number in list(self._registered):
             self.unregister(register_number)
+        self.bot.cancel_scheduled(self)
+
+    def export_state(self):
+        """Return the plugin's state to be passed to import_state on reload.
+
+        The state should only contain basic types (dict, list, str, int, etc.)
+        and must not reference the plugin itself.
+
+        """
+        return None
+
+    def import_state(self, state, version):
+        """Restore state from the previous instance of the plugin.
+
+        :param state: The value previously returned by export_state.
+        :param version: The STATE_VERSION of the plugin that exported state.
+
+        Return True if the state was restored.
+
+        """
+        return False
 
     def register(self, event, callback):
         """Register a callback to a certain API event.
@@ -27,6 +68,7 @@ class Plugin(object):
 
         """
 
+        callback = WeakCallback(callback)
         self.bot.api.on(event, callback)
         reg_num = self._reg_num
         self._registered[reg_num] = (event, callback)
@@ -46,6 +88,15 @@ class Plugin(object):
         del self._registered[register_number]
         return True
 
+    def warmup(self):
+        """Issue any API requests the plugin needs to initialize itself.
+
+        Called once the bot is ready, or immediately after loading when the
+        bot is already ready.
+
+        """
+        pass
+
 
 class CommandPlugin(Plugin):
 
@@ -72,3 +123,28 @@ class PluginException(Exception):
     def __init__(self, message):
         super(PluginException, self).__init__()
         self.message = message
+
+
+class WeakCallback(object):
+
+    """Call a bound method without keeping its instance alive.
+
+    Once the instance has been collected calling the WeakCallback does
+    nothing. Other callables are referenced normally.
+
+    """
+
+    def __init__(self, callback):
+        self.function = getattr(callback, '__func__', None)
+        if self.function is None:
+            self.function = callback
+            self.instance = None
+        else:
+            self.instance = weakref.ref(callback.__self__)
+
+    def __call__(self, *args, **kwargs):
+        if self.instance is None:
+            return self.function(*args, **kwargs)
+        instance = self.instance()
+        if instance is not None:
+            return self.function(instance, *args, **kwargs)
@@ -1,9 +1,17 @@
 """A set of LazySusan plugins that control the bot as a dj."""
 
+import bisect
+import json
+import os
 import random
-from lazysusan.helpers import (display_exceptions, admin_or_moderator_required,
-                               no_arg_command, single_arg_command)
+import time
+from collections import deque
+from lazysusan.helpers import (admin_or_moderator_required, command_cost,
+                               display_exceptions, no_arg_command,
+                               single_arg_command)
+from lazysusan.jobs import Job
 from lazysusan.plugins import CommandPlugin
+from lazysusan.storage import PlaylistStore
 
 
 def best_match(selection, options):
@@ -23,14 +31,150 @@ def best_match(selection, options):
         return possibles
 
 
+def playlist_diff(current, target):
+    """Return the operations that turn the current playlist into target.
+
+    Operations are ('remove', index, song_id), ('add', song_id, index) and
+    ('move', from_index, to_index), with indexes that are valid when the
+    operations are applied in order. Songs that are already in the right
+    relative order (a longest increasing subsequence of their target
+    positions) are never moved, so unchanged songs cost nothing. Songs in
+    target must be unique; repeats of a song in current are removed.
+
+    This takes O(n log n) time as the index of every song is counted with a
+    Fenwick tree rather than found in a list.
+
+    """
+    position = dict((song_id, index) for index, song_id in enumerate(target))
+    kept = set()
+    keep = []
+    for song_id in current:
+        keep.append(song_id in position and song_id not in kept)
+        kept.add(song_id)
+    operations = [('remove', index, current[index]) for index
+                  in range(len(current) - 1, -1, -1) if not keep[index]]
+    current = [x for x, y in zip(current, keep) if y]
+
+    # Patience sorting to find the longest increasing subsequence
+    tails = []  # Index into current of the smallest tail of each length
+    tail_positions = []
+    previous = [None] * len(current)
+    for index, song_id in enumerate(current):
+        length = bisect.bisect_left(tail_positions, position[song_id])
+        previous[index] = tails[length - 1] if length else None
+        if length == len(tails):
+            tails.append(index)
+            tail_positions.append(position[song_id])
+        else:
+            tails[length] = index
+            tail_positions[length] = position[song_id]
+    stable = set()
+    index = tails[-1] if tails else None
+    while index is not None:
+        stable.add(current[index])
+        index = previous[index]
+
+    # Every other song is placed immediately after its predecessor in target,
+    # so it joins the run of songs that follows the closest preceding stable
+    # song (or the front), ahead of the songs that are not yet placed. The
+    # songs can thus be given keys, ordered as they appear in the playlist,
+    # before any is placed: (index, 0, 0) for a song at its index in current
+    # and (index of the run's stable song, 1, place in the run) once placed.
+    original = dict((song_id, index) for index, song_id in enumerate(current))
+    placed = {}
+    head, count = -1, 0
+    for song_id in target:
+        if song_id in stable:
+            head, count = original[song_id], 0
+        else:
+            count += 1
+            placed[song_id] = (head, 1, count)
+    keys = sorted([(x, 0, 0) for x in range(len(current))] +
+                  [placed[x] for x in target if x not in stable])
+    ranks = dict((key, rank + 1) for rank, key in enumerate(keys))
+    tree = [0] * (len(keys) + 1)  # Fenwick tree of the songs in the playlist
+
+    def add(rank, delta):
+        """Add delta to the number of songs with the key of rank."""
+        while rank < len(tree):
+            tree[rank] += delta
+            rank += rank & -rank
+
+    def index_of(rank):
+        """Return the number of songs whose keys precede that of rank."""
+        retval = 0
+        rank -= 1
+        while rank > 0:
+            retval += tree[rank]
+            rank -= rank & -rank
+        return retval
+
+    for index in range(len(current)):
+        add(ranks[(index, 0, 0)], 1)
+    for song_id in target:
+        if song_id in stable:
+            continue
+        if song_id in original:
+            rank = ranks[(original[song_id], 0, 0)]
+            source = index_of(rank)
+            add(rank, -1)
+        rank = ranks[placed[song_id]]
+        destination = index_of(rank)
+        add(rank, 1)
+        if song_id in original:
+            operations.append(('move', source, destination))
+        else:
+            operations.append(('add', song_id, destination))
+    return operations
+
+
+def skip_add(operations, number):
+    """Return the operations after the add operations[number] adjusted for
+    that add not having been made.
+
+    Each index is shifted past the position the song would have had, which
+    is tracked as the operations are applied.
+
+    """
+    index = operations[number][2]
+    retval = []
+    for operation in operations[number + 1:]:
+        if operation[0] == 'remove':
+            retval.append(('remove', operation[1] - (operation[1] > index),
+                           operation[2]))
+            index -= operation[1] < index
+        elif operation[0] == 'add':
+            retval.append(('add', operation[1],
+                           operation[2] - (operation[2] > index)))
+            index += operation[2] <= index
+        else:
+            source = operation[1] - (operation[1] > index)
+            index -= operation[1] < index
+            retval.append(('move', source,
+                           operation[2] - (operation[2] > index)))
+            index += operation[2] <= index
+    return retval
+
+
 class Dj(CommandPlugin):
 
-    """A plugin that controls whether or not the bot is dj-ing."""
+    """A plugin that controls whether or not the bot is dj-ing.
+
+    Changes to the room are coalesced over DECISION_WINDOW seconds before the
+    bot decides whether to step up or down, and at most one such seat action
+    is taken per window. Reversing the previous seat action additionally
+    requires MIN_SEAT_TIME seconds to have passed, unless the table is full.
+
+    """
 
     COMMANDS = {'/autoskip': 'auto_skip',
                 '/djdown': 'stop',
                 '/djup': 'play',
+                '/djwhy': 'explain',
                 '/skip': 'skip_song'}
+    DECISION_WINDOW = 5
+    MAX_DECISIONS = 10
+    MIN_SEAT_TIME = 60
 
     @property
     def should_step_down(self):
@@ -56,8 +200,11 @@ class Dj(CommandPlugin):
 
     def __init__(self, *args, **kwargs):
         super(Dj, self).__init__(*args, **kwargs)
+        self.decisions = deque(maxlen=self.MAX_DECISIONS)
         self.end_song_step_down = False
+        self.last_action = (None, 0)
         self.should_auto_skip = False
+        self.update_pending = False
         self.register('add_dj', self.dj_update)
         self.register('deregistered', self.dj_update)
         self.register('endsong', self.end_song)
@@ -65,6 +212,17 @@ class Dj(CommandPlugin):
         self.register('registered', self.dj_update)
         self.register('rem_dj', self.dj_update)
 
+    def export_state(self):
+        return {'end_song_step_down': self.end_song_step_down,
+                'should_auto_skip': self.should_auto_skip}
+
+    def import_state(self, state, version):
+        if version != self.STATE_VERSION:
+            return False
+        self.end_song_step_down = state['end_song_step_down']
+        self.should_auto_skip = state['should_auto_skip']
+        return True
+
     @no_arg_command
     def auto_skip(self, data):
         """Toggle whether the bot should play anything."""
@@ -76,37 +234,91 @@ class Dj(CommandPlugin):
         else:
             self.bot.reply('I\'m back baby!', data)
 
+    def _record(self, action, reason):
+        """Record a seating decision and the reason it was made."""
+        now = time.time()
+        self.decisions.append((now, action, reason))
+        if action in ('addDj', 'remDj'):
+            self.last_action = (action, now)
+        print('{0}: {1}'.format(action, reason))
+
+    def _schedule_decision(self, delay):
+        """Schedule decide to run after delay unless already scheduled."""
+        if not self.update_pending:
+            self.update_pending = True
+            self.bot.schedule(delay, self.decide)
+
+    @display_exceptions
+    def decide(self):
+        """Decide whether to step up or down based on the current room."""
+        self.update_pending = False
+        action, action_time = self.last_action
+        elapsed = time.time() - action_time
+        if elapsed < self.DECISION_WINDOW:  # One seat action per window
+            self._schedule_decision(self.DECISION_WINDOW - elapsed)
+            return
+
+        num_djs = len(self.bot.dj_ids)
+        num_listeners = len(self.bot.listener_ids)
+        if self.should_step_down:
+            table_full = num_djs >= self.bot.max_djs
+            if table_full:
+                reason = 'the table is full ({0} djs)'.format(num_djs)
+            else:
+                reason = 'only {0} listener(s)'.format(num_listeners)
+            if action == 'addDj' and not table_full and \
+                    elapsed < self.MIN_SEAT_TIME:
+                self._schedule_decision(self.MIN_SEAT_TIME - elapsed)
+            elif self.is_playing:
+                self.end_song_step_down = True
+                self._record('wait', reason + '; leaving after this song')
+            else:
+                self._record('remDj', reason)
+                self.bot.api.remDj()
+        elif self.should_step_up:
+            if action == 'remDj' and elapsed < self.MIN_SEAT_TIME:
+                self._schedule_decision(self.MIN_SEAT_TIME - elapsed)
+                return
+            self._record('addDj', '{0} listeners and {1} dj(s)'
+                         .format(num_listeners, num_djs))
+            self.bot.api.addDj()
+
     @display_exceptions
     def dj_update(self, data):
         """Handle callbacks affecting the users in the room and at the table.
 
-        As a result, the bot may begin or stop dj-ing.
+        As a result, the bot may begin or stop dj-ing once the changes in the
+        current decision window have been coalesced.
 
         """
+        others = False  # Coalesced frames may also contain the bot
         for user in data['user']:
             if self.bot.bot_id == user['userid']:
                 if data['command'] == 'rem_dj':
                     self.should_auto_skip = False
-                return  # Ignore updates from the bot
-
-        if self.should_step_down:
-            if self.is_playing:
-                self.end_song_step_down = True
-            else:
-                print('Leaving the table')
-                self.bot.api.remDj()
-        elif self.should_step_up:
-            print('Stepping up to dj')
-            self.bot.api.addDj()
+                continue  # Ignore updates from the bot
+            others = True
+        if others:
+            self._schedule_decision(self.DECISION_WINDOW)
 
     def end_song(self, _):
         """Conditionally stop dj-ing at the end of a song."""
         if self.end_song_step_down:
             if self.should_step_down:
-                print('Delayed leaving the table.')
+                self._record('remDj', 'delayed until the end of the song')
                 self.bot.api.remDj()
             self.end_song_step_down = False
 
+    @no_arg_command
+    def explain(self, data):
+        """Explain the bot's most recent decisions about dj-ing."""
+        if not self.decisions:
+            return self.bot.reply('I have not made any decisions yet.', data)
+        now = time.time()
+        self.bot.reply('; '.join('{0}s ago {1}: {2}'.format(
+            int(now - when), action, reason) for when, action, reason
+            in list(self.decisions)[-3:]), data)
+
     @display_exceptions
     def new_song(self, _):
         """Called when a new song starts playing."""
@@ -121,6 +333,7 @@ class Dj(CommandPlugin):
         if self.is_dj:
             return self.bot.reply('I am already a dj.', data)
         if len(self.bot.dj_ids) < self.bot.max_djs:
+            self._record('addDj', 'requested by a user')
             return self.bot.api.addDj()
         self.bot.reply('I can not do that right now.', data)
 
@@ -139,6 +352,7 @@ class Dj(CommandPlugin):
         """Have the bot step down as a dj."""
         if not self.is_dj:
             return self.bot.reply('I am not currently dj-ing.', data)
+        self._record('remDj', 'requested by a user')
         self.bot.api.remDj()
 
 
@@ -149,6 +363,8 @@ class Playlist(CommandPlugin):
                 '/plclear': 'clear',
                 '/plcreate': 'create',
                 '/pldelete': 'delete',
+                '/plexport': 'export_playlist',
+                '/plimport': 'import_playlist',
                 '/pllist': 'list',
                 '/plload': 'load',
                 '/plshuffle': 'shuffle',
@@ -156,7 +372,10 @@ class Playlist(CommandPlugin):
                 '/plswitch': 'switch',
                 '/plupdate': 'update_playlist'}
     LIST_MAX_ITEMS = 5
+    PLAYLIST_DIR = 'lazysusan-playlists'
+    PLAYLIST_MAX_AGE = 300
     PLAYLIST_PREFIX = 'botplaylist.'
+    ROOM_LIST_MAX_AGE = 3600
     UPDATE_MAX_ITEMS = 10
     UPDATE_MIN_LISTENERS = 5
     UPDATE_MIN_ROOMS = 20
@@ -166,27 +385,109 @@ class Playlist(CommandPlugin):
         self.playlist = None
         self.playlists = {}
         self.register('roomChanged', self._room_init)
+        self.restored = False  # Whether the playlists need to be verified
         self.room_list = {}
-        # Fetch room info if this is a reload
-        if self.bot.api.roomId:
-            self.bot.api.roomInfo(self._room_init)
+        self.room_list_server = None
+        self.room_list_time = None
+        for job_class in (ClearJob, LoadJob, ShuffleJob, UpdateJob):
+            self.bot.jobs.register(job_class, self)
 
     def _room_init(self, _):
-        """Initialization that must wait until connected to a room."""
-        if not self.playlist:
+        """Refresh data that depends on the room's chat server."""
+        if not self.bot.ready_time:
+            return  # Handled by warmup
+        if not self.playlist or self.restored:
+            # Restored playlists may have changed on the server since
+            self.restored = False
             self.bot.api.playlistListAll(self._playlist_init)
-        self.bot.api.listRooms(skip=0, callback=self.get_room_list(0))
+        if self.room_list_server != self.bot.api.roomChatServer or \
+                time.time() - (self.room_list_time or 0) > \
+                self.ROOM_LIST_MAX_AGE:
+            self.room_list_server = self.bot.api.roomChatServer
+            self.room_list_time = time.time()
+            # Another bot on the same chat server may have crawled it already
+            room_list = self.bot.shared.get(self._room_list_key(),
+                                            self.ROOM_LIST_MAX_AGE)
+            self.room_list = dict(room_list or {})
+            if room_list is None:
+                self.bot.api.listRooms(skip=0,
+                                       callback=self.get_room_list(0))
+
+    def close(self):
+        """Stop running the plugin's jobs; they resume when it is reloaded."""
+        self.bot.jobs.release(self)
+        super(Playlist, self).close()
+
+    def warmup(self):
+        """Fetch the bot's playlists and crawl the room list."""
+        self._room_init(None)
+
+    def export_state(self):
+        return {'playlist': self.playlist,
+                'playlists': dict((name, list(song_ids)) for name, song_ids
+                                  in self.playlists.items()),
+                'room_list': dict(self.room_list),
+                'room_list_server': self.room_list_server,
+                'room_list_time': self.room_list_time}
+
+    def import_state(self, state, version):
+        if version != self.STATE_VERSION:
+            return False
+        self.playlist = state['playlist']
+        self.playlists = dict((name, set(song_ids)) for name, song_ids
+                              in state['playlists'].items())
+        self.restored = True
+        self.room_list = dict(state['room_list'])
+        self.room_list_server = state['room_list_server']
+        self.room_list_time = state.get('room_list_time')
+        return True
+
+    @property
+    def store(self):
+        """Return the local playlist store set by playlist_dir."""
+        return PlaylistStore(self.bot.config.get('playlist_dir',
+                                                 self.PLAYLIST_DIR))
+
+    def _playlist_all(self, playlist, callback):
+        """Call callback with the playlistAll response for the playlist.
+
+        Responses are shared with the other bots using the same identity
+        until the playlist is changed (see changed) or PLAYLIST_MAX_AGE.
+
+        """
+        def _closure(data):
+            if data.get('success'):
+                self.bot.shared.set(key, data['list'])
+            callback(data)
+        key = self._playlist_key(playlist)
+        items = self.bot.shared.get(key, self.PLAYLIST_MAX_AGE)
+        if items is not None:
+            callback({'list': items, 'success': True})
+        else:
+            self.bot.api.playlistAll(playlist, _closure)
 
     def _playlist_init(self, data):
+        names = set(x['name'] for x in data['list'])
+        for name in list(self.playlists):
+            if name not in names:  # E.g., deleted since a restore
+                del self.playlists[name]
         for item in data['list']:
             self.playlists[item['name']] = set()
             if item['active']:
                 self.playlist = item['name']
-        self.bot.api.playlistAll(self.playlist, self._playlist_info)
+        self._playlist_all(self.playlist, self._playlist_info)
 
     def _playlist_info(self, data):
         self.playlists[self.playlist] = set(x['_id'] for x in data['list'])
 
+    def _playlist_key(self, playlist):
+        """Return the shared cache key of a playlist of the bot."""
+        return u'playlist.{0}.{1}'.format(self.bot.bot_id, playlist)
+
+    def _room_list_key(self):
+        """Return the shared cache key of the current chat server's rooms."""
+        return u'room_list.{0}'.format(json.dumps(self.room_list_server))
+
     @no_arg_command
     def add(self, data):
         """Add the current song to the bot's default playlist."""
@@ -200,6 +501,7 @@ class Playlist(CommandPlugin):
             self.bot.reply('Cool tunes, daddio.', data)
             self.bot.api.playlistAdd('default', self.bot.api.currentSongId,
                                      len(playlist))
+            self.changed('default')
             if self.playlist == 'default':
                 playlist.add(self.bot.api.currentSongId)
         self.bot.api.bop()
@@ -208,10 +510,10 @@ class Playlist(CommandPlugin):
     @no_arg_command
     def available(self, data):
         """Output the names of the available playlists (local)."""
-        playlists = []
+        playlists = set(self.store.names())
         for key in self.bot.config:
             if key.startswith(self.PLAYLIST_PREFIX):
-                playlists.append(key[len(self.PLAYLIST_PREFIX):])
+                playlists.add(key[len(self.PLAYLIST_PREFIX):])
         reply = 'Available playlists: '
         reply += ', '.join(sorted(playlists))
         self.bot.reply(reply, data)
@@ -220,52 +522,18 @@ class Playlist(CommandPlugin):
     @no_arg_command
     def clear(self, data):
         """Clear the bot's current playlist."""
-        def delete_callback(cb_data):
-            def create_callback(cb_data2):
-                if cb_data2['success']:
-                    reply = 'Cleared playlist {0}.'.format(self.playlist)
-                else:
-                    reply = cb_data['err']
-                self.bot.reply(reply, data)
-
-            if cb_data['success']:
-                self.playlists[self.playlist] = set()
-                self.bot.api.playlistCreate(self.playlist, create_callback)
-            else:
-                self.bot.reply(cb_data['err'], data)
-
         if not self.playlists[self.playlist]:
             self.bot.reply('The playlist is already empty.', data)
-        elif self.playlist != 'default':
-            self.bot.api.playlistDelete(self.playlist, delete_callback)
-        else:
-            self.bot.api.playlistRemove(self.playlist, 0,
-                                        self.clear_callback(data))
-
-    def clear_callback(self, caller_data, complete_callback=None):
-        @display_exceptions
-        def _closure(data):
-            if not data['success']:
-                self.bot.reply('Failure clearing playlist. There are still '
-                               '{0} items.'.format(len(playlist)),
-                               caller_data)
-                return
-            playlist.remove(data['song_dict'][0]['fileid'])
-            removed = original_count - len(playlist)
-            if removed % 30 == 0:
-                self.bot.reply('Removed {0} of {1} songs so far.'
-                               .format(removed, original_count), caller_data)
-            if playlist:  # While there are songs, continue to remove
-                self.bot.api.playlistRemove(self.playlist, 0, _closure)
-            elif complete_callback:  # Perform completion action
-                complete_callback()
-            else:
-                self.bot.reply('Cleared playlist {0}.'.format(self.playlist),
-                               caller_data)
+            return
+        # The default playlist cannot be deleted so remove each song
+        phase = 'fetch' if self.playlist == 'default' else 'delete'
+        self.bot.jobs.start(ClearJob(self, data, {'phase': phase,
+                                                  'playlist': self.playlist,
+                                                  'removed': 0}))
 
-        playlist = self.playlists[self.playlist]
-        original_count = len(playlist)
-        return _closure
+    def changed(self, playlist):
+        """Invalidate the shared copy of a playlist that is being changed."""
+        self.bot.shared.invalidate(self._playlist_key(playlist))
 
     @single_arg_command
     def create(self, message, data):
@@ -287,11 +555,34 @@ class Playlist(CommandPlugin):
             if cb_data['success']:
                 reply = 'Deleted playlist {0}'.format(cb_data['playlist_name'])
                 del self.playlists[message]
+                self.changed(message)
             else:
                 reply = cb_data['err']
             self.bot.reply(reply, data)
         self.bot.api.playlistDelete(message, callback)
 
+    @admin_or_moderator_required
+    @single_arg_command
+    def export_playlist(self, message, data):
+        """Export a local playlist from the store in lazysusan.ini format.
+
+        The playlist is written next to the store as `<name>.ini`.
+
+        """
+        if message not in self.store:
+            self.bot.reply('Playlist `{0}` does not exist.'.format(message),
+                           data)
+            return
+        store = self.store
+        path = os.path.join(store.directory, '{0}.ini'.format(message))
+        indent = ' ' * (len(self.PLAYLIST_PREFIX) + len(message) + 2)
+        with open(path, 'w') as fp:
+            fp.write('{0}{1}: '.format(self.PLAYLIST_PREFIX, message))
+            fp.write('\n{0}'.format(indent).join(store.read(message)))
+            fp.write('\n')
+        self.bot.reply('Exported {0} songs to {1}.'
+                       .format(store.count(message), path), data)
+
     def get_room_list(self, skip):
         @display_exceptions
         def _closure(data):
@@ -309,31 +600,56 @@ class Playlist(CommandPlugin):
                 self.bot.api.listRooms(skip=count,
                                        callback=self.get_room_list(count))
                 return
+            self.bot.shared.set(self._room_list_key(), self.room_list)
         return _closure
 
+    @admin_or_moderator_required
+    @single_arg_command
+    def import_playlist(self, message, data):
+        """Import a local playlist from lazysusan.ini into the store.
+
+        Once imported, the playlist can be removed from lazysusan.ini.
+
+        """
+        config_name = '{0}{1}'.format(self.PLAYLIST_PREFIX, message)
+        if config_name not in self.bot.config:
+            self.bot.reply('Playlist `{0}` does not exist.'
+                           .format(config_name), data)
+            return
+        try:
+            count = self.store.write(message, self.bot.config[config_name])
+        except (IOError, OSError, ValueError) as exc:
+            self.bot.reply('Import failed: {0}'.format(exc), data)
+            return
+        self.bot.reply('Imported {0} songs into local playlist {1}.'
+                       .format(count, message), data)
+
+    @command_cost(3)
     @no_arg_command
     def list(self, data):
         """Output a summary of the songs in the current playlist."""
         @display_exceptions
         def callback(cb_data):
-            preview = []
-            playlist = set()
-            for item in cb_data['list']:
-                playlist.add(item['_id'])
-                artist = item['metadata']['artist'].encode('utf-8')
-                song = item['metadata']['song'].encode('utf-8')
-                item = '"{0}" by {1}'.format(song, artist)
-                if len(preview) < self.LIST_MAX_ITEMS:
-                    preview.append(item)
+            if not cb_data['success']:
+                self.bot.reply(cb_data.get('err', 'Error listing playlist.'),
+                               data)
+                return
+            playlist = set(x['_id'] for x in cb_data['list'])
+            preview = [self.bot.songs.lookup(x).display
+                       for x in cb_data['list'][:self.LIST_MAX_ITEMS]]
             reply = ('There are {0} songs in the playlist. '
                      .format(len(playlist)))
             if preview:
-                reply += 'The first {0} are: {1}'.format(len(preview),
-                                                         ', '.join(preview))
+                reply += u'The first {0} are: {1}'.format(len(preview),
+                                                          u', '.join(preview))
             self.playlists[self.playlist] = playlist
             self.bot.reply(reply, data)
-        self.bot.api.playlistAll(self.playlist, callback)
+        if not self.playlist:
+            self.bot.reply('The playlists have not been fetched yet.', data)
+            return
+        self._playlist_all(self.playlist, callback)
 
+    @command_cost(2)
     @no_arg_command
     def list_playlists(self, data):
         """List the available playlists."""
@@ -350,96 +666,35 @@ class Playlist(CommandPlugin):
     @admin_or_moderator_required
     @single_arg_command
     def load(self, message, data):
-        """Load the specified local playlist into a new playlist."""
-        def add_songs(cb_data=None):
-            if cb_data and cb_data['success']:
-                failed.pop(0)
-            playlist = self.playlists[playlist_name]
-            while song_ids:
-                song_id = song_ids.pop(0)
-                failed.insert(0, song_id)  # Removed on success
-                if song_id not in playlist:
-                    playlist.add(song_id)
-                    self.bot.api.playlistAdd(playlist_name, song_id,
-                                             len(playlist) - 1, add_songs)
-                    break
-            else:
-                self.bot.api.playlistSwitch(playlist_name, switch_callback)
-
-        def create_callback(cb_data):
-            if cb_data['success']:
-                self.playlists[playlist_name] = set()
-                add_songs()
-            else:
-                self.bot.reply(cb_data['err'], data)
-
-        def delete_callback(cb_data):
-            if cb_data['success']:
-                del self.playlists[playlist_name]
-                self.bot.api.playlistCreate(playlist_name, create_callback)
-            else:
-                self.bot.reply(cb_data['err'], data)
-
-        def switch_callback(cb_data):
-            if cb_data['success']:
-                self.playlist = cb_data['playlist_name']
-                reply = ('Loaded {0} songs from local playlist {1}.'
-                         .format(len(self.playlist), message))
-                if failed:
-                    reply += (' Failed to load the following song ids: {0}'
-                              .format(','.join(failed)))
-            else:
-                reply = cb_data['err']
-            self.bot.reply(reply, data)
-
+        """Load the specified local playlist, updating an existing copy."""
         config_name = '{0}{1}'.format(self.PLAYLIST_PREFIX, message)
-        if config_name not in self.bot.config:
+        if message in self.store:
+            song_ids = list(self.store.read(message))
+        elif config_name in self.bot.config:
+            song_ids = list(self.bot.config[config_name])
+        else:
             self.bot.reply('Playlist `{0}` does not exist.'
-                           .format(config_name), data)
+                           .format(message), data)
             return
-
-        song_ids = self.bot.config[config_name].split('\n')
-        failed = []
         playlist_name = 'local_{0}'.format(message)
-        if playlist_name in self.playlists:  # Delete the playlist
-            self.bot.api.playlistDelete(playlist_name, delete_callback)
-        else:  # Create the playlist
-            self.bot.api.playlistCreate(playlist_name, create_callback)
+        # An existing playlist is synchronized with the local playlist
+        phase = 'fetch' if playlist_name in self.playlists else 'create'
+        self.bot.jobs.start(LoadJob(self, data, {
+            'added': 0, 'applied': 0, 'failed': [], 'moved': 0,
+            'name': message, 'phase': phase, 'playlist': playlist_name,
+            'removed': 0}, song_ids))
 
     @no_arg_command
     def shuffle(self, data):
         """Randomly select the next 10 songs in the bot's current playlist."""
-        def get_endpoints():
-            dst = index[0]
-            index[0] += 1
-            item = new_order.pop(0)
-            src = original.index(item)
-            if src != dst:  # Reorder for next use
-                del original[src]
-                original.insert(dst, item)
-            return src, dst
-
-        def callback(cb_data):
-            if not cb_data['success']:
-                self.bot.reply('Error shuffling playlist.', data)
-            elif index[0] >= num:
-                self.bot.reply('Everyday I\'m shuffling (completed).', data)
-            else:
-                src, dst = get_endpoints()
-                self.bot.api.playlistReorder(self.playlist, src, dst, callback)
-
-        # We don't actually keep track of the song order so just use their
-        # current indexes
-        original = list(range(len(self.playlists[self.playlist])))
-        num = min(len(original), 10)
-        if num < 2:
+        if len(self.playlists[self.playlist]) < 2:
             self.bot.reply('There are too few items to shuffle in {0}.'
                            .format(self.playlist), data)
             return
-        new_order = random.sample(original, num)
-        index = [0]  # Needs to be a list in order to mutate
-        src, dst = get_endpoints()
-        self.bot.api.playlistReorder(self.playlist, src, dst, callback)
+        # The songs are selected once the job fetches the playlist's order
+        self.bot.jobs.start(ShuffleJob(self, data, {
+            'index': 0, 'phase': 'fetch', 'playlist': self.playlist,
+            'songs': []}))
 
     @no_arg_command
     def skip_next(self, data):
@@ -450,6 +705,7 @@ class Playlist(CommandPlugin):
         """
         def callback(cb_data):
             if cb_data['success']:
+                self.changed(self.playlist)
                 self.bot.reply('Next song skipped.', data)
             else:
                 self.bot.reply('Error skipping next song.', data)
@@ -464,7 +720,7 @@ class Playlist(CommandPlugin):
             if cb_data['success']:
                 self.playlist = cb_data['playlist_name']
                 reply = 'Switched to playlist {0}'.format(self.playlist)
-                self.bot.api.playlistAll(self.playlist, self._playlist_info)
+                self._playlist_all(self.playlist, self._playlist_info)
             else:
                 reply = cb_data['err']
             self.bot.reply(reply, data)
@@ -477,6 +733,7 @@ class Playlist(CommandPlugin):
         else:
             self.bot.api.playlistSwitch(selection, callback)
 
+    @command_cost(5)
     @single_arg_command
     def update_playlist(self, message, data):
         """Update the room playlist from songs played in the provideded room.
@@ -485,58 +742,6 @@ class Playlist(CommandPlugin):
         room. Upon completion, the bot will switch to this playlist.
 
         """
-        def room_info_callback(cb_data):
-            def add_songs():
-                def add_song_callback(_):
-                    if to_add:
-                        _, song_id = to_add.pop(0)
-                        playlist.add(song_id)
-                        self.bot.api.playlistAdd(self.playlist, song_id, 0,
-                                                 add_song_callback)
-                    else:
-                        self.bot.reply('Added {0} songs'.format(num), data)
-
-                playlist = self.playlists[self.playlist]
-                songs = cb_data['room']['metadata']['songlog']
-
-                to_add = []
-                for song in songs:
-                    if song['_id'] not in playlist:
-                        to_add.append((song.get('score'), song['_id']))
-                if not to_add:
-                    self.bot.reply('No songs to add.', data)
-                    return
-
-                # Most popular songs will play first (added last)
-                to_add.sort()
-                num = len(to_add)
-                add_song_callback(None)
-
-            def list_callback(cb_data2):
-                self.playlists[self.playlist] = set(x['_id'] for x in
-                                                    cb_data2['list'])
-                add_songs()
-
-            def switch_callback(cb_data2):
-                if cb_data2['success']:
-                    self.playlist = cb_data2['playlist_name']
-                    self.bot.api.playlistAll(self.playlist, list_callback)
-                else:
-                    self.bot.reply(cb_data2['err'], data)
-
-            def create_callback(cb_data2):
-                if cb_data2['success']:
-                    self.bot.api.playlistSwitch(message, switch_callback)
-                else:
-                    self.bot.reply(reply, cb_data2['err'])
-
-            if message not in self.playlists:  # Create the playlist
-                self.bot.api.playlistCreate(message, create_callback)
-            elif message == self.playlist:  # Add songs
-                add_songs()
-            else:  # Switch to the playlist
-                self.bot.api.playlistSwitch(message, switch_callback)
-
         selection = best_match(message, self.room_list.keys())
         if not selection:
             reply = 'Could not find `{0}` in the room_list. '.format(message)
@@ -548,7 +753,368 @@ class Playlist(CommandPlugin):
             self.bot.reply('Possible room matches: {0}'
                            .format(', '.join(selection)), data)
         else:
-            message = selection
-            room_id = self.room_list[message]
-            self.bot.reply('Querying {0} ({1})'.format(message, room_id), data)
-            self.bot.api.roomInfo(room_info_callback, room_id=room_id)
+            room_id = self.room_list[selection]
+            self.bot.reply('Querying {0} ({1})'.format(selection, room_id),
+                           data)
+            self.bot.jobs.start(UpdateJob(self, data, {
+                'added': 0, 'index': 0, 'phase': 'info',
+                'playlist': selection, 'room_id': room_id}))
+
+
+class ClearJob(Job):
+
+    """Clear a playlist by deleting and recreating it.
+
+    The default playlist cannot be deleted so its songs are removed one at a
+    time instead.
+
+    """
+
+    KIND = 'botdj.clear'
+    PROGRESS_INTERVAL = 30
+
+    def describe(self):
+        if self.state['phase'] == 'remove':
+            return 'clear {0} ({1} removed, {2} remaining)'.format(
+                self.state['playlist'], self.state['removed'],
+                self.state['remaining'])
+        return 'clear {0}'.format(self.state['playlist'])
+
+    def handle(self, data):
+        self.plugin.changed(self.state['playlist'])
+        state = self.state
+        phase = state['phase']
+        playlists = self.plugin.playlists
+        if not data['success']:
+            if phase == 'remove':
+                self.reply('Failure clearing playlist. There are still {0} '
+                           'items.'.format(state['remaining']))
+            else:
+                self.reply(data['err'])
+            return False
+        if phase == 'sync':  # Determine whether the deletion happened
+            exists = state['playlist'] in set(x['name'] for x in data['list'])
+            if not exists:
+                state['phase'] = 'create'
+            elif state['resume'] == 'delete':
+                state['phase'] = 'delete'
+            else:
+                state['phase'] = 'done'
+        elif phase == 'delete':
+            playlists.pop(state['playlist'], None)
+            state['phase'] = 'create'
+        elif phase == 'create':
+            playlists[state['playlist']] = set()
+            state['phase'] = 'done'
+        elif phase == 'fetch':
+            playlists[state['playlist']] = set(x['_id'] for x in data['list'])
+            state['phase'] = 'remove'
+            state['remaining'] = len(data['list'])
+        elif phase == 'remove':
+            playlist = playlists.setdefault(state['playlist'], set())
+            playlist.discard(data['song_dict'][0]['fileid'])
+            state['remaining'] -= 1
+            state['removed'] += 1
+            if state['removed'] % self.PROGRESS_INTERVAL == 0:
+                self.reply('Removed {0} of {1} songs so far.'.format(
+                    state['removed'], state['removed'] + state['remaining']))
+        return True
+
+    def resume(self):
+        phase = self.state['phase']
+        if phase in ('create', 'delete'):
+            self.state.update(phase='sync', resume=phase)
+        elif phase == 'remove':
+            self.state['phase'] = 'fetch'
+
+    def step(self, callback):
+        api = self.bot.api
+        phase = self.state['phase']
+        playlist = self.state['playlist']
+        if phase == 'sync':
+            api.playlistListAll(callback)
+        elif phase == 'delete':
+            api.playlistDelete(playlist, callback)
+        elif phase == 'create':
+            api.playlistCreate(playlist, callback)
+        elif phase == 'fetch':
+            api.playlistAll(playlist, callback)
+        elif phase == 'remove' and self.state['remaining'] > 0:
+            api.playlistRemove(playlist, 0, callback)
+        else:
+            self.reply('Cleared playlist {0}.'.format(playlist))
+            return False
+        return True
+
+
+class LoadJob(Job):
+
+    """Load a local playlist (the items) into a turntable playlist.
+
+    An existing playlist is synchronized rather than recreated: only the
+    removes, adds and moves in the operations from playlist_diff are made, so
+    the number of requests depends on the size of the change.
+
+    """
+
+    KIND = 'botdj.load'
+
+    def __init__(self, *args, **kwargs):
+        super(LoadJob, self).__init__(*args, **kwargs)
+        self.operations = []  # Recomputed after a resume
+
+    def describe(self):
+        if self.state['phase'] == 'apply':
+            return 'load {0} ({1} of {2} changes)'.format(
+                self.state['name'], self.state['applied'],
+                len(self.operations))
+        return 'load {0}'.format(self.state['name'])
+
+    def handle(self, data):
+        self.plugin.changed(self.state['playlist'])
+        state = self.state
+        phase = state['phase']
+        if phase == 'apply':
+            operation = self.operations[state['applied']]
+            if not data['success']:
+                if operation[0] != 'add':
+                    self.reply(data.get('err', 'Error loading playlist.'))
+                    return False
+                # Shift the later indexes rather than fetch the playlist again
+                state['failed'].append(operation[1])
+                self.operations[state['applied']:] = skip_add(
+                    self.operations, state['applied'])
+                return True
+            state[{'add': 'added', 'move': 'moved',
+                   'remove': 'removed'}[operation[0]]] += 1
+            state['applied'] += 1
+            self._apply(operation)
+            return True
+        if not data['success']:
+            self.reply(data['err'])
+            return False
+        if phase == 'sync':  # Determine whether the playlist exists
+            exists = state['playlist'] in set(x['name'] for x in data['list'])
+            state['phase'] = 'fetch' if exists else 'create'
+        elif phase == 'create':
+            self.plugin.playlists[state['playlist']] = set()
+            self._plan([])
+        elif phase == 'fetch':
+            self._plan([x['_id'] for x in data['list']])
+        elif phase == 'switch':
+            self.plugin.playlist = data['playlist_name']
+            reply = ('Loaded {0} songs from local playlist {1} ({2} added, '
+                     '{3} removed, {4} moved).'.format(
+                         len(self.plugin.playlists[state['playlist']]),
+                         state['name'], state['added'], state['removed'],
+                         state['moved']))
+            if state['failed']:
+                reply += (' Failed to load the following song ids: {0}'
+                          .format(','.join(state['failed'])))
+            self.reply(reply)
+            return False
+        return True
+
+    def _apply(self, operation):
+        """Update the plugin's copy of the playlist for an operation."""
+        playlist = self.plugin.playlists.setdefault(self.state['playlist'],
+                                                    set())
+        if operation[0] == 'add':
+            playlist.add(operation[1])
+        elif operation[0] == 'remove':
+            playlist.discard(operation[2])
+
+    def _plan(self, current):
+        """Compute the operations from the current server playlist."""
+        self.plugin.playlists[self.state['playlist']] = set(current)
+        failed = set(self.state['failed'])
+        target = []
+        seen = set()
+        for song_id in self.items:
+            if song_id not in seen and song_id not in failed:
+                seen.add(song_id)
+                target.append(song_id)
+        self.operations = playlist_diff(current, target)
+        self.state.update(applied=0, phase='apply')
+
+    def resume(self):
+        if self.state['phase'] != 'switch':
+            self.state['phase'] = 'sync'
+
+    def step(self, callback):
+        api = self.bot.api
+        state = self.state
+        playlist_name = state['playlist']
+        if state['phase'] == 'apply':
+            if state['applied'] < len(self.operations):
+                operation = self.operations[state['applied']]
+                if operation[0] == 'add':
+                    api.playlistAdd(playlist_name, operation[1], operation[2],
+                                    callback)
+                elif operation[0] == 'move':
+                    api.playlistReorder(playlist_name, operation[1],
+                                        operation[2], callback)
+                else:
+                    api.playlistRemove(playlist_name, operation[1], callback)
+                return True
+            state['phase'] = 'switch'
+        if state['phase'] == 'sync':
+            api.playlistListAll(callback)
+        elif state['phase'] == 'create':
+            api.playlistCreate(playlist_name, callback)
+        elif state['phase'] == 'fetch':
+            api.playlistAll(playlist_name, callback)
+        elif state['phase'] == 'switch':
+            api.playlistSwitch(playlist_name, callback)
+        return True
+
+
+class ShuffleJob(Job):
+
+    """Move randomly selected songs to the front of a playlist.
+
+    The playlist is fetched first, and again on resume, so that each move is
+    computed from the playlist's current order and songs that were already
+    moved to the front are not moved again.
+
+    """
+
+    KIND = 'botdj.shuffle'
+    SONGS = 10
+
+    def __init__(self, *args, **kwargs):
+        super(ShuffleJob, self).__init__(*args, **kwargs)
+        self.order = []  # The playlist's song ids, fetched after a resume
+
+    def describe(self):
+        return 'shuffle {0} ({1} of {2} moved)'.format(
+            self.state['playlist'], self.state['index'],
+            len(self.state['songs']))
+
+    def handle(self, data):
+        self.plugin.changed(self.state['playlist'])
+        state = self.state
+        if not data['success']:
+            self.reply('Error shuffling playlist.')
+            return False
+        if state['phase'] == 'fetch':
+            self.order = [x['_id'] for x in data['list']]
+            if state['songs']:  # Resumed, skip any removed songs
+                present = set(self.order)
+                state['songs'] = [x for x in state['songs'] if x in present]
+            else:
+                state['songs'] = random.sample(
+                    self.order, min(len(self.order), self.SONGS))
+            index = 0
+            while index < len(state['songs']) and \
+                    self.order[index] == state['songs'][index]:
+                index += 1
+            state.update(index=index, phase='move')
+        else:
+            src = self.order.index(state['songs'][state['index']])
+            self.order.insert(state['index'], self.order.pop(src))
+            state['index'] += 1
+        return True
+
+    def resume(self):
+        self.state['phase'] = 'fetch'
+
+    def step(self, callback):
+        state = self.state
+        if state['phase'] == 'fetch':
+            self.bot.api.playlistAll(state['playlist'], callback)
+        elif state['index'] < len(state['songs']):
+            src = self.order.index(state['songs'][state['index']])
+            self.bot.api.playlistReorder(state['playlist'], src,
+                                         state['index'], callback)
+        else:
+            self.reply('Everyday I\'m shuffling (completed).')
+            return False
+        return True
+
+
+class UpdateJob(Job):
+
+    """Add the songs recently played in a room to the playlist named for it.
+
+    The most popular songs are added last so that they play first.
+
+    """
+
+    KIND = 'botdj.update'
+
+    def describe(self):
+        if self.state['phase'] == 'add':
+            return 'update {0} ({1} of {2} songs)'.format(
+                self.state['playlist'], self.state['index'],
+                len(self.state['songs']))
+        return 'update {0}'.format(self.state['playlist'])
+
+    def handle(self, data):
+        self.plugin.changed(self.state['playlist'])
+        state = self.state
+        phase = state['phase']
+        if phase == 'add':  # Failures are skipped
+            if data['success']:
+                self.plugin.playlists[state['playlist']].add(
+                    state['songs'][state['index']])
+                state['added'] += 1
+            state['index'] += 1
+            return True
+        if not data['success']:
+            self.reply(data['err'])
+            return False
+        if phase == 'info':
+            # Songs without a score sort as unpopular
+            songs = sorted(data['room']['metadata']['songlog'],
+                           key=lambda x: (x.get('score') or 0, x['_id']))
+            state.update(phase='lists', songs=[x['_id'] for x in songs])
+        elif phase == 'lists':
+            names = set(x['name'] for x in data['list'])
+            if state['playlist'] not in names:
+                state['phase'] = 'create'
+            elif state['playlist'] == self.plugin.playlist:
+                state['phase'] = 'fetch'
+            else:
+                state['phase'] = 'switch'
+        elif phase == 'create':
+            self.plugin.playlists[state['playlist']] = set()
+            state['phase'] = 'switch'
+        elif phase == 'switch':
+            self.plugin.playlist = data['playlist_name']
+            state['phase'] = 'fetch'
+        elif phase == 'fetch':
+            playlist = set(x['_id'] for x in data['list'])
+            self.plugin.playlists[state['playlist']] = playlist
+            state['songs'] = [x for x in state['songs'] if x not in playlist]
+            if not state['songs']:
+                self.reply('No songs to add.')
+                return False
+            state.update(index=0, phase='add')
+        return True
+
+    def resume(self):
+        if self.state['phase'] != 'info':
+            self.state['phase'] = 'lists'
+
+    def step(self, callback):
+        api = self.bot.api
+        state = self.state
+        phase = state['phase']
+        if phase == 'info':
+            api.roomInfo(callback, room_id=state['room_id'])
+        elif phase == 'lists':
+            api.playlistListAll(callback)
+        elif phase == 'create':
+            api.playlistCreate(state['playlist'], callback)
+        elif phase == 'switch':
+            api.playlistSwitch(state['playlist'], callback)
+        elif phase == 'fetch':
+            api.playlistAll(state['playlist'], callback)
+        elif state['index'] < len(state['songs']):
+            api.playlistAdd(state['playlist'], state['songs'][state['index']],
+                            0, callback)
+        else:
+            self.reply('Added {0} songs'.format(state['added']))
+            return False
+        return True
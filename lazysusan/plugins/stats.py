@@ -0,0 +1,85 @@
+"""A plugin that records the songs played and reports statistics on them."""
+
+import time
+from lazysusan.helpers import display_exceptions, no_arg_command
+from lazysusan.plugins import CommandPlugin
+from lazysusan.storage import PlayStore
+
+
+class Stats(CommandPlugin):
+
+    """A plugin that records every song played and reports on the history.
+
+    Plays are stored in the directory set by stats_dir.
+
+    """
+
+    COMMANDS = {'/djstats': 'dj_stats',
+                '/playhours': 'play_hours',
+                '/topsongs': 'top_songs'}
+    STATS_DIR = 'lazysusan-stats'
+    TOP_ITEMS = 5
+
+    def __init__(self, *args, **kwargs):
+        super(Stats, self).__init__(*args, **kwargs)
+        self.store = PlayStore(self.bot.config.get('stats_dir',
+                                                   self.STATS_DIR))
+        self.register('endsong', self.end_song)
+
+    @no_arg_command
+    def dj_stats(self, data):
+        """Output the djs who have played the most songs."""
+        top = self.store.counts('dj', self.TOP_ITEMS)
+        if not top:
+            return self.bot.reply('No songs have been played yet.', data)
+        ups = self.store.sums('dj', 'up')
+        labels = self.store.labels['dj']
+        self.bot.reply(u'Top djs: ' + u', '.join(
+            u'{0} ({1} plays, {2:.1f} avg awesomes)'.format(
+                labels[index], count,
+                float(ups[index]) / count) for index, count in top), data)
+
+    @display_exceptions
+    def end_song(self, data):
+        """Record the song that just ended along with its votes.
+
+        The endsong data is the room from the newsong event with the votes
+        updated as they changed.
+
+        """
+        if not data or not data.get('room'):
+            return
+        metadata = data['room']['metadata']
+        song = metadata.get('current_song')
+        if not song:
+            return
+        self.store.append(
+            song['_id'], data['room']['roomid'], metadata['current_dj'],
+            song.get('starttime') or time.time(), metadata.get('upvotes', 0),
+            metadata.get('downvotes', 0), metadata.get('listeners', 0),
+            labels={'dj': song.get('djname', metadata['current_dj']),
+                    'room': data['room'].get('name', data['room']['roomid']),
+                    'song': self.bot.songs.lookup(song).display})
+        self.store.flush()
+
+    @no_arg_command
+    def play_hours(self, data):
+        """Output the hours of the day (UTC) in which the most songs played."""
+        hours = self.store.hours()
+        busiest = sorted(range(24), key=lambda x: -hours[x])[:3]
+        if not hours[busiest[0]]:
+            return self.bot.reply('No songs have been played yet.', data)
+        self.bot.reply('Busiest hours (UTC): ' + ', '.join(
+            '{0:02d}:00 ({1} plays)'.format(hour, hours[hour])
+            for hour in busiest if hours[hour]), data)
+
+    @no_arg_command
+    def top_songs(self, data):
+        """Output the most played songs."""
+        top = self.store.counts('song', self.TOP_ITEMS)
+        if not top:
+            return self.bot.reply('No songs have been played yet.', data)
+        labels = self.store.labels['song']
+        self.bot.reply(u'Most played: ' + u', '.join(
+            u'{0} ({1})'.format(labels[index], count)
+            for index, count in top), data)
@@ -1,5 +1,6 @@
 """Plugins for managing room themes."""
 
+from collections import OrderedDict
 from lazysusan.helpers import (
         admin_or_moderator_required,
         display_exceptions,
@@ -10,16 +11,64 @@ from lazysusan.plugins import CommandPlugin
 
 class Theme(CommandPlugin):
 
-    """A plugin for managing the room's current theme."""
+    """A plugin for managing the room's current theme.
 
+    When theme terms are set every new song is checked against them, and
+    whether or not it is on theme is announced.
+
+    """
+
+    CACHE_SIZE = 1000
     COMMANDS = {
             '/theme': 'get_theme',
             '/themeset': 'set_theme',
             '/themeclear': 'clear_theme',
+            '/themeterms': 'set_terms',
             }
+    STATE_VERSION = 2
 
     theme = None
 
+    def __init__(self, *args, **kwargs):
+        super(Theme, self).__init__(*args, **kwargs)
+        self.cache = OrderedDict()  # Song id -> matching term or None
+        self.matcher = None
+        self.register('newsong', self.check_song)
+
+    def export_state(self):
+        return {'terms': self.matcher.terms if self.matcher else None,
+                'theme': self.theme}
+
+    def import_state(self, state, version):
+        if version not in (1, self.STATE_VERSION):
+            return False
+        self.theme = state['theme']
+        if state.get('terms'):
+            self.matcher = ThemeMatcher(state['terms'])
+        return True
+
+    @display_exceptions
+    def check_song(self, data):
+        """Announce whether or not the new song is on theme (newsong)."""
+        song = data['room']['metadata'].get('current_song')
+        if not self.matcher or not song:
+            return
+        if song['_id'] in self.cache:
+            term = self.cache.pop(song['_id'])
+        else:
+            metadata = song['metadata']
+            # Fields are separated so that a term cannot span two of them
+            term = self.matcher.search(u'\n'.join(
+                metadata.get(x) or u'' for x in ('artist', 'song', 'album')))
+        self.cache[song['_id']] = term  # Most recently used last
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        if term:
+            reply = u'"{0}" is on theme ({1}).'
+        else:
+            reply = u'"{0}" does not match the theme.'
+        self.bot.reply(reply.format(song['metadata'].get('song'), term))
+
     @no_arg_command
     def get_theme(self, data):
         """Gets the current theme."""
@@ -27,19 +76,103 @@ class Theme(CommandPlugin):
             self.bot.reply("There's no theme right now; anything goes!", data)
         else:
             self.bot.reply(
-                    "The current theme is: \"{}\"".format(self.theme), data)
+                    u'The current theme is: "{0}"'.format(self.theme), data)
+        if self.matcher:
+            self.bot.reply(u'Songs are checked for: {0}'.format(
+                u', '.join(self.matcher.terms)), data)
+
+    @display_exceptions
+    @admin_or_moderator_required
+    def set_terms(self, message, data):
+        """Sets the comma separated terms songs are checked for.
+
+        A song is on theme when its artist, title or album contains one of
+        the terms as a whole word or phrase. With no terms, songs are not
+        checked.
+
+        """
+        terms = [x.strip() for x in message.split(',') if x.strip()]
+        self.cache.clear()
+        if not terms:
+            self.matcher = None
+            self.bot.reply('Songs will not be checked against the theme.',
+                           data)
+            return
+        self.matcher = ThemeMatcher(terms)
+        self.bot.reply(u'Songs will be checked for: {0}'.format(
+            u', '.join(self.matcher.terms)), data)
 
     @display_exceptions
     @admin_or_moderator_required
     def set_theme(self, message, data):
         """Sets the current theme."""
         self.theme = message.strip()
-        self.bot.api.speak("The theme is now: \"{}\"".format(self.theme))
+        self.bot.reply(u'The theme is now: "{0}"'.format(self.theme))
 
     @display_exceptions
     @admin_or_moderator_required
     @no_arg_command
     def clear_theme(self, data):
-        """Removes the current theme."""
+        """Removes the current theme and its terms."""
+        self.cache.clear()
+        self.matcher = None
         self.theme = None
-        self.bot.api.speak("There's no theme right now; anything goes!")
+        self.bot.reply("There's no theme right now; anything goes!")
+
+
+class ThemeMatcher(object):
+
+    """Find theme terms in text with an Aho-Corasick automaton.
+
+    The automaton is built once when the terms are set, after which a search
+    is a single pass over the text regardless of the number of terms. Terms
+    are case insensitive and must match whole words.
+
+    """
+
+    def __init__(self, terms):
+        self.terms = sorted(set(x.strip().lower() for x in terms
+                                if x.strip()))
+        self._fail = [0]
+        self._goto = [{}]
+        self._output = [[]]  # The terms that end at each state
+        for term in self.terms:
+            state = 0
+            for char in term:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(term)
+
+        # Breadth first so that the failure state of the parent is known
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child].extend(self._output[self._fail[child]])
+
+    @staticmethod
+    def _is_boundary(text, index):
+        """Return whether index is outside of a word in text."""
+        return index < 0 or index >= len(text) or not text[index].isalnum()
+
+    def search(self, text):
+        """Return the first term found in text, or None."""
+        text = text.lower()
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for term in self._output[state]:
+                if self._is_boundary(text, index - len(term)) and \
+                        self._is_boundary(text, index + 1):
+                    return term
+        return None
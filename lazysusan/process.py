@@ -0,0 +1,485 @@
+"""Support for running LazySusan plugins in worker subprocesses.
+
+A ProcessPlugin stands in for the plugin within the bot. The real plugin is
+constructed in a worker process with a RemoteBot that forwards its API calls
+and event subscriptions to the bot over a multiprocessing pipe. Events and
+commands are sent to the worker along with a snapshot of the bot's state, in
+which the configuration and the membership sets are only included when they
+have changed.
+
+"""
+
+from __future__ import print_function
+import heapq
+import os
+import threading
+import time
+import traceback
+from lazysusan.helpers import encode_message, import_plugin
+from lazysusan.jobs import JobManager
+from lazysusan.plugins import CommandPlugin
+from lazysusan.shared import SharedCache
+from lazysusan.songs import SongCache
+from multiprocessing import Pipe, Process
+
+COMMAND_FLAGS = ('admin_or_moderator_required', 'admin_required',
+                 'command_cost', 'dynamic_permissions', 'moderator_required')
+
+
+class CallbackToken(object):
+
+    """Identifies a worker callback passed as an argument to an API call."""
+
+    def __init__(self, number):
+        self.number = number
+
+
+class ProcessPlugin(object):
+
+    """The bot's handle to a plugin that runs in a worker process.
+
+    The worker is restarted with an increasing delay if it exits
+    unexpectedly, e.g., when it exceeds its CPU or memory limit. After
+    MAX_RESTART_ATTEMPTS consecutive failed restarts the plugin is left
+    stopped.
+
+    The CPU limit is a budget of CPU seconds for the lifetime of a worker
+    rather than a rate: a long running worker is eventually stopped when it
+    uses up its budget, and then restarts with a new one.
+
+    """
+
+    LOAD_TIMEOUT = 10
+    MAX_RESTART_ATTEMPTS = 5
+    MAX_RESTART_DELAY = 60
+    MEMBERSHIP = ('dj_ids', 'listener_ids', 'moderator_ids')
+    STATE_VERSION = 1
+
+    def __init__(self, bot, plugin_name, cpu=None, memory=None, nice=None):
+        self.bot = bot
+        self.commands = {}
+        self.events = {}
+        self.limits = {'cpu': cpu, 'memory': memory, 'nice': nice}
+        self.name = plugin_name
+        self.restart_delay = 1
+        self._closing = False
+        self._conn = None
+        self._config = None
+        self._membership = {}  # Name -> copy of the set last sent
+        self._process = None
+        self._send_lock = threading.Lock()
+        self._started = None
+
+    def _add_command(self, command, doc, flags):
+        """Register a command that is forwarded to the worker."""
+        def _closure(message, data):
+            self._send(('command', command, message, data, self._state()))
+        if command in self.bot.commands:
+            print('`{0}` cannot use the command `{1}`.'
+                  .format(self.name, command))
+            return
+        _closure.__doc__ = doc
+        _closure.__dict__.update(flags)
+        self.bot.commands[command] = _closure
+        self.commands[command] = _closure
+
+    def _add_event(self, event):
+        """Subscribe to an event on behalf of the worker."""
+        def _closure(data):
+            self._send(('event', event, data, self._state()))
+        if event not in self.events:
+            self.bot.api.on(event, _closure)
+            self.events[event] = _closure
+
+    def _call(self, method, args, kwargs):
+        """Perform an API call requested by the worker."""
+        def callback(token):
+            """Return a callback that forwards the response to the worker."""
+            return lambda data: self._send(('callback', token.number, data))
+
+        args = [callback(x) if isinstance(x, CallbackToken) else x
+                for x in args]
+        for key, value in kwargs.items():
+            if isinstance(value, CallbackToken):
+                kwargs[key] = callback(value)
+        getattr(self.bot.api, method)(*args, **kwargs)
+
+    def _handle(self, message):
+        """Handle a message from the worker. Return False once loaded."""
+        kind = message[0]
+        if kind == 'call':
+            self._call(*message[1:])
+        elif kind == 'on':
+            self._add_event(message[1])
+        elif kind == 'loaded':
+            for command, (doc, flags) in message[1].items():
+                self._add_command(command, doc, flags)
+            return False
+        elif kind == 'error':
+            print('Plugin `{0}` failed in its worker: {1}'
+                  .format(self.name, message[1]))
+            return False
+        return True
+
+    def _read(self, conn):
+        """Handle messages from the worker until it exits (reader thread)."""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, IOError):
+                break
+            with self.bot.api_lock:
+                try:
+                    self._handle(message)
+                except Exception:  # pylint: disable-msg=W0703
+                    traceback.print_exc()
+        with self.bot.api_lock:
+            self._remove()
+        if self._closing:
+            return
+        if time.time() - self._started > self.MAX_RESTART_DELAY:
+            self.restart_delay = 1
+        print('Plugin worker `{0}` exited.'.format(self.name))
+        self._schedule_restart(1)
+
+    def _restart(self, attempt):
+        """Restart the worker (timer thread), retrying with a backoff.
+
+        A restarted worker is warmed up, which also resumes its jobs, if the
+        bot is already ready.
+
+        """
+        if self._closing:
+            return
+        if self.start():
+            if self._closing:  # Closed while starting
+                self.close()
+            elif self.bot.ready_time:
+                with self.bot.api_lock:
+                    self.warmup()
+            return
+        if attempt >= self.MAX_RESTART_ATTEMPTS:
+            print('Plugin worker `{0}` failed to restart {1} times. Giving '
+                  'up; use /pgreload to try again.'.format(self.name, attempt))
+            return
+        self._schedule_restart(attempt + 1)
+
+    def _remove(self):
+        """Remove the commands and event subscriptions of the worker."""
+        for command, handler in self.commands.items():
+            if self.bot.commands.get(command) is handler:
+                del self.bot.commands[command]
+        signals = self.bot.api.signals
+        for event, handler in self.events.items():
+            signals[event] = [x for x in signals[event] if x is not handler]
+        self.commands = {}
+        self.events = {}
+
+    def _schedule_restart(self, attempt):
+        """Restart the worker after the current restart delay.
+
+        Restarts happen on a timer thread so that neither the websocket thread
+        nor the API lock is held up while the worker loads.
+
+        """
+        print('Restarting plugin worker `{0}` in {1} seconds.'
+              .format(self.name, self.restart_delay))
+        timer = threading.Timer(self.restart_delay, self._restart, (attempt,))
+        timer.daemon = True
+        timer.start()
+        self.restart_delay = min(self.restart_delay * 2,
+                                 self.MAX_RESTART_DELAY)
+
+    def _send(self, message):
+        """Send a message to the worker, ignoring a worker that has exited."""
+        with self._send_lock:
+            try:
+                self._conn.send(message)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _state(self):
+        """Return a snapshot of the bot state that plugins read.
+
+        RemoteBot must have every attribute in the snapshot. The config and
+        the MEMBERSHIP sets, whose size grows with the room, are only
+        included when they differ from what was last sent.
+
+        """
+        bot = self.bot
+        state = {'bot_id': bot.bot_id, 'max_djs': bot.max_djs,
+                 'ready_time': bot.ready_time, 'username': bot.username,
+                 'api': {'currentDjId': bot.api.currentDjId,
+                         'currentSongId': bot.api.currentSongId,
+                         'roomChatServer': bot.api.roomChatServer,
+                         'roomId': bot.api.roomId},
+                 'shared': {'enabled': bot.shared.enabled}}
+        if self._config is not bot.config:  # Only send when it changes
+            self._config = state['config'] = bot.config
+        for name in self.MEMBERSHIP:
+            value = getattr(bot, name)
+            if self._membership.get(name) != value:
+                self._membership[name] = frozenset(value)
+                state[name] = value
+        return state
+
+    def close(self):
+        """Stop the worker process and remove its commands and events."""
+        self._closing = True
+        self._remove()
+        self._send(('stop',))
+        if self._process:
+            self._process.join(1)
+            if self._process.is_alive():
+                self._process.terminate()
+
+    def export_state(self):
+        """State is not preserved when reloading a worker plugin."""
+        return None
+
+    def import_state(self, state, version):
+        """State is not preserved when reloading a worker plugin."""
+        return False
+
+    def start(self):
+        """Start the worker and wait for the plugin to be constructed.
+
+        Return whether or not the plugin was loaded successfully.
+
+        """
+        self._conn, child_conn = Pipe()
+        self._config = None
+        self._membership = {}
+        state = self._state()
+        self._process = Process(target=run_worker,
+                                args=(child_conn, self.name, state,
+                                      self.limits))
+        self._process.daemon = True
+        self._process.start()
+        self._started = time.time()
+        child_conn.close()
+
+        loaded = False
+        while self._conn.poll(self.LOAD_TIMEOUT):
+            try:
+                message = self._conn.recv()
+            except (EOFError, IOError):
+                break
+            with self.bot.api_lock:
+                if not self._handle(message):
+                    loaded = message[0] == 'loaded'
+                    break
+        if not loaded:
+            with self.bot.api_lock:
+                self._remove()
+            self._process.terminate()
+            return False
+        thread = threading.Thread(target=self._read, args=(self._conn,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def warmup(self):
+        """Have the plugin in the worker perform its warmup."""
+        self._send(('warmup', self._state()))
+
+
+class RemoteApi(object):
+
+    """Stands in for the ttapi Bot within a worker process."""
+
+    def __init__(self, bot):
+        self._bot = bot
+        self.currentDjId = None
+        self.currentSongId = None
+        self.roomChatServer = None
+        self.roomId = None
+        self.signals = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _closure(*args, **kwargs):
+            self._bot.call(name, args, kwargs)
+        return _closure
+
+    def emit(self, signal, data=None):
+        """Invoke the worker's callbacks for the signal."""
+        for callback in list(self.signals.get(signal) or []):
+            callback(data)
+
+    def on(self, signal, callback):
+        """Register a callback and subscribe the worker to the signal."""
+        if signal not in self.signals:
+            self.signals[signal] = []
+            self._bot.send(('on', signal))
+        self.signals[signal].append(callback)
+
+
+class RemoteBot(object):
+
+    """Stands in for LazySusan within a worker process."""
+
+    def __init__(self, conn):
+        self.api = RemoteApi(self)
+        self.bot_id = None
+        self.config = {}
+        self.conn = conn
+        self.dj_ids = set()
+        self.jobs = JobManager(self)
+        self.listener_ids = set()
+        self.max_djs = None
+        self.moderator_ids = set()
+        self.ready_time = None
+        self.shared = SharedCache(self)
+        self.songs = SongCache()
+        self.username = None
+        self._callbacks = {}
+        self._delayed_events = []
+        self._token = 0
+
+    def call(self, method, args, kwargs):
+        """Send an API call, replacing callbacks with tokens."""
+        def tokenize(value):
+            """Return a token in place of a callable value."""
+            if not callable(value):
+                return value
+            self._token += 1
+            self._callbacks[self._token] = value
+            return CallbackToken(self._token)
+
+        self.send(('call', method, [tokenize(x) for x in args],
+                   dict((key, tokenize(value)) for key, value
+                        in kwargs.items())))
+
+    def cancel_scheduled(self, owner):
+        """Cancel the scheduled events whose callback is a method of owner."""
+        self._delayed_events = [
+            x for x in self._delayed_events
+            if getattr(x[1], '__self__', None) is not owner]
+        heapq.heapify(self._delayed_events)
+
+    def is_admin(self, item):
+        """item can be either the user_id, or a dictionary from a message."""
+        if isinstance(item, dict):
+            item = item.get('userid') if item['command'] == 'speak' \
+                else item.get('senderid')
+        return item in self.config['admin_ids']
+
+    def is_moderator(self, item):
+        """item can be either the user_id, or a dictionary from a message."""
+        if isinstance(item, dict):
+            item = item.get('userid') if item['command'] == 'speak' \
+                else item.get('senderid')
+        return item in self.moderator_ids
+
+    def reply(self, message, data=None):
+        """Reply to a command on the same stream (pm/room chat) as invoked."""
+        message = encode_message(message)
+        if data is None or data['command'] == 'speak':
+            self.api.speak(message)
+        elif data['command'] == 'pmmed':
+            self.api.pm(message, data['senderid'])
+
+    def run(self, plugin):
+        """Handle messages from the bot until told to stop."""
+        while True:
+            now = time.time()
+            while self._delayed_events and self._delayed_events[0][0] <= now:
+                _, callback, args, kwargs = heapq.heappop(self._delayed_events)
+                self._safely(callback, *args, **kwargs)
+            timeout = None
+            if self._delayed_events:
+                timeout = max(0, self._delayed_events[0][0] - now)
+            if not self.conn.poll(timeout):
+                continue
+            try:
+                message = self.conn.recv()
+            except (EOFError, IOError):
+                return
+            kind = message[0]
+            if kind == 'stop':
+                return
+            elif kind == 'callback':
+                callback = self._callbacks.pop(message[1], None)
+                if callback:
+                    self._safely(callback, message[2])
+            elif kind == 'command':
+                self.update(message[4])
+                handler = getattr(plugin, plugin.COMMANDS[message[1]])
+                self._safely(handler, message[2], message[3])
+            elif kind == 'event':
+                self.update(message[3])
+                self._safely(self.api.emit, message[1], message[2])
+            elif kind == 'warmup':
+                self.update(message[1])
+                self._safely(plugin.warmup)
+                self.jobs.resume()
+
+    @staticmethod
+    def _safely(function, *args, **kwargs):
+        """Call function printing, rather than raising, any exception."""
+        try:
+            function(*args, **kwargs)
+        except Exception:  # pylint: disable-msg=W0703
+            traceback.print_exc()
+
+    def schedule(self, min_delay, callback, *args, **kwargs):
+        """Schedule an event to occur at least min_delay seconds in the future.
+
+        Scheduled events run within the worker.
+
+        """
+        heapq.heappush(self._delayed_events,
+                       (time.time() + min_delay, callback, args, kwargs))
+
+    def send(self, message):
+        """Send a message to the bot."""
+        self.conn.send(message)
+
+    def update(self, state):
+        """Update the bot's attributes from a state snapshot."""
+        for name in ('api', 'shared'):
+            for key, value in state.pop(name).items():
+                setattr(getattr(self, name), key, value)
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+def run_worker(conn, plugin_name, state, limits):
+    """The entry point of a plugin worker process."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        resource = None
+    if resource and limits['cpu']:
+        resource.setrlimit(resource.RLIMIT_CPU,
+                           (limits['cpu'], limits['cpu'] + 1))
+    if resource and limits['memory']:
+        memory = limits['memory'] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    if limits['nice'] and hasattr(os, 'nice'):
+        os.nice(limits['nice'])
+
+    bot = RemoteBot(conn)
+    bot.update(state)
+    try:
+        plugin_class = import_plugin(plugin_name)
+        if not plugin_class:
+            raise Exception('Cannot find plugin `{0}`.'.format(plugin_name))
+        plugin = plugin_class(bot)
+        plugin.__class__.NAME = plugin_name
+    except Exception as exc:  # pylint: disable-msg=W0703
+        traceback.print_exc()
+        conn.send(('error', str(exc)))
+        return
+    commands = {}
+    if isinstance(plugin, CommandPlugin):
+        for command, func_name in plugin.COMMANDS.items():
+            func = getattr(plugin, func_name)
+            flags = dict((x, func.__dict__[x]) for x in COMMAND_FLAGS
+                         if func.__dict__.get(x))
+            commands[command] = (func.__doc__, flags)
+    conn.send(('loaded', commands))
+    bot.run(plugin)
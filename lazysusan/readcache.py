@@ -0,0 +1,143 @@
+"""A single-flight cache of the responses of read-only API requests."""
+
+import copy
+import time
+from collections import OrderedDict
+
+
+class ReadCache(object):
+
+    """Answer repeated read-only API requests from recent responses.
+
+    The API client's read methods (TTLS) are replaced so that a successful
+    response is kept for the method's TTL, and so that a request made while
+    an identical one is in flight waits for that request's response instead
+    of being sent. Every caller but the first receives its own copy of the
+    response, so callers may modify what they receive.
+
+    Mutating requests (INVALIDATES) made through the API client discard the
+    responses of the read methods they affect, as do the room events
+    (ROOM_EVENTS) for the room the bot is in. A request that is not answered
+    within PENDING_TIMEOUT seconds, e.g., because of a reconnect, no longer
+    holds back identical requests.
+
+    """
+
+    INVALIDATES = {'addDj': ('roomInfo',),
+                   'modifyLaptop': ('userInfo',),
+                   'modifyName': ('userInfo',),
+                   'playlistAdd': ('playlistAll',),
+                   'playlistCreate': ('playlistAll', 'playlistListAll'),
+                   'playlistDelete': ('playlistAll', 'playlistListAll'),
+                   'playlistRemove': ('playlistAll',),
+                   'playlistRename': ('playlistAll', 'playlistListAll'),
+                   'playlistReorder': ('playlistAll',),
+                   'playlistSwitch': ('playlistListAll',),
+                   'remDj': ('roomInfo',),
+                   'roomDeregister': ('roomInfo',),
+                   'roomRegister': ('roomInfo',),
+                   'setAvatar': ('userInfo',)}
+    MAX_ENTRIES = 1000
+    PENDING_TIMEOUT = 30
+    ROOM_EVENTS = ('add_dj', 'deregistered', 'new_moderator', 'newsong',
+                   'nosong', 'registered', 'rem_dj', 'rem_moderator',
+                   'update_votes')
+    TTLS = {'playlistAll': 60, 'playlistListAll': 60, 'roomInfo': 10,
+            'userInfo': 300}
+
+    def __init__(self, api):
+        self.api = api
+        self.entries = OrderedDict()  # key -> (expiration time, response)
+        self.pending = {}  # key -> (time sent, callbacks)
+        self.stats = {'hits': 0, 'misses': 0, 'shared': 0}
+        for method in self.TTLS:
+            setattr(api, method, self._read(method, getattr(api, method)))
+        for method, methods in self.INVALIDATES.items():
+            setattr(api, method,
+                    self._mutate(methods, getattr(api, method)))
+        for event in self.ROOM_EVENTS:
+            api.on(event, self.handle_room_event)
+
+    @property
+    def hit_rate(self):
+        """Return the fraction of requests that were not sent."""
+        total = sum(self.stats.values())
+        if not total:
+            return 0.0
+        return float(self.stats['hits'] + self.stats['shared']) / total
+
+    def _key(self, method, args, kwargs):
+        """Return the cache key of a read request (without its callback)."""
+        if method == 'playlistAll':
+            return (method, args[0] if args else 'default')
+        if method == 'roomInfo':
+            return (method, kwargs.get('room_id', self.api.roomId),
+                    bool(args and args[0]))
+        return (method,)
+
+    def _mutate(self, methods, request):
+        """Return a wrapper of a mutating request that invalidates methods."""
+        def _closure(*args, **kwargs):
+            self.invalidate(*methods)
+            return request(*args, **kwargs)
+        return _closure
+
+    def _read(self, method, request):
+        """Return a caching wrapper of the read request method."""
+        def _closure(*args, **kwargs):
+            callback = kwargs.pop('callback', None)
+            if callback is None and args and callable(args[-1]):
+                args, callback = args[:-1], args[-1]
+            key = self._key(method, args, kwargs)
+            now = time.time()
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.stats['hits'] += 1
+                if callback:
+                    callback(copy.deepcopy(entry[1]))
+                return
+            flight = self.pending.get(key)
+            if flight and now - flight[0] < self.PENDING_TIMEOUT:
+                self.stats['shared'] += 1
+                flight[1].append(callback)
+                return
+            self.stats['misses'] += 1
+            flight = self.pending[key] = (now, [callback])
+
+            def respond(data):
+                if self.pending.get(key) is flight:  # Not invalidated
+                    del self.pending[key]
+                    if data.get('success'):
+                        self.store(key, data, method)
+                for i, function in enumerate(flight[1]):
+                    if function:
+                        function(data if i == 0 else copy.deepcopy(data))
+            request(*(args + (respond,)), **kwargs)
+        return _closure
+
+    def handle_room_event(self, _):
+        """Discard the cached information of the bot's room."""
+        for key in list(self.entries) + list(self.pending):
+            if key[0] == 'roomInfo' and key[1] == self.api.roomId:
+                self.entries.pop(key, None)
+                self.pending.pop(key, None)
+
+    def invalidate(self, *methods):
+        """Discard the responses of methods, including those in flight.
+
+        Requests in flight still answer their callers but are not cached, and
+        identical requests are sent again.
+
+        """
+        for key in list(self.entries) + list(self.pending):
+            if key[0] in methods:
+                self.entries.pop(key, None)
+                self.pending.pop(key, None)
+
+    def store(self, key, data, method):
+        """Cache a copy of a successful response for the method's TTL."""
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.TTLS[method],
+                             copy.deepcopy(data))
+        while len(self.entries) > self.MAX_ENTRIES:
+            self.entries.popitem(last=False)
@@ -0,0 +1,98 @@
+"""A cache of read-mostly data shared by the bots running on a host."""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+import time
+from lazysusan.storage import _replace
+
+
+class SharedCache(object):
+
+    """A cache of JSON values shared through the directory set by shared_dir.
+
+    Each value is stored in its own file, which is written to a temporary
+    file and then renamed so that readers never see a partial value. Values
+    are kept in memory and only re-read when their file is replaced, so a
+    value set or invalidated by one process is seen by every other process
+    on its next get.
+
+    Unless enabled, e.g., by --supervise or by setting shared_dir, nothing is
+    shared: get always misses and set and invalidate do nothing.
+
+    """
+
+    DIRECTORY = 'lazysusan-shared'
+
+    def __init__(self, bot, enabled=False):
+        self.bot = bot
+        self.enabled = enabled
+        self.entries = {}  # key -> (file stamp, value)
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @property
+    def directory(self):
+        """Return the directory values are stored in."""
+        return self.bot.config.get('shared_dir', self.DIRECTORY)
+
+    def _path(self, key):
+        """Return the path of the file storing the value of key."""
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, key, max_age=None):
+        """Return the value of key, or None if it is missing or too old.
+
+        :param max_age: The maximum number of seconds since the value was set.
+
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.entries.pop(key, None)
+            self.stats['misses'] += 1
+            return None
+        if max_age is not None and time.time() - stat.st_mtime > max_age:
+            self.stats['misses'] += 1
+            return None
+        stamp = (stat.st_ino, stat.st_mtime, stat.st_size)
+        entry = self.entries.get(key)
+        if not entry or entry[0] != stamp:
+            try:
+                with open(path) as fp:
+                    entry = (stamp, json.load(fp)['value'])
+            except (IOError, OSError, KeyError, ValueError):
+                self.stats['misses'] += 1
+                return None
+            self.entries[key] = entry
+        self.stats['hits'] += 1
+        return entry[1]
+
+    def invalidate(self, key):
+        """Remove the value of key for every process."""
+        if not self.enabled:
+            return
+        self.entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def set(self, key, value):
+        """Store the value of key for every process."""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_path, 'w') as fp:
+                json.dump({'key': key, 'value': value}, fp)
+            _replace(tmp_path, path)
+        except (IOError, OSError) as exc:
+            print('Cannot share `{0}`: {1}'.format(key, exc))
@@ -0,0 +1,150 @@
+"""Periodic snapshots of LazySusan's state for warm restarts."""
+
+from __future__ import print_function
+import json
+import os
+import time
+from lazysusan.storage import _replace
+
+
+class SnapshotManager(object):
+
+    """Save the bot's and its plugins' state to a file, and restore it.
+
+    A snapshot holds the scheduled events whose callbacks are methods of the
+    bot or of a loaded plugin (and whose arguments are JSON serializable),
+    the room's dj, listener and moderator ids, and the exported state of each
+    loaded plugin. Snapshots are written to a temporary file that then
+    replaces the previous snapshot, so a crash never leaves a partial one.
+
+    The room ids are only restored from snapshots newer than MAX_ROOM_AGE
+    seconds, and are replaced by the server's once the room is joined.
+
+    """
+
+    INTERVAL = 60
+    MAX_ROOM_AGE = 300
+    SNAPSHOT_FILE = 'lazysusan-{0}.snapshot.json'
+    VERSION = 1
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.plugins = {}  # Restored plugin states not yet imported
+
+    @property
+    def path(self):
+        """Return the path of the snapshot file."""
+        default = self.SNAPSHOT_FILE.format(self.bot.config_section)
+        return self.bot.config.get('snapshot_file', default)
+
+    def _owner(self, callback):
+        """Return the name of the owner of a callback ('' for the bot)."""
+        owner = getattr(callback, '__self__', None)
+        if owner is self.bot:
+            return ''
+        for plugin_name, plugin in self.bot._loaded_plugins.items():
+            if owner is plugin:
+                return plugin_name
+        return None
+
+    def capture(self):
+        """Return the current state as a JSON serializable dictionary."""
+        events = []
+        for when, callback, args, kwargs in self.bot._delayed_events:
+            owner = self._owner(callback)
+            if owner is None:
+                continue
+            event = [when, owner, callback.__name__, list(args), kwargs]
+            try:
+                json.dumps(event)
+            except (TypeError, ValueError):
+                continue
+            events.append(event)
+
+        plugins = dict(self.plugins)  # Keep the state of unloaded plugins
+        for plugin_name, plugin in self.bot._loaded_plugins.items():
+            state = plugin.export_state()
+            if state is not None:
+                plugins[plugin_name] = [state, plugin.STATE_VERSION]
+        return {'dj_ids': sorted(self.bot.dj_ids),
+                'events': events,
+                'listener_ids': sorted(self.bot.listener_ids),
+                'max_djs': self.bot.max_djs,
+                'moderator_ids': sorted(self.bot.moderator_ids),
+                'plugins': plugins,
+                'room_id': self.bot.api.roomId,
+                'time': time.time(),
+                'username': self.bot.username,
+                'version': self.VERSION}
+
+    def checkpoint(self):
+        """Save a snapshot and schedule the next one."""
+        self.bot.schedule(self.INTERVAL, self.checkpoint)
+        self.save()
+
+    def load(self):
+        """Read the snapshot file and restore the bot's room state.
+
+        Return the snapshot, or None if there is no usable snapshot.
+
+        """
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path) as fp:
+                snapshot = json.load(fp)
+        except (IOError, OSError, ValueError) as exc:
+            print('Cannot load snapshot `{0}`: {1}'.format(self.path, exc))
+            return None
+        if snapshot.get('version') != self.VERSION:
+            print('Discarded snapshot `{0}` of an unknown version.'
+                  .format(self.path))
+            return None
+        self.plugins = dict((name, tuple(value)) for name, value
+                            in snapshot['plugins'].items())
+        self.bot.username = snapshot['username']
+        if snapshot['room_id'] == self.bot.config['room_id'] and \
+                time.time() - snapshot['time'] < self.MAX_ROOM_AGE:
+            self.bot.dj_ids = set(snapshot['dj_ids'])
+            self.bot.listener_ids = set(snapshot['listener_ids'])
+            self.bot.max_djs = snapshot['max_djs']
+            self.bot.moderator_ids = set(snapshot['moderator_ids'])
+        print('Loaded snapshot from {0:.0f} seconds ago.'
+              .format(time.time() - snapshot['time']))
+        return snapshot
+
+    def plugin_state(self, plugin_name):
+        """Return (and forget) the restored (state, version) of a plugin."""
+        return self.plugins.pop(plugin_name, None)
+
+    def restore_events(self, snapshot):
+        """Reschedule the snapshot's events whose owners are loaded.
+
+        Events whose callback is already scheduled, e.g., by __init__, are
+        skipped.
+
+        """
+        scheduled = set((self._owner(x[1]), x[1].__name__)
+                        for x in self.bot._delayed_events)
+        now = time.time()
+        for when, owner, name, args, kwargs in snapshot['events']:
+            if (owner, name) in scheduled:
+                continue
+            if owner:
+                target = self.bot._loaded_plugins.get(owner)
+            else:
+                target = self.bot
+            callback = getattr(target, name, None)
+            if callback is None:
+                continue
+            kwargs = dict((str(key), value) for key, value in kwargs.items())
+            self.bot.schedule(max(0, when - now), callback, *args, **kwargs)
+
+    def save(self):
+        """Write a snapshot, replacing the previous one."""
+        try:
+            with open(self.path + '.tmp', 'w') as fp:
+                json.dump(self.capture(), fp)
+            _replace(self.path + '.tmp', self.path)
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            print('Cannot save snapshot `{0}`: {1}'.format(self.path, exc))
@@ -0,0 +1,102 @@
+"""A cache of the metadata of the songs seen in turntable's payloads."""
+
+import sys
+from collections import OrderedDict
+
+
+class Song(object):
+
+    """The metadata of a song along with its display string."""
+
+    __slots__ = ('album', 'artist', 'display', 'id', 'length', 'title')
+
+    def __init__(self, item):
+        metadata = item.get('metadata') or {}
+        self.album = metadata.get('album') or u''
+        self.artist = metadata.get('artist') or u''
+        self.id = item['_id']
+        self.length = metadata.get('length')
+        self.title = metadata.get('song') or u''
+        self.display = u'"{0}" by {1}'.format(self.title, self.artist)
+
+    @property
+    def size(self):
+        """Return the approximate number of bytes used by the song."""
+        return sys.getsizeof(self) + sum(sys.getsizeof(x) for x in (
+            self.album, self.artist, self.display, self.id, self.title))
+
+
+class SongCache(object):
+
+    """A least recently used cache of song metadata keyed by song id.
+
+    Songs are added from every decoded frame that contains them (newsong
+    and room.info's current song and songlog, and playlist.all's list) and
+    the least recently used songs are evicted once the songs use more than
+    max_size bytes.
+
+    """
+
+    MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.songs = OrderedDict()  # Song id -> Song, most recently used last
+        self.stats = {'evicted': 0, 'hits': 0, 'misses': 0}
+
+    def __len__(self):
+        return len(self.songs)
+
+    def _touch(self, song_id):
+        """Return the cached song, marking it as the most recently used."""
+        song = self.songs.pop(song_id, None)
+        if song is not None:
+            self.songs[song_id] = song
+        return song
+
+    def add(self, item):
+        """Cache (or refresh) a song from a song dictionary and return it."""
+        song = Song(item)
+        previous = self.songs.pop(song.id, None)
+        if previous is not None:
+            self.size -= previous.size
+        self.songs[song.id] = song
+        self.size += song.size
+        while self.size > self.max_size and len(self.songs) > 1:
+            self.size -= self.songs.popitem(last=False)[1].size
+            self.stats['evicted'] += 1
+        return song
+
+    def get(self, song_id):
+        """Return the cached song with song_id, or None."""
+        song = self._touch(song_id)
+        self.stats['hits' if song else 'misses'] += 1
+        return song
+
+    def handle_message(self, data):
+        """Cache the songs contained in a received frame (pre_message)."""
+        obj = data[1]
+        if not obj:
+            return
+        if isinstance(obj.get('room'), dict):
+            metadata = obj['room'].get('metadata') or {}
+            items = list(metadata.get('songlog') or [])
+            items.append(metadata.get('current_song'))
+        elif isinstance(obj.get('list'), list):
+            items = obj['list']
+        else:
+            return
+        for item in items:
+            if isinstance(item, dict) and '_id' in item and \
+                    'metadata' in item and not self._touch(item['_id']):
+                self.add(item)
+
+    def lookup(self, item):
+        """Return the cached song of a song dictionary, caching it if needed.
+
+        This avoids rendering the songs of payloads that were not received as
+        frames, e.g., those read from the shared cache.
+
+        """
+        return self.get(item['_id']) or self.add(item)
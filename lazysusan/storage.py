@@ -0,0 +1,295 @@
+"""Compact on-disk storage used by LazySusan."""
+
+import binascii
+import heapq
+import io
+import json
+import mmap
+import os
+import re
+from array import array
+from collections import Counter
+from operator import itemgetter
+try:
+    from itertools import izip
+except ImportError:  # Python 3
+    izip = zip  # pylint: disable-msg=C0103
+
+
+def _replace(tmp_path, path):
+    """Atomically move tmp_path to path, replacing any existing file."""
+    if os.name == 'nt' and os.path.exists(path):  # rename won't replace
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+class PlayStore(object):
+
+    """An append-only, column-oriented store of song plays.
+
+    Each column is an array, and song, room and dj ids are interned to
+    integer indexes. Rows are persisted in chunks of CHUNK_SIZE rows where
+    only the last, partial chunk is rewritten by flush. Interned ids are
+    appended to strings.tsv.
+
+    The play count and the SUM_COLUMNS sums of every song, room and dj, and
+    the plays per hour, are updated on append, so queries take time in the
+    number of distinct ids rather than plays. flush saves them to
+    totals.json, and they are recomputed from the rows when that file does
+    not match them.
+
+    """
+
+    CHUNK_SIZE = 16384
+    COLUMNS = (('song', 'I'), ('room', 'I'), ('dj', 'I'), ('start', 'd'),
+               ('up', 'H'), ('down', 'H'), ('listeners', 'H'), ('hour', 'B'))
+    KINDS = ('song', 'room', 'dj')
+    SUM_COLUMNS = ('up', 'down', 'listeners')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.columns = dict((name, array(code)) for name, code in self.COLUMNS)
+        self.labels = dict((kind, []) for kind in self.KINDS)
+        self.strings = dict((kind, []) for kind in self.KINDS)
+        self.totals = dict((kind, dict((x, []) for x in
+                                       ('count',) + self.SUM_COLUMNS))
+                           for kind in self.KINDS)
+        self._flushed = 0
+        self._hours = [0] * 24
+        self._index = dict((kind, {}) for kind in self.KINDS)
+        self._new_strings = []
+        self._load()
+
+    def __len__(self):
+        return len(self.columns['song'])
+
+    def _add_totals(self, row):
+        """Add a row, a dictionary of column values, to the totals."""
+        for kind in self.KINDS:
+            totals = self.totals[kind]
+            index = row[kind]
+            totals['count'][index] += 1
+            for column in self.SUM_COLUMNS:
+                totals[column][index] += row[column]
+        self._hours[row['hour']] += 1
+
+    def _chunk_path(self, number):
+        """Return the path to the numbered chunk file."""
+        return os.path.join(self.directory, 'plays-{0:06d}.bin'.format(number))
+
+    def _intern(self, kind, value, label):
+        """Return the index for value, adding it if it is new."""
+        index = self._index[kind].get(value)
+        if index is None:
+            index = len(self.strings[kind])
+            self._index[kind][value] = index
+            self.labels[kind].append(label)
+            self.strings[kind].append(value)
+            for totals in self.totals[kind].values():
+                totals.append(0)
+            self._new_strings.append((kind, value, label))
+        return index
+
+    def _load(self):
+        """Load the strings and chunks previously written by flush."""
+        path = os.path.join(self.directory, 'strings.tsv')
+        if not os.path.isfile(path):
+            return
+        with io.open(path, encoding='utf-8') as fp:
+            for line in fp:
+                kind, value, label = line.rstrip('\n').split('\t', 2)
+                self._intern(kind, value, label)
+        self._new_strings = []
+        row_size = sum(self.columns[x].itemsize for x, _ in self.COLUMNS)
+        number = 0
+        while os.path.isfile(self._chunk_path(number)):
+            with open(self._chunk_path(number), 'rb') as fp:
+                data = fp.read()
+            rows = len(data) // row_size
+            offset = 0
+            for name, _ in self.COLUMNS:
+                column = self.columns[name]
+                size = rows * column.itemsize
+                if hasattr(column, 'frombytes'):  # Python 3
+                    column.frombytes(data[offset:offset + size])
+                else:
+                    column.fromstring(data[offset:offset + size])
+                offset += size
+            number += 1
+        self._flushed = len(self)
+        self._load_totals()
+
+    def _load_totals(self):
+        """Load the totals saved by flush, or recompute them from the rows."""
+        path = os.path.join(self.directory, 'totals.json')
+        try:
+            with open(path) as fp:
+                saved = json.load(fp)
+        except (IOError, OSError, ValueError):
+            saved = None
+        if saved and saved.get('rows') == len(self) and all(
+                len(values) == len(self.strings[kind])
+                for kind in self.KINDS
+                for values in saved['totals'][kind].values()):
+            self._hours = saved['hours']
+            self.totals = saved['totals']
+            return
+        for kind in self.KINDS:
+            size = len(self.strings[kind])
+            totals = self.totals[kind]
+            counts = Counter(self.columns[kind])
+            totals['count'] = [counts[x] for x in range(size)]
+            for column in self.SUM_COLUMNS:
+                sums = totals[column] = [0] * size
+                for index, value in izip(self.columns[kind],
+                                         self.columns[column]):
+                    sums[index] += value
+        counts = Counter(self.columns['hour'])
+        self._hours = [counts[hour] for hour in range(24)]
+
+    def append(self, song, room, dj, start, up, down, listeners,
+               labels=None):
+        """Append a play.
+
+        :param labels: An optional dictionary mapping kind (song, room or dj)
+            to a display label for the id when it is first seen.
+
+        """
+        labels = labels or {}
+        row = {'song': self._intern('song', song, labels.get('song', song)),
+               'room': self._intern('room', room, labels.get('room', room)),
+               'dj': self._intern('dj', dj, labels.get('dj', dj)),
+               'start': start, 'up': min(up, 0xFFFF),
+               'down': min(down, 0xFFFF),
+               'listeners': min(listeners, 0xFFFF),
+               'hour': int(start % 86400 // 3600)}  # For hours
+        for name, _ in self.COLUMNS:
+            self.columns[name].append(row[name])
+        self._add_totals(row)
+
+    def counts(self, kind, limit):
+        """Return the most frequent (index, count) pairs of the kind."""
+        return heapq.nlargest(limit, (x for x in enumerate(
+            self.totals[kind]['count']) if x[1]), key=itemgetter(1))
+
+    def flush(self):
+        """Persist new strings and any rows added since the last flush."""
+        if self._flushed == len(self) and not self._new_strings:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if self._new_strings:
+            path = os.path.join(self.directory, 'strings.tsv')
+            with io.open(path, 'a', encoding='utf-8') as fp:
+                for kind, value, label in self._new_strings:
+                    label = label.replace('\t', ' ').replace('\n', ' ')
+                    fp.write(u'{0}\t{1}\t{2}\n'.format(kind, value, label))
+            self._new_strings = []
+        for number in range(self._flushed // self.CHUNK_SIZE,
+                            (len(self) - 1) // self.CHUNK_SIZE + 1):
+            start = number * self.CHUNK_SIZE
+            end = start + self.CHUNK_SIZE
+            path = self._chunk_path(number)
+            with open(path + '.tmp', 'wb') as fp:
+                for name, _ in self.COLUMNS:
+                    self.columns[name][start:end].tofile(fp)
+            _replace(path + '.tmp', path)
+        self._flushed = len(self)
+        path = os.path.join(self.directory, 'totals.json')
+        with open(path + '.tmp', 'w') as fp:
+            json.dump({'hours': self._hours, 'rows': len(self),
+                       'totals': self.totals}, fp)
+        _replace(path + '.tmp', path)
+
+    def hours(self):
+        """Return the number of plays that started in each hour (UTC)."""
+        return list(self._hours)
+
+    def sums(self, kind, column):
+        """Return a list of column's sum for each index of kind.
+
+        column must be one of SUM_COLUMNS.
+
+        """
+        return list(self.totals[kind][column])
+
+
+class PlaylistStore(object):
+
+    """A directory of local playlists stored as packed song ids.
+
+    Each playlist is a file of consecutive 12-byte song ids (the binary form
+    of turntable's 24 character hex ids). Files are only memory-mapped when a
+    playlist is read, so the size of the library does not affect startup.
+
+    """
+
+    EXTENSION = '.ids'
+    ID_RE = re.compile('^[0-9a-f]{24}$')
+    ID_SIZE = 12
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __contains__(self, name):
+        try:
+            return os.path.isfile(self._path(name))
+        except ValueError:
+            return False
+
+    def _path(self, name):
+        """Return the path to the file for the named playlist."""
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError('Invalid playlist name `{0}`.'.format(name))
+        return os.path.join(self.directory, name + self.EXTENSION)
+
+    def count(self, name):
+        """Return the number of song ids in the named playlist."""
+        return os.path.getsize(self._path(name)) // self.ID_SIZE
+
+    def names(self):
+        """Return the sorted list of playlist names in the store."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(x[:-len(self.EXTENSION)] for x in
+                      os.listdir(self.directory)
+                      if x.endswith(self.EXTENSION))
+
+    def read(self, name):
+        """Generate the song ids of the named playlist in order."""
+        with open(self._path(name), 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            size -= size % self.ID_SIZE  # Ignore a truncated trailing id
+            if not size:
+                return
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                packed = mapped[offset:offset + self.ID_SIZE]
+                yield binascii.hexlify(packed).decode('ascii')
+                offset += self.ID_SIZE
+        finally:
+            mapped.close()
+
+    def write(self, name, song_ids):
+        """Replace the named playlist with the provided song ids.
+
+        Raise ValueError, without modifying the playlist, if any of the song
+        ids are invalid.
+
+        """
+        path = self._path(name)
+        song_ids = list(song_ids)
+        invalid = [x for x in song_ids if not self.ID_RE.match(x)]
+        if invalid:
+            raise ValueError('Invalid song ids: {0}'
+                             .format(', '.join(invalid)))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            for song_id in song_ids:
+                fp.write(binascii.unhexlify(song_id))
+        _replace(tmp_path, path)
+        return len(song_ids)
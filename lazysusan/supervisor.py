@@ -0,0 +1,76 @@
+"""Run several bots, one per worker process, and restart those that exit."""
+
+from __future__ import print_function
+import time
+from multiprocessing import Process
+
+
+class Supervisor(object):
+
+    """Run target(section, *args) in a worker process for every section.
+
+    A worker that exits is restarted after a delay that doubles, up to
+    MAX_RESTART_DELAY, each time it exits within MAX_RESTART_DELAY seconds of
+    starting. When interrupted, workers are given STOP_TIMEOUT seconds to
+    exit, e.g., to save a snapshot, before they are terminated.
+
+    """
+
+    CHECK_INTERVAL = 1
+    MAX_RESTART_DELAY = 60
+    STOP_TIMEOUT = 5
+
+    def __init__(self, target, sections, args=()):
+        self.args = tuple(args)
+        self.target = target
+        self.workers = dict((section, {'delay': 1, 'process': None,
+                                       'restart_at': 0, 'started': None})
+                            for section in sections)
+
+    def _start(self, section):
+        """Start the worker for section."""
+        worker = self.workers[section]
+        worker['process'] = Process(target=self.target,
+                                    args=(section,) + self.args)
+        worker['process'].start()
+        worker['started'] = time.time()
+        print('Started bot `{0}` (pid {1}).'
+              .format(section, worker['process'].pid))
+
+    def check(self):
+        """Start the workers that are due and schedule exited ones."""
+        now = time.time()
+        for section, worker in sorted(self.workers.items()):
+            process = worker['process']
+            if process is not None and not process.is_alive():
+                process.join()
+                if now - worker['started'] > self.MAX_RESTART_DELAY:
+                    worker['delay'] = 1
+                print('Bot `{0}` exited with code {1}. Restarting in {2} '
+                      'seconds.'.format(section, process.exitcode,
+                                        worker['delay']))
+                worker['restart_at'] = now + worker['delay']
+                worker['delay'] = min(worker['delay'] * 2,
+                                      self.MAX_RESTART_DELAY)
+                worker['process'] = process = None
+            if process is None and now >= worker['restart_at']:
+                self._start(section)
+
+    def run(self):
+        """Supervise the workers until interrupted, then stop them."""
+        try:
+            while True:
+                self.check()
+                time.sleep(self.CHECK_INTERVAL)
+        except KeyboardInterrupt:
+            print('Interrupt received.')
+        # The workers received the interrupt as well, so let them exit
+        deadline = time.time() + self.STOP_TIMEOUT
+        for worker in self.workers.values():
+            process = worker['process']
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
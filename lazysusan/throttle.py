@@ -0,0 +1,77 @@
+"""Per-user and per-command throttling of LazySusan commands."""
+
+import time
+from collections import OrderedDict
+
+
+class CommandThrottle(object):
+
+    """Limit how often commands can be run using token buckets.
+
+    Every user has a bucket, and every command has a bucket shared by all
+    users. Running a command takes its cost in tokens from both buckets, and
+    buckets refill continuously at their rate up to their capacity. Buckets
+    are kept in least recently used order, and those that have refilled
+    (which are equivalent to new buckets) are evicted.
+
+    """
+
+    COMMAND_CAPACITY = 20
+    COMMAND_RATE = 0.5
+    MAX_BUCKETS = 10000
+    USER_CAPACITY = 10
+    USER_RATE = 0.2
+
+    def __init__(self):
+        self.buckets = OrderedDict()
+        self.limits = {'command': (self.COMMAND_CAPACITY, self.COMMAND_RATE),
+                       'user': (self.USER_CAPACITY, self.USER_RATE)}
+
+    def _evict(self, now):
+        """Remove buckets that have refilled or exceed MAX_BUCKETS."""
+        while self.buckets:
+            key = next(iter(self.buckets))
+            tokens, updated, _ = self.buckets[key]
+            capacity, rate = self.limits[key[0]]
+            if len(self.buckets) <= self.MAX_BUCKETS and \
+                    tokens + (now - updated) * rate < capacity:
+                break
+            del self.buckets[key]
+
+    def _take(self, key, now):
+        """Return the refilled bucket for key, moving it to the end."""
+        capacity, rate = self.limits[key[0]]
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = [capacity, now, False]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        self.buckets[key] = bucket
+        return bucket
+
+    def allow(self, user_id, command, cost=1):
+        """Return whether the user may run the command now.
+
+        When allowed, the cost is deducted from the user's and the command's
+        buckets.
+
+        """
+        now = time.time()
+        user = self._take(('user', user_id), now)
+        command = self._take(('command', command), now)
+        allowed = user[0] >= cost and command[0] >= cost
+        if allowed:
+            user[0] -= cost
+            user[2] = False
+            command[0] -= cost
+        self._evict(now)
+        return allowed
+
+    def should_warn(self, user_id):
+        """Return True only the first time a user is throttled in a row."""
+        bucket = self.buckets.get(('user', user_id))
+        if not bucket or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
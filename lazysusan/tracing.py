@@ -0,0 +1,111 @@
+"""Per-request tracing of turntable API calls and adaptive request pacing."""
+
+import time
+from collections import OrderedDict, deque
+
+
+class AdaptivePacer(object):
+
+    """Adjust the API client's rate limit according to recent error rates.
+
+    While the error rate over the last WINDOW responses stays at or below
+    LOW_ERROR_RATE the delay between requests is reduced by STEP. When it
+    exceeds HIGH_ERROR_RATE the delay is doubled, after which at least WINDOW
+    responses are observed before the next back off.
+
+    """
+
+    HIGH_ERROR_RATE = 0.2
+    LOW_ERROR_RATE = 0.05
+    MAX_RATE_LIMIT = 5.0
+    MIN_RATE_LIMIT = 0.2
+    STEP = 0.005
+    WINDOW = 20
+
+    def __init__(self, api):
+        self.api = api
+        self.results = deque(maxlen=self.WINDOW)
+        self._cooldown = 0
+
+    @property
+    def error_rate(self):
+        """Return the fraction of recent responses that were failures."""
+        if not self.results:
+            return 0.0
+        return float(self.results.count(False)) / len(self.results)
+
+    def record(self, success):
+        """Record the outcome of a request and adjust the rate limit."""
+        self.results.append(success)
+        if self._cooldown:
+            self._cooldown -= 1
+            return
+        if len(self.results) < self.WINDOW:
+            return
+        error_rate = self.error_rate
+        if error_rate > self.HIGH_ERROR_RATE:
+            self.api.rateLimit = min(self.MAX_RATE_LIMIT,
+                                     self.api.rateLimit * 2)
+            self._cooldown = self.WINDOW
+        elif error_rate <= self.LOW_ERROR_RATE:
+            self.api.rateLimit = max(self.MIN_RATE_LIMIT,
+                                     self.api.rateLimit - self.STEP)
+
+
+class ApiTracer(object):
+
+    """Record the latency and success of every API request by method.
+
+    Requests are matched to their responses by msgid, so callbacks passed to
+    the API client are left untouched.
+
+    """
+
+    MAX_PENDING = 1000
+
+    def __init__(self, api, pacer=None):
+        self.api = api
+        self.pacer = pacer
+        self.pending = OrderedDict()
+        self.stats = {}
+        self._send = api._send
+        api._send = self.send
+        api.on('pre_message', self.handle_message)
+
+    def handle_message(self, data):
+        """Match a received frame to a pending request (pre_message)."""
+        obj = data[1]
+        if not obj or obj.get('msgid') not in self.pending:
+            return
+        method, sent = self.pending.pop(obj['msgid'])
+        success = obj.get('success', True) is not False
+        stats = self.stats.setdefault(method, {'count': 0, 'errors': 0,
+                                               'max_latency': 0.0,
+                                               'total_latency': 0.0})
+        latency = time.time() - sent
+        stats['count'] += 1
+        stats['errors'] += not success
+        stats['max_latency'] = max(stats['max_latency'], latency)
+        stats['total_latency'] += latency
+        if self.pacer:
+            self.pacer.record(success)
+
+    def send(self, rq, callback=None):
+        """Send the request through the API client and note when it was sent.
+
+        This replaces the API client's _send method.
+
+        """
+        msgid = self.api._msgId
+        self._send(rq, callback)
+        self.pending[msgid] = (rq['api'], time.time())
+        if len(self.pending) > self.MAX_PENDING:  # Responses that never came
+            self.pending.popitem(last=False)
+
+    def summary(self, limit=5):
+        """Return a short description of the most frequently used methods."""
+        items = sorted(self.stats.items(), key=lambda x: -x[1]['count'])
+        return ', '.join('{0}: {1} calls, {2} errors, {3:.0f}ms avg'.format(
+            method, x['count'], x['errors'],
+            1000 * x['total_latency'] / x['count'])
+            for method, x in items[:limit])
@@ -21,9 +21,12 @@ setup(name=PACKAGE_NAME,
                    'Operating System :: OS Independent',
                    'Programming Language :: Python :: 2.6',
                    'Programming Language :: Python :: 2.7',
+                   'Programming Language :: Python :: 3',
                    'Topic :: Utilities'],
       description='LazySusan is a pluginable bot for turntable.fm.',
-      entry_points={'console_scripts': ['lazysusan = lazysusan:main']},
+      entry_points={'console_scripts': [
+          'lazysusan = lazysusan:main',
+          'lazysusan-fakeserver = lazysusan.fakeserver:main']},
       install_requires=['ttapi>=1.2.0', 'update_checker>=0.3'],
       keywords='turntable bot',
       license='Simplified BSD License',
@@ -0,0 +1,97 @@
+"""Test the jobs and helpers of the botdj plugins."""
+
+import random
+import unittest
+from lazysusan.plugins.botdj import LoadJob, UpdateJob, playlist_diff
+
+
+def apply_operations(playlist, operations):
+    """Return the playlist with the operations from playlist_diff applied."""
+    playlist = list(playlist)
+    for operation in operations:
+        if operation[0] == 'remove':
+            assert playlist.pop(operation[1]) == operation[2]
+        elif operation[0] == 'add':
+            playlist.insert(operation[2], operation[1])
+        else:
+            playlist.insert(operation[2], playlist.pop(operation[1]))
+    return playlist
+
+
+class FakePlaylist(object):
+
+    """The parts of the Playlist plugin that its jobs use."""
+
+    def __init__(self):
+        self.bot = None
+        self.changes = []
+        self.playlist = 'default'
+        self.playlists = {}
+
+    def changed(self, playlist_name):
+        self.changes.append(playlist_name)
+
+
+class LoadJobTest(unittest.TestCase):
+
+    def test_failed_add(self):
+        server = ['a', 'b', 'c', 'd']
+        items = ['x', 'd', 'bad', 'c', 'y', 'b', 'bad2', 'z']
+        job = LoadJob(FakePlaylist(), {}, {
+            'added': 0, 'applied': 0, 'failed': [], 'moved': 0, 'name': 'one',
+            'phase': 'fetch', 'playlist': 'default', 'removed': 0}, items)
+        self.assertTrue(job.handle({'list': [{'_id': x} for x in server],
+                                    'success': True}))
+        while job.state['applied'] < len(job.operations):
+            operation = job.operations[job.state['applied']]
+            if operation[0] == 'add' and operation[1].startswith('bad'):
+                self.assertTrue(job.handle({'success': False}))
+            else:
+                server = apply_operations(server, [operation])
+                self.assertTrue(job.handle({'success': True}))
+            self.assertEqual('apply', job.state['phase'])  # Not refetched
+        self.assertEqual(['x', 'd', 'c', 'y', 'b', 'z'], server)
+        self.assertEqual(['bad', 'bad2'], job.state['failed'])
+        self.assertEqual(set(server), job.plugin.playlists['default'])
+
+
+class PlaylistDiffTest(unittest.TestCase):
+
+    def test_duplicates_removed(self):
+        current = ['a', 'b', 'a', 'c', 'b']
+        self.assertEqual(['a', 'c', 'b'], apply_operations(
+            current, playlist_diff(current, ['a', 'c', 'b'])))
+
+    def test_random(self):
+        rand = random.Random(0)
+        for _ in range(500):
+            songs = [str(x) for x in range(rand.randint(0, 30))]
+            current = rand.sample(songs, rand.randint(0, len(songs)))
+            target = rand.sample(songs, rand.randint(0, len(songs)))
+            self.assertEqual(target, apply_operations(
+                current, playlist_diff(current, target)))
+
+    def test_stable_songs_not_moved(self):
+        self.assertEqual([], playlist_diff(['a', 'b', 'c'], ['a', 'b', 'c']))
+        self.assertEqual([('move', 0, 3)], playlist_diff(
+            ['a', 'b', 'c', 'd'], ['b', 'c', 'd', 'a']))
+        self.assertEqual([('remove', 1, 'b'), ('add', 'e', 2)], playlist_diff(
+            ['a', 'b', 'c'], ['a', 'c', 'e']))
+
+
+class UpdateJobTest(unittest.TestCase):
+
+    def test_songlog_order(self):
+        job = UpdateJob(FakePlaylist(), {}, {
+            'added': 0, 'index': 0, 'phase': 'info', 'playlist': 'room',
+            'room_id': 'room'})
+        songlog = [{'_id': 'b', 'score': 0.5}, {'_id': 'a'},
+                   {'_id': 'c', 'score': 0.1}, {'_id': 'd', 'score': None}]
+        self.assertTrue(job.handle({'room': {'metadata': {
+            'songlog': songlog}}, 'success': True}))
+        self.assertEqual('lists', job.state['phase'])
+        self.assertEqual(['a', 'd', 'c', 'b'], job.state['songs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Run a bot against FakeTurntable to test reconnecting and interrupts."""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from lazysusan.fakeserver import FakeTurntable
+
+try:
+    from Queue import Empty, Queue
+except ImportError:  # Python 3
+    from queue import Empty, Queue
+
+BOT_ID = 'botuser'
+CONFIG = """[DEFAULT]
+admin_ids: {0}
+auth_id: auth
+chat_server: {1}
+plugins:
+room_id: room1
+user_id: {0}
+"""
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The bot closes its connection as the stale watchdog would, once joined
+SCRIPT = """from __future__ import print_function
+import threading
+from lazysusan import LazySusan
+bot = LazySusan('DEFAULT', None, False, False)
+joins = []
+def joined(_):
+    print('Joined the room.')
+    joins.append(True)
+    if len(joins) == 1:
+        threading.Timer(0.1, bot._close_stale_connection).start()
+bot.api.on('roomChanged', joined)
+bot.start()
+print('Stopped.')
+"""
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeTurntable(seed=1)
+        self.server.add_user(BOT_ID, 'LazyBot')
+        self.server.add_room('room1', 'Room One')
+        address = self.server.start()
+        with open(os.path.join(self.directory, 'lazysusan.ini'), 'w') as fp:
+            fp.write(CONFIG.format(BOT_ID, address))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def _start_bot(self):
+        """Start the bot in a process. Return it, its reader and lines."""
+        env = dict(os.environ, HOME=self.directory, PYTHONUNBUFFERED='1')
+        env.pop('APPDATA', None)
+        env.pop('XDG_CONFIG_HOME', None)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_DIR] + [x for x in [env.get('PYTHONPATH')] if x])
+        process = subprocess.Popen([sys.executable, '-c', SCRIPT],
+                                   cwd=self.directory, env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        lines = Queue()
+
+        def _read():
+            for line in iter(process.stdout.readline, ''):
+                lines.put(line.strip())
+        thread = threading.Thread(target=_read)
+        thread.daemon = True
+        thread.start()
+        return process, thread, lines
+
+    @staticmethod
+    def _wait_for(lines, expected, count=1, timeout=20):
+        """Return the lines read until expected was read count times."""
+        retval = []
+        deadline = time.time() + timeout
+        while retval.count(expected) < count:
+            try:
+                retval.append(lines.get(timeout=max(0, deadline -
+                                                    time.time())))
+            except Empty:
+                break
+        return retval
+
+    def test_stale_close_then_interrupt(self):
+        process, reader, lines = self._start_bot()
+        try:
+            output = self._wait_for(lines, 'Joined the room.', count=2)
+            self.assertEqual(2, output.count('Joined the room.'), output)
+            self.assertIn('Websocket closed.', ' '.join(output))
+            process.send_signal(signal.SIGINT)
+            output = self._wait_for(lines, 'Stopped.', timeout=10)
+            self.assertIn('Interrupt received.', output)
+            self.assertIn('Stopped.', output)
+            self.assertNotIn('Websocket closed.', ' '.join(output))
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            reader.join(5)  # Closing stdout mid-read fails on Python 2
+            process.stdout.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Test the filtering and decoding of received frames."""
+
+import json
+import unittest
+from lazysusan.frames import FastJson, FrameFilter
+
+EVENT = '~m~40~m~{"command": "snagged", "userid": "a"}'
+RESPONSE = '~m~40~m~{"msgid": 3, "success": true}'
+
+
+class FakeApi(object):
+
+    """The parts of the API client that FrameFilter uses."""
+
+    def __init__(self):
+        self.debug = False
+        self.emitted = []
+        self.lastActivity = None
+        self.signals = {}
+
+    def emit(self, signal, data=None):
+        self.emitted.append((signal, data))
+
+    def on(self, signal, callback):
+        self.signals.setdefault(signal, []).append(callback)
+
+    def on_message(self, _, message):
+        """Decode the frame as the API client does."""
+        return json.loads(message[message.index('{'):])
+
+
+class FrameFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeApi()
+        self.frames = FrameFilter(self.api)
+
+    def test_wanted(self):
+        self.assertFalse(self.frames.wanted(EVENT))
+        self.assertTrue(self.frames.wanted(RESPONSE))
+        self.assertTrue(self.frames.wanted('~m~4~m~~h~1'))
+        self.api.on('snagged', lambda _: None)
+        self.assertTrue(self.frames.wanted(EVENT))
+
+    def test_wanted_by_pre_message(self):
+        def callback(_):
+            pass
+        self.api.on('pre_message', callback)
+        self.frames.decoded_only.add(callback)
+        self.assertFalse(self.frames.wanted(EVENT))
+        self.api.on('pre_message', lambda _: None)
+        self.assertTrue(self.frames.wanted(EVENT))
+
+    def test_wrap(self):
+        on_message = self.frames.wrap(self.api.on_message)
+        self.assertEqual({'msgid': 3, 'success': True},
+                         on_message(None, RESPONSE))
+        self.assertEqual(None, on_message(None, EVENT))
+        self.assertEqual([('post_message', (EVENT, None))], self.api.emitted)
+        self.assertEqual({'decoded': 1, 'dropped': 1}, self.frames.stats)
+        self.assertTrue(self.api.lastActivity)
+
+    def test_install(self):
+        on_message = FastJson.install(self.api.on_message)
+        self.assertIs(FastJson, on_message.__func__.__globals__['json'])
+        self.assertIs(json, globals()['json'])  # The module is unaffected
+        self.assertEqual({'msgid': 3, 'success': True},
+                         on_message(None, RESPONSE))
+
+
+if __name__ == '__main__':
+    unittest.main()
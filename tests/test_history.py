@@ -0,0 +1,68 @@
+"""Test the bounded, indexed chat history."""
+
+import unittest
+from lazysusan.history import ChatHistory
+
+
+class ChatHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history = ChatHistory(capacity=3)
+
+    @staticmethod
+    def texts(entries):
+        """Return the text of each entry."""
+        return [x[3] for x in entries]
+
+    def test_search(self):
+        self.history.add('a', 'Alice', 'Hello there')
+        self.history.add('b', 'Bob', 'hello, hello!')
+        self.history.add('a', 'Alice', 'bye')
+        self.assertEqual(['hello, hello!', 'Hello there'],
+                         self.texts(self.history.search('HELLO')))
+        self.assertEqual(['hello, hello!'],
+                         self.texts(self.history.search('hello', limit=1)))
+        self.assertEqual([], self.history.search('two words'))
+        self.assertEqual([], self.history.search('missing'))
+
+    def test_last_message(self):
+        self.history.add('a', 'Alice', 'first')
+        self.history.add('b', 'Bob', 'other')
+        self.history.add('a', 'Alice', 'second')
+        self.assertEqual('second', self.history.last_message('alice')[3])
+        self.assertEqual('Bob', self.history.name('b'))
+        self.assertEqual(None, self.history.last_message('carol'))
+
+    def test_private(self):
+        self.history.add('a', 'Alice', 'public words')
+        self.history.add('a', 'Alice', 'secret words', private=True)
+        self.assertEqual('public words',
+                         self.history.last_message('Alice')[3])
+        self.assertEqual('secret words', self.history.last_message(
+            'Alice', include_private=True)[3])
+        self.assertEqual(['public words'],
+                         self.texts(self.history.search('words')))
+
+    def test_eviction(self):
+        self.history.add('a', 'Alice', 'old news')
+        for i in range(3):
+            self.history.add('b', 'Bob', 'message {0}'.format(i))
+        self.assertEqual(3, len(self.history))
+        self.assertEqual([], self.history.search('news'))
+        self.assertEqual(None, self.history.last_message('Alice'))
+        self.assertNotIn('alice', self.history.names)
+        self.assertNotIn('old', self.history._tokens)
+        self.assertNotIn('a', self.history._users)
+        self.assertEqual(['message 2', 'message 1', 'message 0'],
+                         self.texts(self.history.search('message')))
+
+    def test_renamed_user_kept(self):
+        self.history.add('a', 'Alice', 'one')
+        self.history.add('b', 'Alice', 'two')  # Another user takes the name
+        for i in range(2):
+            self.history.add('c', 'Carol', str(i))
+        self.assertEqual('b', self.history.names['alice'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""Test running, checkpointing and resuming jobs."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lazysusan.jobs import Job, JobManager
+
+
+class FakeBot(object):
+
+    """The parts of LazySusan that JobManager and Job use."""
+
+    def __init__(self, directory):
+        self.config = {'job_dir': directory}
+        self.replies = []
+
+    def reply(self, message, data):
+        self.replies.append(message)
+
+
+class FakePlugin(object):
+
+    """Owns jobs and records the requests they issue."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.requests = []  # (item, callback)
+
+
+class CountJob(Job):
+
+    """Issues one request per item, counting the responses."""
+
+    KIND = 'count'
+
+    def handle(self, data):
+        self.state['done'] = self.state.get('done', 0) + 1
+        self.state.setdefault('results', []).append(data)
+        return self.state['done'] < len(self.items)
+
+    def resume(self):
+        self.state['resumed'] = self.state.get('resumed', 0) + 1
+
+    def step(self, callback):
+        self.plugin.requests.append(
+            (self.items[self.state.get('done', 0)], callback))
+        return True
+
+
+class JobManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bot = FakeBot(self.directory)
+        self.plugin = FakePlugin(self.bot)
+        self.manager = JobManager(self.bot)
+        self.manager.register(CountJob, self.plugin)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def respond(self, plugin=None):
+        """Respond to the oldest request of plugin with its item."""
+        item, callback = (plugin or self.plugin).requests.pop(0)
+        callback(item.upper())
+
+    def test_run_to_completion(self):
+        job = CountJob(self.plugin, {}, items=['a', 'b'])
+        job_id = self.manager.start(job)
+        self.assertEqual(1, job_id)
+        self.assertEqual(2, len(os.listdir(self.directory)))
+        self.respond()
+        self.respond()
+        self.assertEqual([], self.plugin.requests)
+        self.assertEqual({}, self.manager.jobs)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_resume_after_restart(self):
+        self.manager.start(CountJob(self.plugin, {'text': '/job'},
+                                    items=['a', 'b', 'c']))
+        self.respond()
+
+        # A new bot resumes the job from its checkpoint, once the plugin is
+        # registered and the bot is connected.
+        plugin = FakePlugin(self.bot)
+        manager = JobManager(self.bot)
+        manager.register(CountJob, plugin)
+        self.assertEqual([], plugin.requests)
+        manager.resume()
+        job = manager.jobs[1]
+        self.assertEqual({'text': '/job'}, job.data)
+        self.assertEqual(['a', 'b', 'c'], job.items)
+        self.assertEqual(2, job.state['resumed'])
+        self.assertEqual(2, manager.start(CountJob(plugin, {}, items=['d'])))
+        self.respond(plugin)
+        self.respond(plugin)
+        self.respond(plugin)
+        self.assertEqual(['A', 'B', 'C'], job.state['results'])
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_resume_ignores_stale_response(self):
+        self.manager.start(CountJob(self.plugin, {}, items=['a', 'b']))
+        self.manager.resume()  # E.g., on reconnect: the request is reissued
+        stale = self.plugin.requests.pop(0)[1]
+        self.respond()
+        stale('lost')
+        job = self.manager.jobs[1]
+        self.assertEqual(['A'], job.state['results'])
+        self.assertEqual([('b', self.plugin.requests[0][1])],
+                         self.plugin.requests)
+
+    def test_cancel(self):
+        job_id = self.manager.start(CountJob(self.plugin, {}, items=['a']))
+        self.assertTrue(self.manager.cancel(job_id))
+        self.assertFalse(self.manager.cancel(job_id))
+        self.respond()  # Ignored
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_release_keeps_checkpoint(self):
+        self.manager.start(CountJob(self.plugin, {}, items=['a', 'b']))
+        self.manager.release(self.plugin)
+        self.assertEqual({}, self.manager.jobs)
+        self.assertEqual({}, self.manager.kinds)
+        self.assertEqual(2, len(os.listdir(self.directory)))
+        self.manager.register(CountJob, self.plugin)
+        self.assertIn(1, self.manager.jobs)
+
+    def test_failure(self):
+        job = CountJob(self.plugin, {}, items=['a'])
+        job.handle = lambda data: 1 / 0
+        self.manager.start(job)
+        self.respond()
+        self.assertEqual(['Job 1 failed.'], self.bot.replies)
+        self.assertEqual({}, self.manager.jobs)
+
+
+if __name__ == '__main__':
+    unittest.main()
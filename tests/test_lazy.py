@@ -0,0 +1,95 @@
+"""Test declaring plugins that are loaded on their first command."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lazysusan import LazySusan
+# Python 2 cannot find these after chdir if the tests run from a relative path
+from lazysusan.plugins import appearance, botdj, simple  # noqa: F401
+
+ADMIN_ID = 'admin'
+CONFIG = """[lazy]
+admin_ids: {0}
+auth_id: auth
+chat_server: 127.0.0.1:8080
+plugins:
+room_id: room
+user_id: bot
+{1}
+"""
+LAZY = """lazy_plugins: simple.Talk /echo
+              botdj.Playlist /plclear /pllist"""
+
+
+class RecordingSocket(object):
+
+    """A websocket that records the frames sent rather than sending them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame):
+        """Record a frame."""
+        self.sent.append(frame)
+
+
+class LazyPluginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.write_config(LAZY)
+        self.bot = LazySusan('lazy', None, False, False)
+        self.bot.api.rateLimit = 0
+        self.bot.username = 'bot'
+        self.bot.api.ws = RecordingSocket()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def write_config(lazy):
+        """Write lazysusan.ini with the given lazy_plugins line."""
+        with open('lazysusan.ini', 'w') as fp:
+            fp.write(CONFIG.format(ADMIN_ID, lazy))
+
+    def speak(self, user_id, text):
+        """Handle a chat message from the given user."""
+        self.bot.handle_room_message({'command': 'speak', 'name': user_id,
+                                      'text': text, 'userid': user_id})
+
+    def test_command_flags(self):
+        pllist = self.bot.commands['/pllist']
+        self.assertEqual(3, pllist.__dict__.get('command_cost'))
+        self.assertTrue(pllist.__doc__.startswith('Output a summary'))
+        self.assertTrue(self.bot.commands['/plclear'].__dict__.get(
+            'admin_or_moderator_required'))
+        self.assertFalse(self.bot.commands['/echo'].__dict__)
+
+    def test_permission_checked_before_loading(self):
+        self.speak('user', '/plclear')
+        self.assertIn('botdj.Playlist', self.bot._lazy_plugins)
+        self.assertEqual(1, len(self.bot.api.ws.sent))
+        self.assertIn('"pm.send"', self.bot.api.ws.sent[0])
+
+    def test_removed_after_loading(self):
+        self.speak('user', '/echo hello')
+        self.assertIn('simple.Talk', self.bot._loaded_plugins)
+        self.write_config('lazy_plugins: botdj.Playlist /plclear /pllist')
+        os.utime('lazysusan.ini', (0, 0))  # Ensure the change is noticed
+        self.bot.check_config()
+        self.assertNotIn('simple.Talk', self.bot._loaded_plugins)
+        self.assertNotIn('/echo', self.bot.commands)
+        self.assertIn('botdj.Playlist', self.bot._lazy_plugins)
+
+    def test_unknown_command(self):
+        self.assertFalse(self.bot.declare_lazy_plugin(
+            'appearance.Appearance', ['/botavatar', '/nosuchcommand']))
+        self.assertNotIn('/botavatar', self.bot.commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
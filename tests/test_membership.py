@@ -0,0 +1,108 @@
+"""Test the coalescing of room membership events."""
+
+import unittest
+from lazysusan.membership import MembershipCoalescer
+
+
+class FakeApi(object):
+
+    """Records the events dispatched through the API client."""
+
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, signal, data=None):
+        self.emitted.append((signal, data))
+
+
+class FakeBot(object):
+
+    """The parts of LazySusan that MembershipCoalescer uses."""
+
+    def __init__(self):
+        self.api = FakeApi()
+        self.dj_ids = set()
+        self.listener_ids = set(['present'])
+        self.scheduled = []
+
+    def schedule(self, min_delay, callback, *args):
+        self.scheduled.append((min_delay, callback, args))
+
+
+def frame(command, *user_ids):
+    """Return a membership frame for the given users."""
+    return {'command': command,
+            'user': [{'name': x, 'userid': x} for x in user_ids]}
+
+
+class MembershipCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = FakeBot()
+        self.coalescer = MembershipCoalescer(self.bot)
+
+    def dispatched(self):
+        """Return (command, user ids) of each dispatched membership frame."""
+        return [(signal, [x['userid'] for x in data['user']])
+                for signal, data in self.bot.api.emitted
+                if signal in MembershipCoalescer.KINDS]
+
+    def test_net_changes(self):
+        self.bot.api.emit('registered', frame('registered', 'a', 'b'))
+        self.bot.api.emit('deregistered', frame('deregistered', 'a'))
+        self.bot.api.emit('registered', frame('registered', 'present'))
+        self.bot.api.emit('deregistered', frame('deregistered', 'present'))
+        self.bot.api.emit('add_dj', frame('add_dj', 'b'))
+        self.assertEqual([], self.bot.api.emitted)
+        self.coalescer.flush()
+        self.assertEqual([('deregistered', ['present']),
+                          ('registered', ['b']), ('add_dj', ['b'])],
+                         self.dispatched())
+        self.assertEqual(1, self.coalescer.stats['batches'])
+        self.assertEqual(3, self.coalescer.stats['dispatched'])
+
+    def test_other_event_flushes(self):
+        self.bot.api.emit('registered', frame('registered', 'a'))
+        self.bot.api.emit('speak', {'text': 'hi'})
+        self.assertEqual(['registered', 'speak'],
+                         [x[0] for x in self.bot.api.emitted])
+
+    def test_responses_do_not_flush(self):
+        self.bot.api.emit('registered', frame('registered', 'a'))
+        for signal in MembershipCoalescer.PASSTHROUGH:
+            self.bot.api.emit(signal, {'success': True})
+        self.assertEqual(list(MembershipCoalescer.PASSTHROUGH),
+                         [x[0] for x in self.bot.api.emitted])
+        self.assertTrue(self.coalescer.staged)
+
+    def test_high_water(self):
+        user_ids = ['u{0}'.format(i)
+                    for i in range(MembershipCoalescer.HIGH_WATER)]
+        self.bot.api.emit('registered', frame('registered', *user_ids))
+        self.assertEqual([('registered', user_ids)], self.dispatched())
+
+    def test_scheduled_flush(self):
+        self.bot.api.emit('registered', frame('registered', 'a'))
+        self.bot.api.emit('registered', frame('registered', 'b'))
+        self.assertEqual(1, len(self.bot.scheduled))
+        delay, callback, args = self.bot.scheduled.pop()
+        self.assertEqual(MembershipCoalescer.DELAY, delay)
+        self.coalescer._staged_time -= delay  # As if DELAY has passed
+        callback(*args)
+        self.assertEqual([('registered', ['a', 'b'])], self.dispatched())
+        self.assertEqual([], self.bot.scheduled)
+
+    def test_scheduled_flush_restaged(self):
+        self.bot.api.emit('registered', frame('registered', 'a'))
+        self.coalescer.flush()
+        self.bot.api.emit('registered', frame('registered', 'b'))
+        _, callback, args = self.bot.scheduled.pop()
+        callback(*args)  # Due for a, which was flushed, but not for b yet
+        self.assertEqual([('registered', ['a'])], self.dispatched())
+        self.assertEqual(1, len(self.bot.scheduled))
+        self.assertTrue(0 < self.bot.scheduled[0][0] <=
+                        MembershipCoalescer.DELAY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""Run each bundled plugin in a worker process."""
+
+import inspect
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from lazysusan.plugins import Plugin
+from lazysusan.process import ProcessPlugin, RemoteBot
+from lazysusan.shared import SharedCache
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lazysusan', 'plugins')
+BOT_ATTRIBUTE_RE = re.compile(r'\bbot\.([a-z_]+)')
+
+
+def bundled_plugins():
+    """Return the names, e.g., botdj.Dj, of the bundled plugins."""
+    retval = []
+    for filename in sorted(os.listdir(PLUGIN_DIR)):
+        if not filename.endswith('.py') or filename.startswith('_'):
+            continue
+        module_name = filename[:-3]
+        module = __import__('lazysusan.plugins.' + module_name,
+                            fromlist=[module_name])
+        for name, item in sorted(vars(module).items()):
+            if inspect.isclass(item) and issubclass(item, Plugin) and \
+                    item.__module__ == module.__name__:
+                retval.append('{0}.{1}'.format(module_name, name))
+    return retval
+
+
+class FakeApi(object):
+
+    """Records the API calls made through a ProcessPlugin."""
+
+    def __init__(self):
+        self.calls = []
+        self.currentDjId = None
+        self.currentSongId = None
+        self.roomChatServer = None
+        self.roomId = 'room'
+        self.signals = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.calls.append(name)
+
+    def on(self, signal, callback):
+        self.signals.setdefault(signal, []).append(callback)
+
+
+class FakeBot(object):
+
+    """The parts of LazySusan that ProcessPlugin uses."""
+
+    def __init__(self, directory):
+        self.api = FakeApi()
+        self.api_lock = threading.RLock()
+        self.bot_id = 'bot'
+        self.commands = {}
+        self.config = {'admin_ids': frozenset(), 'job_dir': directory,
+                       'playlist_dir': directory, 'shared_dir': directory,
+                       'stats_dir': directory}
+        self.dj_ids = set()
+        self.listener_ids = set()
+        self.max_djs = 5
+        self.moderator_ids = set()
+        self.ready_time = time.time()
+        self.shared = SharedCache(self)
+        self.username = 'bot'
+
+
+class ProcessPluginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bot = FakeBot(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _wait_for_call(self, method, timeout=5):
+        """Return whether or not the API method was called within timeout."""
+        deadline = time.time() + timeout
+        while method not in self.bot.api.calls and time.time() < deadline:
+            time.sleep(0.05)
+        return method in self.bot.api.calls
+
+    def test_bot_attributes(self):
+        remote = RemoteBot(None)
+        for filename in os.listdir(PLUGIN_DIR):
+            if not filename.endswith('.py'):
+                continue
+            with open(os.path.join(PLUGIN_DIR, filename)) as fp:
+                for attribute in BOT_ATTRIBUTE_RE.findall(fp.read()):
+                    self.assertTrue(hasattr(remote, attribute), '{0}: {1}'
+                                    .format(filename, attribute))
+
+    def test_bundled_plugins(self):
+        for plugin_name in bundled_plugins():
+            plugin = ProcessPlugin(self.bot, plugin_name)
+            self.assertTrue(plugin.start(), plugin_name)
+            try:
+                plugin.warmup()
+                if plugin_name == 'botdj.Playlist':
+                    self.assertTrue(self._wait_for_call('playlistListAll'))
+            finally:
+                plugin.close()
+
+    def test_restart(self):
+        plugin = ProcessPlugin(self.bot, 'botdj.Playlist')
+        self.assertTrue(plugin.start())
+        try:
+            plugin.warmup()
+            self.assertTrue(self._wait_for_call('playlistListAll'))
+            del self.bot.api.calls[:]
+            self.bot.commands.clear()
+            process = plugin._process
+            process.terminate()
+            process.join()
+            deadline = time.time() + 5
+            while plugin._process is process and time.time() < deadline:
+                # The restart happens while the API lock is mostly held
+                with self.bot.api_lock:
+                    time.sleep(0.05)
+            self.assertIsNot(process, plugin._process)
+            while not self.bot.commands and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(self.bot.commands)
+            # The restarted worker is warmed up again
+            self.assertTrue(self._wait_for_call('playlistListAll'))
+        finally:
+            plugin.close()
+
+    def test_state(self):
+        plugin = ProcessPlugin(self.bot, 'simple.Talk')
+        remote = RemoteBot(None)
+        remote.update(plugin._state())
+        self.assertEqual(self.bot.ready_time, remote.ready_time)
+        self.assertFalse(remote.shared.enabled)
+        self.bot.shared.enabled = True
+        remote.update(plugin._state())
+        self.assertTrue(remote.shared.enabled)
+
+    def test_state_membership(self):
+        plugin = ProcessPlugin(self.bot, 'simple.Talk')
+        remote = RemoteBot(None)
+        self.bot.dj_ids.add('dj')
+        remote.update(plugin._state())
+        self.assertEqual(set(['dj']), remote.dj_ids)
+        for name in ProcessPlugin.MEMBERSHIP:  # Unchanged sets are not sent
+            self.assertNotIn(name, plugin._state())
+        self.bot.listener_ids.add('listener')
+        state = plugin._state()
+        self.assertEqual(['listener_ids'], [
+            x for x in ProcessPlugin.MEMBERSHIP if x in state])
+        remote.update(state)
+        self.assertEqual(set(['dj']), remote.dj_ids)
+        self.assertEqual(set(['listener']), remote.listener_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
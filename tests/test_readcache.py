@@ -0,0 +1,134 @@
+"""Test the single-flight cache of read-only API requests."""
+
+import time
+import unittest
+from lazysusan import readcache
+from lazysusan.readcache import ReadCache
+
+
+class FakeApi(object):
+
+    """Records the requests sent, holding their callbacks."""
+
+    def __init__(self):
+        self.requests = []  # (method, args, callback)
+        self.roomId = 'room'
+        self.signals = {}
+        for method in list(ReadCache.TTLS) + list(ReadCache.INVALIDATES):
+            setattr(self, method, self._request(method))
+
+    def _request(self, method):
+        """Return a request method that records its calls."""
+        def _closure(*args, **kwargs):
+            callback = args[-1] if args and callable(args[-1]) else None
+            self.requests.append((method, args[:-1] if callback else args,
+                                  callback))
+        return _closure
+
+    def emit(self, signal, data=None):
+        for callback in self.signals.get(signal, []):
+            callback(data)
+
+    def on(self, signal, callback):
+        self.signals.setdefault(signal, []).append(callback)
+
+    def respond(self, data):
+        """Answer the oldest request."""
+        callback = self.requests.pop(0)[2]
+        callback(data)
+
+
+class FakeTime(object):
+
+    """Stands in for the time module with a clock that is set by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ReadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        readcache.time = self.clock
+        self.api = FakeApi()
+        self.cache = ReadCache(self.api)
+        self.received = []
+
+    def tearDown(self):
+        readcache.time = time
+
+    def test_ttl(self):
+        self.api.userInfo(self.received.append)
+        self.api.respond({'success': True, 'name': 'bot'})
+        self.api.userInfo(self.received.append)
+        self.assertEqual([], self.api.requests)
+        self.assertEqual(2, len(self.received))
+        self.received[1]['name'] = 'changed'  # Callers get their own copy
+        self.clock.now += ReadCache.TTLS['userInfo'] - 1
+        self.api.userInfo(self.received.append)
+        self.assertEqual('bot', self.received[2]['name'])
+        self.clock.now += 1
+        self.api.userInfo(self.received.append)
+        self.assertEqual(1, len(self.api.requests))
+        self.assertEqual({'hits': 2, 'misses': 2, 'shared': 0},
+                         self.cache.stats)
+
+    def test_single_flight(self):
+        for _ in range(3):
+            self.api.playlistAll('default', self.received.append)
+        self.api.playlistAll('other', self.received.append)
+        self.assertEqual(['default', 'other'],
+                         [x[1][0] for x in self.api.requests])
+        self.api.respond({'success': True, 'list': [1]})
+        self.assertEqual(3, len(self.received))
+        self.assertEqual({'success': True, 'list': [1]}, self.received[2])
+        self.assertIsNot(self.received[0], self.received[1])
+        self.assertEqual(2, self.cache.stats['shared'])
+
+    def test_failure_not_cached(self):
+        self.api.playlistListAll(self.received.append)
+        self.api.respond({'success': False})
+        self.api.playlistListAll(self.received.append)
+        self.assertEqual(1, len(self.api.requests))
+
+    def test_pending_timeout(self):
+        self.api.roomInfo(self.received.append)
+        self.clock.now += ReadCache.PENDING_TIMEOUT
+        self.api.roomInfo(self.received.append)
+        self.assertEqual(2, len(self.api.requests))
+
+    def test_invalidated_by_request(self):
+        self.api.playlistAll('default', self.received.append)
+        self.api.playlistAdd('song', self.received.append)
+        self.assertEqual(['playlistAll', 'playlistAdd'],
+                         [x[0] for x in self.api.requests])
+        self.api.respond({'success': True, 'list': []})  # Not cached
+        self.api.playlistAll('default', self.received.append)
+        self.assertEqual('playlistAll', self.api.requests[-1][0])
+
+    def test_invalidated_in_flight(self):
+        self.api.roomInfo(self.received.append)
+        self.api.emit('registered', {'user': []})
+        self.api.roomInfo(self.received.append)
+        self.assertEqual(2, len(self.api.requests))
+        self.api.respond({'success': True})
+        self.api.respond({'success': True})
+        self.assertEqual(2, len(self.received))
+        self.assertEqual(1, len(self.cache.entries))
+
+    def test_invalidated_by_room_event(self):
+        self.api.roomInfo(self.received.append)
+        self.api.respond({'success': True})
+        self.api.roomInfo(self.received.append, room_id='other')
+        self.api.respond({'success': True})
+        self.api.emit('newsong', {})
+        self.assertEqual([('roomInfo', 'other', False)],
+                         list(self.cache.entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
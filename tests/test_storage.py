@@ -0,0 +1,125 @@
+"""Test the on-disk stores of playlists and plays."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lazysusan.storage import PlayStore, PlaylistStore
+
+SONG_IDS = ['4f09de21590ca23168001a9e', '0123456789abcdef01234567',
+            'ffffffffffffffffffffffff']
+
+
+class PlaylistStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PlaylistStore(os.path.join(self.directory, 'lists'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.assertEqual([], self.store.names())
+        self.assertEqual(3, self.store.write('rock', SONG_IDS))
+        self.assertEqual(0, self.store.write('empty', []))
+        self.assertEqual(['empty', 'rock'], self.store.names())
+        self.assertEqual(SONG_IDS, list(self.store.read('rock')))
+        self.assertEqual([], list(self.store.read('empty')))
+        self.assertEqual(3, self.store.count('rock'))
+        self.assertIn('rock', self.store)
+        self.assertNotIn('jazz', self.store)
+
+    def test_replace(self):
+        self.store.write('rock', SONG_IDS)
+        self.store.write('rock', SONG_IDS[:1])
+        self.assertEqual(SONG_IDS[:1], list(self.store.read('rock')))
+
+    def test_invalid_ids(self):
+        self.store.write('rock', SONG_IDS)
+        self.assertRaises(ValueError, self.store.write, 'rock',
+                          SONG_IDS[:1] + ['not an id'])
+        self.assertEqual(SONG_IDS, list(self.store.read('rock')))
+
+    def test_invalid_names(self):
+        for name in ('', '.hidden', os.path.join('a', 'b')):
+            self.assertRaises(ValueError, self.store.write, name, SONG_IDS)
+            self.assertNotIn(name, self.store)
+
+    def test_truncated(self):
+        self.store.write('rock', SONG_IDS)
+        path = os.path.join(self.store.directory, 'rock.ids')
+        with open(path, 'ab') as fp:
+            fp.write(b'\x01\x02')
+        self.assertEqual(SONG_IDS, list(self.store.read('rock')))
+        self.assertEqual(3, self.store.count('rock'))
+
+
+class PlayStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), 'plays')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def open_store(self):
+        """Return the store in the directory, with small chunks."""
+        store = PlayStore(self.directory)
+        store.CHUNK_SIZE = 2
+        return store
+
+    @staticmethod
+    def fill(store):
+        """Append five plays of three songs in two rooms."""
+        store.append('s1', 'r1', 'd1', 3600, 1, 0, 10,
+                     labels={'song': u'Caf\xe9', 'room': 'Room 1'})
+        store.append('s2', 'r1', 'd1', 7200, 2, 1, 20)
+        store.append('s1', 'r2', 'd2', 7300, 0x10000, 0, 5)
+        store.flush()
+        store.append('s3', 'r2', 'd2', 90000, 0, 3, 7)
+        store.append('s1', 'r1', 'd2', 93600, 4, 0, 9)
+        store.flush()
+
+    def assert_filled(self, store):
+        """Check the plays appended by fill."""
+        self.assertEqual(5, len(store))
+        self.assertEqual(['s1', 's2', 's3'], store.strings['song'])
+        self.assertEqual([u'Caf\xe9', 's2', 's3'], store.labels['song'])
+        self.assertEqual(['Room 1', 'r2'], store.labels['room'])
+        self.assertEqual([(0, 3), (1, 1), (2, 1)], store.counts('song', 5))
+        self.assertEqual([(0, 3)], store.counts('room', 1))
+        self.assertEqual([0xFFFF + 5, 2, 0], store.sums('song', 'up'))
+        self.assertEqual([30, 21], store.sums('dj', 'listeners'))
+        self.assertEqual([0, 2, 3, 0], store.hours()[:4])
+        self.assertEqual([0, 0, 1, 1, 0], list(store.columns['room']))
+        self.assertEqual(93600, store.columns['start'][-1])
+
+    def test_round_trip(self):
+        store = self.open_store()
+        self.fill(store)
+        self.assert_filled(store)
+        self.assertEqual(['plays-000000.bin', 'plays-000001.bin',
+                          'plays-000002.bin', 'strings.tsv', 'totals.json'],
+                         sorted(os.listdir(self.directory)))
+        self.assert_filled(self.open_store())
+
+    def test_totals_recomputed(self):
+        self.fill(self.open_store())
+        os.remove(os.path.join(self.directory, 'totals.json'))
+        self.assert_filled(self.open_store())
+
+    def test_unflushed_rows_lost(self):
+        store = self.open_store()
+        self.fill(store)
+        store.append('s4', 'r1', 'd1', 0, 0, 0, 0)
+        store = self.open_store()
+        self.assertEqual(5, len(store))
+        store.append('s4', 'r1', 'd1', 0, 0, 0, 0)
+        store.flush()
+        self.assertEqual(['s1', 's2', 's3', 's4'],
+                         self.open_store().strings['song'])
+
+
+if __name__ == '__main__':
+    unittest.main()
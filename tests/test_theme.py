@@ -0,0 +1,53 @@
+"""Test matching songs against theme terms."""
+
+import random
+import re
+import unittest
+from lazysusan.plugins.theme import ThemeMatcher
+
+
+def naive_search(terms, text):
+    """Return the terms found in text as whole words, using regexes."""
+    return set(x for x in terms if re.search(
+        r'(?<!\w){0}(?!\w)'.format(re.escape(x)), text.lower(), re.UNICODE))
+
+
+class ThemeMatcherTest(unittest.TestCase):
+
+    def test_terms(self):
+        matcher = ThemeMatcher([' Rain ', 'rain', '', 'Blue Moon'])
+        self.assertEqual(['blue moon', 'rain'], matcher.terms)
+
+    def test_whole_words(self):
+        matcher = ThemeMatcher(['rain', 'blue moon'])
+        self.assertEqual('rain', matcher.search(u'Purple RAIN'))
+        self.assertEqual('rain', matcher.search(u'rain, rain, go away'))
+        self.assertEqual(None, matcher.search(u'Rainbow Connection'))
+        self.assertEqual(None, matcher.search(u'Brain Damage'))
+        self.assertEqual('blue moon', matcher.search(u'Blue Moon of Kentucky'))
+        self.assertEqual(None, matcher.search(u'Blue Moonlight'))
+        self.assertEqual(None, matcher.search(u'Blue\nMoon'))
+
+    def test_overlapping_terms(self):
+        matcher = ThemeMatcher(['he', 'she', 'hers', 'his'])
+        self.assertEqual('hers', matcher.search(u'ushers and hers'))
+        self.assertEqual('he', matcher.search(u'ushe he'))
+        self.assertEqual(None, matcher.search(u'ahishers'))
+
+    def test_random(self):
+        rand = random.Random(1)
+        for _ in range(200):
+            terms = [''.join(rand.choice('ab ') for _ in range(
+                rand.randint(1, 4))) for _ in range(rand.randint(1, 5))]
+            matcher = ThemeMatcher(terms)
+            text = ''.join(rand.choice('ab c') for _ in range(20))
+            expected = naive_search(matcher.terms, text)
+            found = matcher.search(text)
+            if expected:
+                self.assertIn(found, expected, (terms, text))
+            else:
+                self.assertEqual(None, found, (terms, text))
+
+
+if __name__ == '__main__':
+    unittest.main()
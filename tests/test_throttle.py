@@ -0,0 +1,74 @@
+"""Test the token bucket throttling of commands."""
+
+import time
+import unittest
+from lazysusan import throttle
+from lazysusan.throttle import CommandThrottle
+
+
+class FakeTime(object):
+
+    """Stands in for the time module with a clock that is set by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class CommandThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        throttle.time = self.clock
+        self.throttle = CommandThrottle()
+
+    def tearDown(self):
+        throttle.time = time
+
+    def test_user_bucket(self):
+        for _ in range(CommandThrottle.USER_CAPACITY):
+            self.assertTrue(self.throttle.allow('a', '/echo'))
+        self.assertFalse(self.throttle.allow('a', '/echo'))
+        self.assertTrue(self.throttle.allow('b', '/echo'))
+        self.clock.now += 1 / CommandThrottle.USER_RATE
+        self.assertTrue(self.throttle.allow('a', '/echo'))
+        self.assertFalse(self.throttle.allow('a', '/echo'))
+
+    def test_command_bucket(self):
+        for i in range(CommandThrottle.COMMAND_CAPACITY):
+            self.assertTrue(self.throttle.allow(i, '/echo'))
+        self.assertFalse(self.throttle.allow('new', '/echo'))
+        self.assertTrue(self.throttle.allow('new', '/say'))
+
+    def test_cost(self):
+        self.assertTrue(self.throttle.allow('a', '/pllist', cost=6))
+        self.assertFalse(self.throttle.allow('a', '/pllist', cost=6))
+        self.assertTrue(self.throttle.allow('a', '/echo', cost=4))
+
+    def test_should_warn(self):
+        self.assertFalse(self.throttle.should_warn('a'))
+        self.throttle.allow('a', '/echo', cost=CommandThrottle.USER_CAPACITY)
+        self.assertFalse(self.throttle.allow('a', '/echo'))
+        self.assertTrue(self.throttle.should_warn('a'))
+        self.assertFalse(self.throttle.should_warn('a'))
+        self.clock.now += 1 / CommandThrottle.USER_RATE
+        self.assertTrue(self.throttle.allow('a', '/echo'))
+        self.assertFalse(self.throttle.allow('a', '/echo'))
+        self.assertTrue(self.throttle.should_warn('a'))
+
+    def test_evict(self):
+        self.throttle.allow('a', '/echo')
+        self.clock.now += CommandThrottle.COMMAND_CAPACITY / \
+            CommandThrottle.COMMAND_RATE
+        self.throttle.allow('b', '/say')
+        self.assertEqual([('user', 'b'), ('command', '/say')],
+                         list(self.throttle.buckets))
+        self.throttle.MAX_BUCKETS = 1
+        self.throttle.allow('b', '/say')
+        self.assertEqual([('command', '/say')], list(self.throttle.buckets))
+
+
+if __name__ == '__main__':
+    unittest.main()